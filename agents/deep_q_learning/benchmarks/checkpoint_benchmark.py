@@ -0,0 +1,114 @@
+"""
+Measures the checkpoint write and resume times of the replay memory, the part of
+a MountainCarAgent checkpoint that grows with the configuration. The raw .npy column
+files used by ReplayMemory.save and load (memory-mapped) are compared with pickling the memory.
+"""
+
+import argparse
+import pickle
+import shutil
+import sys
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
+sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
+
+from agents.deep_q_learning.replay_memory import ReplayMemory, PrioritizedReplayMemory
+
+
+STATE_SIZE = 2
+ACTION_SPACE = 3
+
+
+def fill_memory(memory: ReplayMemory) -> ReplayMemory:
+    chunk = 100_000
+    for start in range(0, memory.max_size, chunk):
+        count = min(chunk, memory.max_size - start)
+        memory.append_batch(np.random.uniform(-1, 1, (count, STATE_SIZE)),
+                            np.random.randint(0, ACTION_SPACE, count),
+                            -np.ones(count),
+                            np.random.uniform(-1, 1, (count, STATE_SIZE)),
+                            np.random.random(count) < 0.005)
+    return memory
+
+
+def new_memory(size: int, prioritized: bool) -> ReplayMemory:
+    if prioritized:
+        return PrioritizedReplayMemory(max_size=size, state_shape=(STATE_SIZE,))
+    return ReplayMemory(max_size=size, state_shape=(STATE_SIZE,))
+
+
+def measure_memmap(memory: ReplayMemory, directory: Path, prioritized: bool) -> (float, float):
+    """
+    :return: Write and resume times in seconds
+    """
+    start = time.perf_counter()
+    memory.save(directory)
+    write_time = time.perf_counter() - start
+
+    restored = new_memory(memory.max_size, prioritized)
+    start = time.perf_counter()
+    restored.load(directory)
+    resume_time = time.perf_counter() - start
+
+    return write_time, resume_time
+
+
+def measure_pickle(memory: ReplayMemory, directory: Path) -> (float, float):
+    """
+    :return: Write and resume times in seconds
+    """
+    directory.mkdir(exist_ok=True, parents=True)
+    pickle_file = Path(directory, "replay_memory.pkl")
+    start = time.perf_counter()
+    with open(pickle_file, "wb") as pfile:
+        pickle.dump(memory, pfile, protocol=pickle.HIGHEST_PROTOCOL)
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with open(pickle_file, "rb") as pfile:
+        pickle.load(pfile)
+    resume_time = time.perf_counter() - start
+
+    return write_time, resume_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark replay memory checkpoint write and resume.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20_000, 1_000_000, 10_000_000],
+                        help="The replay_memory_size values to benchmark.")
+    parser.add_argument("--prioritized", action="store_true", default=False,
+                        help="Activate to benchmark the prioritized replay memory.")
+    parser.add_argument("--output_dir", type=str, default=None,
+                        help="Where to write the checkpoints. A temporary folder by default.")
+    args = parser.parse_args()
+
+    output_dir = Path(tempfile.mkdtemp() if args.output_dir is None else args.output_dir)
+
+    print(f"{'size':>12} {'format':>8} {'size (MB)':>10} {'write (s)':>10} {'resume (s)':>11}")
+    for size in args.sizes:
+        memory = fill_memory(new_memory(size, args.prioritized))
+        memory_mb = memory.nbytes / 2 ** 20
+
+        memmap_dir = Path(output_dir, f"memmap_{size}")
+        write_time, resume_time = measure_memmap(memory, memmap_dir, args.prioritized)
+        print(f"{size:>12} {'memmap':>8} {memory_mb:>10.1f} {write_time:>10.3f} {resume_time:>11.3f}")
+        shutil.rmtree(memmap_dir)
+
+        pickle_dir = Path(output_dir, f"pickle_{size}")
+        write_time, resume_time = measure_pickle(memory, pickle_dir)
+        print(f"{size:>12} {'pickle':>8} {memory_mb:>10.1f} {write_time:>10.3f} {resume_time:>11.3f}")
+        shutil.rmtree(pickle_dir)
+
+    if args.output_dir is None:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == '__main__':
+    main()
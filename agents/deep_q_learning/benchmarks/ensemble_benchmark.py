@@ -0,0 +1,113 @@
+"""
+Compares two ways of training K MountainCar DQN agents with different seeds:
+ - MountainCarEnsemble, the K Q networks stacked in one model trained in a single process
+ - K processes, each one training its own MountainCarAgent
+Both train every member for the same number of episodes with the same configuration.
+Process start up and Tensorflow import times are not measured.
+"""
+
+import argparse
+import multiprocessing
+import sys
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
+sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
+
+from agents.deep_q_learning.mountain_car.agent import AgentConfig
+
+
+CONFIG_FILE = Path(SCRIPT_DIR.parent.parent, "mountain_car", "configurations", "default.json")
+
+
+def agent_parameters(config: AgentConfig) -> dict:
+    return {"min_replay_memory_size": config.min_replay_memory_size,
+            "update_target_every": config.update_target_every,
+            "replay_memory_size": config.replay_memory_size,
+            "batch_size": config.batch_size,
+            "layer_size": config.hidden_layer_size,
+            "learning_rate": config.learning_rate,
+            "double_q_learning": config.double_q_learning,
+            "activation": config.activation,
+            "hidden_layers_count": config.hidden_layers_count,
+            "prioritized_replay": config.prioritized_replay,
+            "priority_alpha": config.priority_alpha,
+            "environments_count": config.environments_count,
+            "train_every": config.train_every,
+            "gradient_steps": config.gradient_steps,
+            "warmup_steps": config.warmup_steps,
+            "target_update": config.target_update,
+            "tau": config.tau,
+            "n_steps": config.n_steps}
+
+
+def train_single_agent(parameters: dict, episodes: int, seed: int, barrier):
+    """Process that trains one MountainCarAgent once all processes are ready."""
+    import tensorflow as tf
+    from agents.deep_q_learning.mountain_car.agent import MountainCarAgent
+
+    np.random.seed(seed)
+    tf.random.set_seed(seed)
+    agent = MountainCarAgent(**parameters)
+    barrier.wait()
+    agent.train_agent(episodes=episodes, show_every=episodes)
+
+
+def measure_processes(parameters: dict, episodes: int, seeds: list) -> float:
+    """
+    :return: Time in seconds until all processes finished training
+    """
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(len(seeds) + 1)
+    processes = [context.Process(target=train_single_agent, args=(parameters, episodes, seed, barrier))
+                 for seed in seeds]
+    for process in processes:
+        process.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for process in processes:
+        process.join()
+    return time.perf_counter() - start
+
+
+def measure_ensemble(parameters: dict, episodes: int, seeds: list) -> float:
+    """
+    :return: Training time of the ensemble in seconds
+    """
+    from agents.deep_q_learning.mountain_car.ensemble import MountainCarEnsemble
+
+    ensemble = MountainCarEnsemble(seeds=seeds, **parameters)
+    start = time.perf_counter()
+    ensemble.train_agent(episodes=episodes, show_every=episodes)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stacked DQN ensemble against one process per seed.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--config_file", type=str, default=CONFIG_FILE,
+                        help="Configuration file of the agents, the episodes are set with --episodes.")
+    parser.add_argument("--members", type=int, nargs="+", default=[1, 4, 8],
+                        help="The ensemble sizes to benchmark.")
+    parser.add_argument("--episodes", type=int, default=20,
+                        help="The episodes played by each member.")
+    args = parser.parse_args()
+
+    config = AgentConfig("ensemble_benchmark", args.config_file)
+    parameters = agent_parameters(config)
+
+    # Episodes are mostly lost at the start of training, so they take the maximum length
+    print(f"{'members':>8} {'mode':>10} {'time (s)':>9} {'episodes/s':>11}")
+    for members in args.members:
+        seeds = list(range(members))
+        for mode, measure in (("ensemble", measure_ensemble), ("processes", measure_processes)):
+            elapsed = measure(parameters, args.episodes, seeds)
+            print(f"{members:>8} {mode:>10} {elapsed:>9.2f} {members * args.episodes / elapsed:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Per-action latency of acting on a single state with the models of the agents,
+comparing the Tensorflow paths used before with DenseInferenceEngine:
+ - MountainCarAgent DQNModel: eager model call and compiled call vs engine greedy action
+ - MoveToGoalDQNAgent Sequential model: model.predict vs engine greedy action
+ - Policy gradient model: compiled produce_actions vs engine sampled action
+The engine outputs are checked against the model outputs.
+"""
+
+import argparse
+import sys
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import Sequential
+from tensorflow.keras.layers import Dense
+
+SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
+sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
+
+from code_utils.inference_utils import DenseInferenceEngine
+from agents.deep_q_learning.mountain_car.agent import DQNModel
+from agents.policy_gradient_methods.models import feed_forward_model_constructor
+
+
+def time_action(function, states: np.array) -> float:
+    """
+    :return: Mean time per action in microseconds
+    """
+    function(states[0])  # Warm up and tracing
+    start = time.perf_counter()
+    for state in states:
+        function(state)
+    return (time.perf_counter() - start) / len(states) * 1e6
+
+
+def mountain_car_model(layer_size: int, hidden_layers_count: int):
+    model = DQNModel(layer_size=layer_size, output_size=3, learning_rate=0.001,
+                     hidden_layers_count=hidden_layers_count)
+    model.build((None, 2))
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None, None], dtype=tf.float32)])
+    def compiled_call(states):
+        return model(states)
+
+    paths = {"eager call": lambda state: np.argmax(model(np.array([state]))),
+             "tf.function": lambda state: np.argmax(compiled_call(np.array([state], dtype=np.float32)))}
+    return model, paths
+
+
+def move_to_goal_model(layer_size: int):
+    model = Sequential()
+    model.add(Dense(layer_size, activation="relu", input_shape=(4,)))
+    model.add(Dense(layer_size, activation="relu"))
+    model.add(Dense(5, activation='linear'))
+    model.compile(loss="mse", optimizer="adam")
+
+    paths = {"predict": lambda state: np.argmax(model.predict(np.array([state]), verbose=0))}
+    return model, paths
+
+
+def policy_gradient_model(layer_size: int, hidden_layers_count: int, model_path: Path):
+    model = feed_forward_model_constructor(4, 2)(model_path=model_path, layer_size=layer_size,
+                                                 learning_rate=0.001, hidden_layers_count=hidden_layers_count)
+    model(np.zeros((1, 4), dtype=np.float32))
+
+    paths = {"produce_actions": lambda state: model.produce_actions(
+        tf.constant(np.array([state]), dtype=tf.float32))[0][0]}
+    return model, paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark single state action selection latency.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--layer_size", type=int, default=256,
+                        help="The hidden layers size of the models.")
+    parser.add_argument("--hidden_layers_count", type=int, default=3,
+                        help="The number of hidden layers of the MountainCar and policy gradient models.")
+    parser.add_argument("--actions", type=int, default=500,
+                        help="How many actions are timed for each path.")
+    args = parser.parse_args()
+
+    model_path = Path(SCRIPT_DIR.parent, "inference_benchmark_model")
+    models = {"MountainCar DQN": mountain_car_model(args.layer_size, args.hidden_layers_count),
+              "MoveToGoal DQN": move_to_goal_model(args.layer_size),
+              "Policy gradient": policy_gradient_model(args.layer_size, args.hidden_layers_count, model_path)}
+
+    print(f"{'model':>16} {'path':>16} {'latency (us)':>13} {'max abs error':>14}")
+    for name, (model, paths) in models.items():
+        input_size = model.layers[0].get_weights()[0].shape[0]
+        states = np.random.uniform(-1, 1, (args.actions, input_size)).astype(np.float32)
+        engine = DenseInferenceEngine("relu", weights_source=lambda: model.get_weights())
+
+        error = np.max(np.abs(engine.forward(states).copy() - model(states).numpy()))
+        if name == "Policy gradient":
+            paths["engine"] = engine.sample_action
+        else:
+            paths["engine"] = engine.greedy_action
+
+        for path, function in paths.items():
+            latency = time_action(function, states)
+            print(f"{name:>16} {path:>16} {latency:>13.1f} {error if path == 'engine' else '':>14}")
+
+    # Created by the policy gradient model summary writer
+    if model_path.exists():
+        import shutil
+        shutil.rmtree(model_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Measures the training steps per second of MoveToGoalDQNAgent on MoveToGoal configurations.
+The replay memory is filled with random play and then only training steps are timed.
+"""
+
+import argparse
+import sys
+import os
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
+sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
+
+from environments.move_to_goal.mtg_simple import MoveToGoalSimple
+from environments.move_to_goal.mtg_enemy import MoveToGoalEnemy
+from agents.deep_q_learning.move_to_goal.agent import MoveToGoalDQNAgent
+
+
+CONFIGS_DIR = Path(SCRIPT_DIR.parent.parent, "move_to_goal", "configurations")
+
+
+def create_game(config: dict):
+    parameters = {"board_x": config["board_size"][0],
+                  "board_y": config["board_size"][1],
+                  "goal_reward": config["goal_reward"],
+                  "move_reward": config["move_reward"],
+                  "game_end": config["game_end"],
+                  "goal_initial_pos": tuple(config["goal_initial_pos"]),
+                  "player_initial_pos": tuple(config["player_initial_pos"])}
+    if "enemy_reward" in config:
+        return MoveToGoalEnemy(enemy_reward=config["enemy_reward"],
+                               enemy_initial_pos=config["enemy_initial_pos"], **parameters)
+    return MoveToGoalSimple(**parameters)
+
+
+def fill_replay_memory(agent: MoveToGoalDQNAgent):
+    game = agent.game
+    while len(agent.replay_memory) < agent.min_replay_memory_size:
+        game.prepare_game()
+        done = False
+        while not done:
+            state = game.get_state()
+            action = np.random.randint(0, game.action_space)
+            new_state, reward, done = game.step(player_action=action)
+            agent.update_replay_memory((state, action, reward, new_state, done))
+
+
+def measure_training_steps(config: dict, steps: int, q_table_cache: bool) -> float:
+    """
+    :return: Training steps per second
+    """
+    agent = MoveToGoalDQNAgent(game=create_game(config),
+                               learning_rate=config["learning_rate"],
+                               replay_memory_size=config["replay_memory_size"],
+                               min_replay_memory_size=config["min_replay_memory_size"],
+                               batch_size=config["batch_size"],
+                               update_target_every=config["update_target_every"],
+                               hidden_layer_size=config["hidden_layer_size"],
+                               n_steps=config["n_steps"],
+                               q_table_cache=q_table_cache,
+                               q_table_refresh_every=config["q_table_refresh_every"])
+    fill_replay_memory(agent)
+
+    agent.training_step(config["discount"])  # Warm up and tracing
+    start = time.perf_counter()
+    for _ in range(steps):
+        agent.training_step(config["discount"])
+    return steps / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MoveToGoalDQNAgent training steps.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--config_files", type=str, nargs="+",
+                        default=[str(Path(CONFIGS_DIR, "simple_01.json")), str(Path(CONFIGS_DIR, "enemy_01.json"))],
+                        help="The configurations to benchmark.")
+    parser.add_argument("--steps", type=int, default=200,
+                        help="How many training steps are timed for each configuration.")
+    args = parser.parse_args()
+
+    print(f"{'config':>20} {'q table cache':>14} {'train steps/s':>14}")
+    for config_file in args.config_files:
+        with open(config_file, "r", encoding="utf8") as cfile:
+            config = json.load(cfile)
+        for q_table_cache in (False, True):
+            steps_per_second = measure_training_steps(config, args.steps, q_table_cache)
+            print(f"{Path(config_file).stem:>20} {str(q_table_cache):>14} {steps_per_second:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Measures the cost of sampling a minibatch from a PrioritizedReplayMemory and
+updating the priorities of the sampled transitions, for growing buffer sizes.
+With the sum tree both operations should grow with log(buffer size).
+"""
+
+import argparse
+import sys
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
+sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
+
+from agents.deep_q_learning.replay_memory import PrioritizedReplayMemory
+
+
+STATE_SIZE = 2
+ACTION_SPACE = 3
+
+
+def fill_memory(size: int) -> PrioritizedReplayMemory:
+    memory = PrioritizedReplayMemory(max_size=size, state_shape=(STATE_SIZE,))
+    chunk = 100_000
+    for start in range(0, size, chunk):
+        count = min(chunk, size - start)
+        indices = memory.append_batch(np.random.uniform(-1, 1, (count, STATE_SIZE)),
+                                      np.random.randint(0, ACTION_SPACE, count),
+                                      -np.ones(count),
+                                      np.random.uniform(-1, 1, (count, STATE_SIZE)),
+                                      np.random.random(count) < 0.005)
+        # Spread the priorities so sampling is not uniform
+        memory.update_priorities(indices, np.random.exponential(1., count))
+    return memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark prioritized replay sampling and updates.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10_000, 100_000, 1_000_000, 4_000_000, 10_000_000],
+                        help="The replay memory sizes to benchmark.")
+    parser.add_argument("--batch_size", type=int, default=64,
+                        help="The number of transitions in each sampled minibatch.")
+    parser.add_argument("--batches", type=int, default=1000,
+                        help="How many sample and update rounds are timed.")
+    args = parser.parse_args()
+
+    print(f"{'size':>12} {'depth':>6} {'sample (us)':>12} {'update (us)':>12} {'total (us)':>12}")
+    for size in args.sizes:
+        memory = fill_memory(size)
+
+        sample_time = 0.
+        update_time = 0.
+        for _ in range(args.batches):
+            start = time.perf_counter()
+            minibatch = memory.sample(args.batch_size, beta=0.4)
+            sample_time += time.perf_counter() - start
+
+            td_errors = np.random.normal(0., 1., args.batch_size)
+            start = time.perf_counter()
+            memory.update_priorities(minibatch.indices, td_errors)
+            update_time += time.perf_counter() - start
+
+        sample_us = sample_time / args.batches * 1e6
+        update_us = update_time / args.batches * 1e6
+        print(f"{size:>12} {memory.tree.depth:>6} {sample_us:>12.1f} {update_us:>12.1f} "
+              f"{sample_us + update_us:>12.1f}")
+
+        del memory
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Compares the deque based replay memory used originally by MountainCarAgent with
+the preallocated NumPy ReplayMemory. Measures minibatch sampling latency and
+the memory taken by the stored transitions, as the growth of the resident set size
+of a fresh process filling the memory. The NumPy buffers size is reported next to it.
+"""
+
+import argparse
+import multiprocessing
+import random
+import resource
+import sys
+import os
+import time
+from pathlib import Path
+from collections import deque
+
+import numpy as np
+
+SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
+sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
+
+from agents.deep_q_learning.replay_memory import ReplayMemory
+
+
+STATE_SIZE = 2
+ACTION_SPACE = 3
+
+
+def random_transition():
+    state = np.random.uniform(-1, 1, STATE_SIZE)
+    new_state = np.random.uniform(-1, 1, STATE_SIZE)
+    return state, np.random.randint(0, ACTION_SPACE), -1.0, new_state, bool(np.random.random() < 0.005)
+
+
+def fill_deque(size: int) -> deque:
+    memory = deque(maxlen=size)
+    for _ in range(size):
+        memory.append(random_transition())
+    return memory
+
+
+def sample_deque(memory: deque, batch_size: int):
+    minibatch = random.sample(memory, batch_size)
+    states = np.array([transition[0] for transition in minibatch])
+    actions = np.array([transition[1] for transition in minibatch])
+    rewards = np.array([transition[2] for transition in minibatch])
+    new_states = np.array([transition[3] for transition in minibatch])
+    dones = np.array([transition[4] for transition in minibatch])
+    return states, actions, rewards, new_states, dones
+
+
+def fill_replay_memory(size: int) -> ReplayMemory:
+    memory = ReplayMemory(max_size=size, state_shape=(STATE_SIZE,))
+    chunk = 100_000
+    for start in range(0, size, chunk):
+        count = min(chunk, size - start)
+        memory.append_batch(np.random.uniform(-1, 1, (count, STATE_SIZE)),
+                            np.random.randint(0, ACTION_SPACE, count),
+                            -np.ones(count),
+                            np.random.uniform(-1, 1, (count, STATE_SIZE)),
+                            np.random.random(count) < 0.005)
+    return memory
+
+
+def sample_replay_memory(memory: ReplayMemory, batch_size: int):
+    return memory.sample(batch_size)
+
+
+def max_rss() -> int:
+    """
+    :return: The peak resident set size of this process in bytes (ru_maxrss is in KB on Linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(fill_function, sample_function, size: int, batch_size: int, samples: int):
+    """
+    Fill a memory and time the sampling of minibatches from it.
+    Must run in a fresh process, so the peak resident set size only grows with this memory.
+    :return: Mean sample latency in microseconds, the resident set size growth in MB
+             and the size of the NumPy buffers in MB (None for the deque)
+    """
+    rss_before = max_rss()
+    memory = fill_function(size)
+    memory_used = max_rss() - rss_before
+    buffers_size = memory.nbytes / 2 ** 20 if isinstance(memory, ReplayMemory) else None
+
+    # Warm up
+    sample_function(memory, batch_size)
+
+    start = time.perf_counter()
+    for _ in range(samples):
+        sample_function(memory, batch_size)
+    latency = (time.perf_counter() - start) / samples * 1e6
+
+    del memory
+    return latency, memory_used / 2 ** 20, buffers_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark replay memory implementations.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20_000, 1_000_000, 10_000_000],
+                        help="The replay_memory_size values to benchmark.")
+    parser.add_argument("--batch_size", type=int, default=64,
+                        help="The number of transitions in each sampled minibatch.")
+    parser.add_argument("--samples", type=int, default=1000,
+                        help="How many minibatches are sampled to compute the latency.")
+    parser.add_argument("--skip_deque", action="store_true", default=False,
+                        help="Activate to only measure the NumPy replay memory.")
+    args = parser.parse_args()
+
+    implementations = {"numpy": (fill_replay_memory, sample_replay_memory)}
+    if not args.skip_deque:
+        implementations["deque"] = (fill_deque, sample_deque)
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{'size':>12} {'memory':>8} {'sample (us)':>12} {'RSS (MB)':>12} {'buffers (MB)':>13}")
+    for size in args.sizes:
+        for name, (fill_function, sample_function) in implementations.items():
+            with context.Pool(1) as pool:
+                latency, memory_used, buffers_size = pool.apply(measure, (fill_function, sample_function, size,
+                                                                          args.batch_size, args.samples))
+            buffers = "-" if buffers_size is None else f"{buffers_size:.1f}"
+            print(f"{size:>12} {name:>8} {latency:>12.1f} {memory_used:>12.1f} {buffers:>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Compares target network update strategies for the Mountain Car DQN model:
+ - set_weights(get_weights()), the weights round trip through NumPy
+ - Compiled hard copy with variable assignments
+ - Compiled soft (Polyak averaging) update
+"""
+
+import argparse
+import sys
+import os
+import time
+from pathlib import Path
+
+import tensorflow as tf
+
+SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
+sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
+
+from agents.deep_q_learning.mountain_car.agent import DQNModel
+from agents.deep_q_learning.target_network import update_target_variables
+
+
+STATE_SIZE = 2
+ACTION_SPACE = 3
+
+
+def build_model(layer_size: int, hidden_layers_count: int) -> DQNModel:
+    model = DQNModel(layer_size=layer_size, output_size=ACTION_SPACE, learning_rate=0.001,
+                     hidden_layers_count=hidden_layers_count)
+    model.build((None, STATE_SIZE))
+    return model
+
+
+def time_function(function, repeats: int) -> float:
+    """
+    :return: Mean time per call in milliseconds
+    """
+    function()  # Warm up and tracing
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark target network update strategies.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--layer_sizes", type=int, nargs="+", default=[256, 1024, 2048, 4096],
+                        help="The hidden_layer_size values to benchmark.")
+    parser.add_argument("--hidden_layers_count", type=int, default=3,
+                        help="The number of hidden layers of the models.")
+    parser.add_argument("--tau", type=float, default=0.005,
+                        help="Soft update weight of the online network.")
+    parser.add_argument("--repeats", type=int, default=100,
+                        help="How many updates are timed for each strategy.")
+    args = parser.parse_args()
+
+    print(f"{'layer size':>10} {'parameters':>12} {'set_weights (ms)':>17} "
+          f"{'compiled hard (ms)':>19} {'compiled soft (ms)':>19}")
+    for layer_size in args.layer_sizes:
+        model = build_model(layer_size, args.hidden_layers_count)
+        target_model = build_model(layer_size, args.hidden_layers_count)
+
+        @tf.function
+        def hard_update():
+            update_target_variables(target_model.variables, model.variables)
+
+        @tf.function
+        def soft_update():
+            update_target_variables(target_model.variables, model.variables, args.tau)
+
+        set_weights_time = time_function(lambda: target_model.set_weights(model.get_weights()), args.repeats)
+        hard_time = time_function(hard_update, args.repeats)
+        soft_time = time_function(soft_update, args.repeats)
+
+        print(f"{layer_size:>10} {model.count_params():>12} {set_weights_time:>17.3f} "
+              f"{hard_time:>19.3f} {soft_time:>19.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Actor processes for the actor-learner training of MountainCarAgent.
+Each actor steps its own MountainCar environments with a NumPy copy of the Q network
+and writes the transitions to shared memory slots read by the learner.
+The learner publishes fresh weights in shared memory every few updates.
+This module doesn't use Tensorflow, actors only need NumPy.
+"""
+
+import queue
+import traceback
+
+import numpy as np
+
+from code_utils.shared_memory_utils import SharedArrays, WeightsBroadcast
+from code_utils.inference_utils import DenseInferenceEngine
+from agents.deep_q_learning.mountain_car.batch_env import MountainCarBatch
+
+
+class TransitionSlots(object):
+    """
+    Shared memory queue of transition chunks. A fixed number of slots is preallocated:
+    actors take a free slot, fill it and announce it, the learner copies it to the
+    replay memory and frees it. When all slots are full actors wait for the learner.
+    """
+
+    def __init__(self, slots_count: int, chunk_size: int, state_size: int, context):
+        """
+        :param slots_count: The number of chunks that can be waiting for the learner
+        :param chunk_size: The number of transitions in a chunk
+        :param state_size: The size of an environment state
+        :param context: The multiprocessing context used to create the actors
+        """
+        self.chunk_size = chunk_size
+        self.arrays = SharedArrays({"states": ((slots_count, chunk_size, state_size), np.float32),
+                                    "actions": ((slots_count, chunk_size), np.int8),
+                                    "rewards": ((slots_count, chunk_size), np.float32),
+                                    "new_states": ((slots_count, chunk_size, state_size), np.float32),
+                                    "dones": ((slots_count, chunk_size), np.bool_)})
+        self.free = context.Queue()
+        self.full = context.Queue()
+        for slot in range(slots_count):
+            self.free.put(slot)
+
+    def next_chunk(self, actors: list, poll_interval: float=1.) -> tuple:
+        """
+        Wait for the next full slot, checking that the actors are still running.
+        :param actors: The actor processes writing to the slots
+        :param poll_interval: Seconds between the actors checks while waiting
+        :return: The slot, actor id, weights version, episodes rewards and episodes wins of the chunk
+        """
+        while True:
+            try:
+                chunk = self.full.get(timeout=poll_interval)
+            except queue.Empty:
+                chunk = None
+            if isinstance(chunk, str):
+                raise RuntimeError(f"Actor failed:\n{chunk}")
+
+            # Actors only exit when stopped, a failed actor sent its traceback before exiting
+            exited = [actor for actor in actors if actor.exitcode is not None]
+            if exited:
+                while True:
+                    try:
+                        message = self.full.get(timeout=poll_interval)
+                    except queue.Empty:
+                        break
+                    if isinstance(message, str):
+                        raise RuntimeError(f"Actor failed:\n{message}")
+                raise RuntimeError(f"{exited[0].name} exited with code {exited[0].exitcode}")
+
+            if chunk is not None:
+                return chunk
+
+    def close(self):
+        self.arrays.close()
+
+
+def run_actor(actor_id: int, environments_count: int, chunk_steps: int, slots: TransitionSlots,
+              broadcast: WeightsBroadcast, epsilon, stop_event, activation: str, seed: int):
+    """
+    Actor process loop: collect chunks of `chunk_steps` lockstep steps with an epsilon
+    greedy policy until the stop event is set. The weights are refreshed before each chunk.
+    If the actor fails, the traceback is sent through the full slots queue instead of a chunk.
+    :param actor_id: Identifies the actor in the chunks it sends
+    :param environments_count: The number of environments stepped in lockstep by this actor
+    :param chunk_steps: The number of lockstep steps in each chunk
+    :param slots: Where the chunks are written
+    :param broadcast: Where the learner publishes the weights
+    :param epsilon: Shared value with the exploration rate set by the learner
+    :param stop_event: Set by the learner to stop the actor
+    :param activation: The activation of the Q network hidden layers
+    :param seed: Random seed of this actor
+    """
+    try:
+        np.random.seed(seed)
+        envs = MountainCarBatch(environments_count)
+        envs.reset()
+        running_rewards = np.zeros(environments_count)
+        q_network = DenseInferenceEngine(activation)
+        version = -1
+
+        while not stop_event.is_set():
+            try:
+                slot = slots.free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            new_weights, version = broadcast.latest(version)
+            if new_weights is not None:
+                q_network.set_weights(new_weights)
+
+            episodes_rewards = []
+            episodes_wins = []
+            for step in range(chunk_steps):
+                states = envs.states.copy()
+                actions = q_network.greedy_actions(states)
+                explore = np.random.random(environments_count) <= max(0.01, epsilon.value)
+                actions[explore] = np.random.randint(0, envs.action_space, np.count_nonzero(explore))
+                new_states, rewards, dones, wins = envs.step(actions)
+
+                block = slice(step * environments_count, (step + 1) * environments_count)
+                slots.arrays["states"][slot, block] = states
+                slots.arrays["actions"][slot, block] = actions
+                slots.arrays["rewards"][slot, block] = rewards
+                slots.arrays["new_states"][slot, block] = new_states
+                slots.arrays["dones"][slot, block] = dones
+
+                running_rewards += rewards
+                for env_index in np.flatnonzero(dones):
+                    episodes_rewards.append(float(running_rewards[env_index]))
+                    episodes_wins.append(bool(wins[env_index]))
+                    running_rewards[env_index] = 0
+
+            slots.full.put((slot, actor_id, version, episodes_rewards, episodes_wins))
+    except Exception:
+        slots.full.put(traceback.format_exc())
@@ -1,17 +1,17 @@
 import time
-import random
+import json
 import logging
+import multiprocessing
+import queue
+import shutil
 import sys
 import os
-import pickle
 from pathlib import Path
-from collections import deque
 
 import gym
 import numpy as np
 import matplotlib.pyplot as plt
 import tensorflow as tf
-from mpl_toolkits.mplot3d import Axes3D
 from tensorflow.keras import Model
 from tensorflow.keras.layers import Dense
 
@@ -19,11 +19,26 @@ SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
 sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
 
 from code_utils.config_utils import BaseConfig
+from code_utils.inference_utils import DenseInferenceEngine
+from code_utils.profiler_utils import PhaseProfiler
+from code_utils.shared_memory_utils import WeightsBroadcast
+from agents.deep_q_learning.replay_memory import ReplayMemory, PrioritizedReplayMemory
+from agents.deep_q_learning.mountain_car.batch_env import MountainCarBatch
+from agents.deep_q_learning.mountain_car.actors import TransitionSlots, run_actor
+from agents.deep_q_learning.training_scheduler import TrainingScheduler
+from agents.deep_q_learning.target_network import check_target_update, update_target_variables
+from agents.deep_q_learning.mountain_car.q_values_snapshots import QValuesSnapshotWriter, evaluation_grid, \
+    q_values_plot_points, scatter_q_values
 
 
 logger = logging.getLogger()
 logging.getLogger("tensorflow").setLevel(logging.ERROR)
 
+CHECKPOINT_DIR = "checkpoint"
+PROFILE_DIR = "profile"
+EPSILON_MIN = 0.01
+EPSILON_DECAY = 0.01
+
 
 class AgentConfig(BaseConfig):
 
@@ -41,12 +56,29 @@ class AgentConfig(BaseConfig):
         self.min_replay_memory_size = self.config_dict["min_replay_memory_size"]
         self.batch_size = self.config_dict["batch_size"]
         self.update_target_every = self.config_dict["update_target_every"]
+        self.target_update = self.config_dict["target_update"]
+        self.tau = self.config_dict["tau"]
         self.hidden_layer_size = self.config_dict["hidden_layer_size"]
         self.plot_game = self.config_dict["plot_game"]
         self.save_q_values_every = self.config_dict["save_q_values_every"]
+        self.render_q_values = self.config_dict["render_q_values"]
         self.double_q_learning = self.config_dict["double_q_learning"]
         self.hidden_layers_count = self.config_dict["hidden_layers_count"]
         self.activation = self.config_dict["activation"]
+        self.prioritized_replay = self.config_dict["prioritized_replay"]
+        self.priority_alpha = self.config_dict["priority_alpha"]
+        self.priority_beta = self.config_dict["priority_beta"]
+        self.environments_count = self.config_dict["environments_count"]
+        self.train_every = self.config_dict["train_every"]
+        self.gradient_steps = self.config_dict["gradient_steps"]
+        self.warmup_steps = self.config_dict["warmup_steps"]
+        self.checkpoint_every = self.config_dict["checkpoint_every"]
+        self.n_steps = self.config_dict["n_steps"]
+        self.actors_count = self.config_dict["actors_count"]
+        self.actor_chunk_steps = self.config_dict["actor_chunk_steps"]
+        self.broadcast_every = self.config_dict["broadcast_every"]
+        self.profile_phases = self.config_dict["profile_phases"]
+        self.profile_steps = self.config_dict["profile_steps"]
 
 
 class DQNModel(Model):
@@ -93,19 +125,68 @@ class DQNModel(Model):
         self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
 
 
+class TrainingProgress(object):
+    """
+    Episodes results of a training run and statistics of the current block of episodes.
+    A block ends every show_every episodes, when its statistics are logged.
+    """
+
+    def __init__(self, show_every: int):
+        self.show_every = show_every
+        self.episodes_rewards = []
+        self.episodes_wins = []
+        self.first_win = False
+        self.last_loss, self.last_mean_q = None, None
+        self.training_start_time = time.time()
+        self.start_time = self.training_start_time
+        self.environment_steps = 0
+        self.block_start_trained_steps = 0
+
+    @property
+    def episodes_counter(self) -> int:
+        return len(self.episodes_rewards)
+
+    def add_episode(self, reward: float, win: bool, total_environment_steps: int) -> bool:
+        """
+        :param total_environment_steps: Environment steps since the start of the training, logged on the first win
+        :return: True if the episode ends a block
+        """
+        self.episodes_rewards.append(reward)
+        self.episodes_wins.append(bool(win))
+        if win and not self.first_win:
+            logger.info(f"First win after {total_environment_steps} environment steps "
+                        f"and {time.time() - self.training_start_time} sec")
+            self.first_win = True
+        return not self.episodes_counter % self.show_every
+
+    def start_block(self, trained_steps: int):
+        self.environment_steps = 0
+        self.block_start_trained_steps = trained_steps
+        self.start_time = time.time()
+
+
 class MountainCarAgent(object):
 
     def __init__(self, replay_memory_size: int, layer_size: int,
                  min_replay_memory_size: int, learning_rate: float,
                  batch_size: int, update_target_every: int,
                  double_q_learning: bool=False, prioritized_replay: bool=False,
-                 hidden_layers_count: int=3, activation: str="relu"):
+                 hidden_layers_count: int=3, activation: str="relu", priority_alpha: float=0.6,
+                 environments_count: int=1, train_every: int=1, gradient_steps: int=1,
+                 warmup_steps: int=0, target_update: str="hard", tau: float=0.005, n_steps: int=1):
+
+        check_target_update(target_update, tau)
 
-        # TODO: Implement prioritized_replay
         self.env = gym.make("MountainCar-v0")
         self.env.reset()
         self.action_space = self.env.action_space.n
         self.state_space = self.env.observation_space.shape[0]
+        self.environments_count = environments_count
+        self.envs = MountainCarBatch(environments_count)
+
+        # Fixed states used to take snapshots of the predicted Q values
+        self.q_values_grid = evaluation_grid(self.envs.min_position, self.envs.max_position,
+                                             self.envs.max_speed)
         self.trained_steps = 0
 
         self.model = DQNModel(layer_size=layer_size, output_size=self.action_space,
@@ -119,172 +200,557 @@ class MountainCarAgent(object):
         self.target_model.build((None, self.state_space))
         self.target_model.set_weights(self.model.get_weights())
 
-        self.replay_memory = deque(maxlen=replay_memory_size)
+        # NumPy copy of the model to act on single states, invalidated when the weights change
+        self.inference = DenseInferenceEngine(activation, weights_source=lambda: self.model.get_weights())
+
+        # The memory computes the n-step returns, following each environment stream
+        if prioritized_replay:
+            self.replay_memory = PrioritizedReplayMemory(max_size=replay_memory_size,
+                                                         state_shape=(self.state_space,),
+                                                         alpha=priority_alpha,
+                                                         n_steps=n_steps,
+                                                         streams=environments_count)
+        else:
+            self.replay_memory = ReplayMemory(max_size=replay_memory_size, state_shape=(self.state_space,),
+                                              n_steps=n_steps, streams=environments_count)
         self.min_replay_memory_size = min_replay_memory_size
         self.batch_size = batch_size
         self.target_update_counter = 0
         self.update_target_every = update_target_every
+        self.target_update = target_update
+        self.tau = tau
         self.double_q_learning = double_q_learning
+        self.scheduler = TrainingScheduler(train_every=train_every,
+                                           gradient_steps=gradient_steps,
+                                           warmup_steps=warmup_steps)
 
     def produce_action(self, state: tuple):
-        q_values = self.get_q_values(state)
-        action = np.argmax(q_values)
-        return action
+        return self.inference.greedy_action(state)
 
     def get_q_values(self, state: tuple):
         return self.model(np.array([state]))
 
+    def produce_actions(self, states: np.array) -> np.array:
+        """
+        Greedy actions for a batch of states, using a single model call.
+        """
+        q_values = self.batch_q_values(states.astype(np.float32))
+        return np.argmax(q_values, axis=1)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None, None], dtype=tf.float32)])
+    def batch_q_values(self, states: tf.Tensor):
+        logger.info("[Retrace] batch_q_values")
+        return self.model(states)
+
     # Adds step's data to a memory replay array
     # (state, action, reward, new_state, done)
     def update_replay_memory(self, transition):
-        self.replay_memory.append(transition)
+        self.replay_memory.append(*transition)
 
     def train_agent(self, episodes: int=25000, epsilon: float=1, plot_game: bool=False,
                     show_every: int=None, save_model: Path=None, discount: float=0.95,
-                    cycles: int=1, save_q_values_every: int=None):
-
-        if save_q_values_every is not None and save_model is None:
-            raise ValueError("If you want to save the q values during training you must "
-                             "specify an output folder.")
-        else:
-            q_values_dir = Path(save_model, "q_values")
-            q_values_dir.mkdir()
-
-        episodes_counter = 0
-        episodes_wins = []
-        episodes_rewards = []
-        epsilon_min = 0.01
-        epsilon_decay_value = 0.01
-        self.trained_steps = 0
-        if show_every is None:
-            show_every = episodes
+                    cycles: int=1, save_q_values_every: int=None, priority_beta: float=0.4,
+                    render_q_values: bool=False, checkpoint_every: int=None, resume: bool=False,
+                    profile_phases: bool=False, profile_steps: list=None):
+
+        profiler, q_values_writer = self.start_training(save_model, save_q_values_every, render_q_values,
+                                                        checkpoint_every, resume, profile_phases, profile_steps)
+        progress = TrainingProgress(show_every if show_every is not None else episodes)
+        checkpoint_dir = None if save_model is None else Path(save_model, CHECKPOINT_DIR)
+        checkpoint_due = False
+
+        first_cycle = 0
+        resumed_state = None
+        if resume:
+            resumed_state, resumed_arrays = self.resume_training(checkpoint_dir, progress)
+            first_cycle = resumed_state["cycle"]
+            logger.info(f"Resuming training from episode {progress.episodes_counter} of cycle {first_cycle}")
 
         logger.info("#### Starting training ####")
-        start_time = time.time()
-        for cycle in range(cycles):
+        logger.info(f"Collecting experience from {self.environments_count} environments in lockstep")
+        logger.info(f"Gradient steps per environment step = {self.scheduler.update_to_data_ratio} "
+                    f"after {self.scheduler.warmup_steps} warm-up steps")
+        logger.info(f"Using {self.replay_memory.n_steps}-step returns")
+        progress.start_block(self.trained_steps)
+        for cycle in range(first_cycle, cycles):
             current_epsilon = epsilon
-            for episode in range(episodes):
-                self.env.reset()
-                done = False
-                show = False
-                episode_reward = 0
-                current_epsilon = max(epsilon_min, current_epsilon)
-
-                if episode + (cycle * episodes) > 0:
-                    if not (episode + (cycle * episodes)) % show_every:
-                        logger.info("====================================================")
-                        logger.info(f"Showing episode N° {episode} of cycle {cycle}")
-                        logger.info(f"Executed training steps = {self.trained_steps}")
-                        logger.info(f"Batch time = {time.time() - start_time} sec")
-                        logger.info(f"Epsilon is {current_epsilon}")
-                        logger.info(f"Last {show_every} episodes reward mean: "
-                                    f"{np.mean(episodes_rewards[-show_every:])}")
-                        batch_wins = np.sum(episodes_wins[-show_every:])
-                        logger.info(f"Wins in last {show_every} episodes = {batch_wins}")
-                        show = True
-                        start_time = time.time()
-                    else:
-                        show = False
-
-                while not done:
-
-                    if show and plot_game:
-                        self.env.render()
-
-                    state = self.env.state
-                    if np.random.random() > current_epsilon:
-                        action = self.produce_action(state)
-                    else:
-                        action = np.random.randint(0, self.env.action_space.n)
-                    new_state, reward, done, _ = self.env.step(action)
-
-                    # Every step we update replay memory and train main network
-                    self.update_replay_memory((state, action, reward, new_state, done))
-                    self.training_step(discount)
-
-                    if done:
-                        if new_state[0] >= self.env.goal_position:
-                            episodes_wins.append(True)
-                        else:
-                            episodes_wins.append(False)
-                        self.target_update_counter += 1
-
-                    # If counter reaches set value, update target network with weights of main network
-                    if self.target_update_counter % self.update_target_every == 0 and self.target_update_counter > 0:
-                        self.target_model.set_weights(self.model.get_weights())
-                        self.target_update_counter = 0
-
-                    episode_reward += reward
-
-                    if save_q_values_every is not None:
-                        if not self.trained_steps % save_q_values_every:
-                            plot_points = self.q_values_plot(Path(q_values_dir, f"q_values_{self.trained_steps}.png"))
-                            with open(Path(q_values_dir, f"q_values_{self.trained_steps}.pickle"), "wb") as pfile:
-                                pickle.dump(plot_points, pfile, protocol=pickle.HIGHEST_PROTOCOL)
-
-                current_epsilon -= epsilon_decay_value
-
-                episodes_rewards.append(episode_reward)
-                episodes_counter += 1
-
-        moving_avg = np.convolve(episodes_rewards, np.ones((show_every,)) / show_every, mode='valid')
+            cycle_episodes = 0
+            self.envs.reset()
+            running_rewards = np.zeros(self.environments_count)
+
+            # Continue the cycle from the point where the checkpoint was saved
+            if resumed_state is not None:
+                current_epsilon = resumed_state["epsilon"]
+                cycle_episodes = resumed_state["cycle_episodes"]
+                self.envs.states[:] = resumed_arrays["env_states"]
+                self.envs.episode_steps[:] = resumed_arrays["env_episode_steps"]
+                running_rewards = resumed_arrays["running_rewards"]
+                resumed_state = None
+
+            while cycle_episodes < episodes:
+                states = self.envs.states.copy()
+
+                # Select actions for all environments with exploration/exploitation
+                with profiler.phase("policy_inference"):
+                    actions = self.produce_actions(states)
+                explore = np.random.random(self.environments_count) <= max(EPSILON_MIN, current_epsilon)
+                actions[explore] = np.random.randint(0, self.action_space, np.count_nonzero(explore))
+                with profiler.phase("environment_step"):
+                    new_states, rewards, dones, wins = self.envs.step(actions)
+
+                # Every lockstep we update replay memory with all transitions and
+                # train main network as many times as the scheduler says
+                with profiler.phase("replay_memory"):
+                    self.replay_memory.append_batch(states, actions, rewards, new_states, dones)
+                # Prioritized replay importance sampling correction is annealed to 1 during training
+                beta = priority_beta + (1. - priority_beta) * progress.episodes_counter / (episodes * cycles)
+                self.learner_steps(self.environments_count, discount, beta, progress, profiler,
+                                   q_values_writer, save_q_values_every)
+
+                running_rewards += rewards
+                for env_index in np.flatnonzero(dones):
+                    if cycle_episodes >= episodes:
+                        break
+
+                    block_done = progress.add_episode(running_rewards[env_index], wins[env_index],
+                                                      self.scheduler.environment_steps)
+                    running_rewards[env_index] = 0
+                    cycle_episodes += 1
+                    self.target_update_counter += 1
+                    current_epsilon -= EPSILON_DECAY
+
+                    if checkpoint_every is not None and not progress.episodes_counter % checkpoint_every:
+                        checkpoint_due = True
+
+                    if block_done:
+                        self.log_block(progress, profiler, f"Showing episode N° {cycle_episodes} of cycle {cycle}",
+                                       max(EPSILON_MIN, current_epsilon))
+                        if plot_game:
+                            self.play_game(plot_game=True)
+                        progress.start_block(self.trained_steps)
+
+                self.update_target_if_due()
+
+                # Checkpoints are saved once all the transitions of the lockstep are processed
+                if checkpoint_due:
+                    with profiler.phase("saving"):
+                        training_state, training_arrays = self.checkpoint_state(progress)
+                        training_state.update({"cycle": cycle,
+                                               "cycle_episodes": cycle_episodes,
+                                               "epsilon": current_epsilon})
+                        training_arrays.update({"env_states": self.envs.states,
+                                                "env_episode_steps": self.envs.episode_steps,
+                                                "running_rewards": running_rewards})
+                        self.save_checkpoint(checkpoint_dir, training_state, training_arrays)
+                    checkpoint_due = False
+
+        return self.finish_training(progress, save_model, profiler, q_values_writer)
+
+    def train_agent_actors(self, episodes: int=25000, epsilon: float=1, show_every: int=None,
+                           save_model: Path=None, discount: float=0.95, priority_beta: float=0.4,
+                           actors_count: int=2, actor_chunk_steps: int=50, broadcast_every: int=100,
+                           save_q_values_every: int=None, render_q_values: bool=False,
+                           checkpoint_every: int=None, resume: bool=False,
+                           profile_phases: bool=False, profile_steps: list=None):
+        """
+        Train with separate collection and learning. `actors_count` processes step their own
+        environments with a NumPy copy of the Q network and send the transitions through shared
+        memory, while this process (the learner) fills the replay memory and runs the training steps.
+        The learner publishes its weights every `broadcast_every` training steps, the policy
+        staleness (training steps between the weights used to collect a chunk and the learner
+        weights when it arrives) is reported with the other statistics. Two chunks per actor
+        can wait for the learner, which bounds the staleness when the learner is the bottleneck.
+        Checkpoints don't include the environments, the actors start new episodes when resuming.
+        :param actors_count: The number of actor processes
+        :param actor_chunk_steps: Lockstep steps collected by an actor before sending them
+        :param broadcast_every: Training steps between weights publications
+        See train_agent for the other parameters.
+        :return: The moving average of the episodes rewards
+        """
+        profiler, q_values_writer = self.start_training(save_model, save_q_values_every, render_q_values,
+                                                        checkpoint_every, resume, profile_phases, profile_steps)
+        progress = TrainingProgress(show_every if show_every is not None else episodes)
+        checkpoint_dir = None if save_model is None else Path(save_model, CHECKPOINT_DIR)
+        checkpoint_due = False
+        if resume:
+            self.resume_training(checkpoint_dir, progress)
+            logger.info(f"Resuming training from episode {progress.episodes_counter}")
+
+        context = multiprocessing.get_context("spawn")
+        chunk_size = actor_chunk_steps * self.environments_count
+        slots = TransitionSlots(slots_count=2 * actors_count, chunk_size=chunk_size,
+                                state_size=self.state_space, context=context)
+        broadcast = WeightsBroadcast([weights.shape for weights in self.model.get_weights()], context)
+        shared_epsilon = context.Value("d", max(EPSILON_MIN, epsilon - EPSILON_DECAY * progress.episodes_counter),
+                                       lock=False)
+        stop_event = context.Event()
+
+        # The last transitions of each environment in a chunk continue in a later chunk
+        chunk_cuts = np.zeros(chunk_size, dtype=np.bool_)
+        chunk_cuts[-self.environments_count:] = True
+        staleness = []
+
+        broadcast.publish(self.model.get_weights(), self.trained_steps)
+        actors = [context.Process(target=run_actor, name=f"actor_{actor_id}",
+                                  args=(actor_id, self.environments_count, actor_chunk_steps, slots, broadcast,
+                                        shared_epsilon, stop_event, self.model.activation,
+                                        np.random.randint(2 ** 31)),
+                                  daemon=True)
+                  for actor_id in range(actors_count)]
+        for actor in actors:
+            actor.start()
+
+        logger.info("#### Starting training ####")
+        logger.info(f"Collecting experience with {actors_count} actor processes of "
+                    f"{self.environments_count} environments")
+        logger.info(f"Gradient steps per environment step = {self.scheduler.update_to_data_ratio} "
+                    f"after {self.scheduler.warmup_steps} warm-up steps")
+        logger.info(f"Using {self.replay_memory.n_steps}-step returns")
+        progress.start_block(self.trained_steps)
+        try:
+            while progress.episodes_counter < episodes:
+                with profiler.phase("actors_wait"):
+                    slot, actor_id, version, chunk_rewards, chunk_wins = slots.next_chunk(actors)
+                with profiler.phase("replay_memory"):
+                    self.replay_memory.append_batch(slots.arrays["states"][slot],
+                                                    slots.arrays["actions"][slot],
+                                                    slots.arrays["rewards"][slot],
+                                                    slots.arrays["new_states"][slot],
+                                                    slots.arrays["dones"][slot],
+                                                    chunk_cuts)
+                slots.free.put(slot)
+                staleness.append(self.trained_steps - version)
+
+                beta = priority_beta + (1. - priority_beta) * progress.episodes_counter / episodes
+                broadcasts_count = self.trained_steps // broadcast_every
+                self.learner_steps(chunk_size, discount, beta, progress, profiler,
+                                   q_values_writer, save_q_values_every)
+                if self.trained_steps // broadcast_every > broadcasts_count:
+                    with profiler.phase("weights_broadcast"):
+                        broadcast.publish(self.model.get_weights(), self.trained_steps)
+
+                for episode_reward, win in zip(chunk_rewards, chunk_wins):
+                    if progress.episodes_counter >= episodes:
+                        break
+
+                    block_done = progress.add_episode(episode_reward, win, self.scheduler.environment_steps)
+                    self.target_update_counter += 1
+
+                    if checkpoint_every is not None and not progress.episodes_counter % checkpoint_every:
+                        checkpoint_due = True
+
+                    if block_done:
+                        self.log_block(progress, profiler, f"Showing episode N° {progress.episodes_counter}",
+                                       shared_epsilon.value,
+                                       [f"Policy staleness = {np.mean(staleness)} training steps "
+                                        f"(max {np.max(staleness)})"])
+                        staleness = []
+                        progress.start_block(self.trained_steps)
+
+                # Same exploration schedule as train_agent, applied by the actors
+                shared_epsilon.value = max(EPSILON_MIN, epsilon - EPSILON_DECAY * progress.episodes_counter)
+
+                self.update_target_if_due()
+
+                # Transitions still in the actors are lost when resuming, they only start new episodes
+                if checkpoint_due:
+                    with profiler.phase("saving"):
+                        training_state, training_arrays = self.checkpoint_state(progress)
+                        training_state["epsilon"] = shared_epsilon.value
+                        self.save_checkpoint(checkpoint_dir, training_state, training_arrays)
+                    checkpoint_due = False
+        finally:
+            stop_event.set()
+            # Actors can't exit while their last chunks are waiting in the queue
+            while any(actor.is_alive() for actor in actors):
+                try:
+                    slots.full.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            for actor in actors:
+                actor.join()
+            slots.close()
+            broadcast.close()
+
+        return self.finish_training(progress, save_model, profiler, q_values_writer)
+
+    def start_training(self, save_model: Path, save_q_values_every: int, render_q_values: bool,
+                       checkpoint_every: int, resume: bool, profile_phases: bool,
+                       profile_steps: list) -> (PhaseProfiler, QValuesSnapshotWriter):
+        """
+        Check the training options and reset the training counters.
+        See train_agent for the parameters.
+        :return: The phases profiler and the Q values snapshots writer, None if snapshots aren't saved
+        """
+        if (checkpoint_every is not None or resume) and save_model is None:
+            raise ValueError("Checkpoints are saved in the output folder, you must specify one.")
+        if profile_steps is not None and save_model is None:
+            raise ValueError("The Tensorflow profile is saved in the output folder, you must specify one.")
+
+        # Time spent in each phase of the loop, the Tensorflow profiler captures a window of gradient steps
+        profile_dir = None if save_model is None else Path(save_model, PROFILE_DIR)
+        profiler = PhaseProfiler(enabled=profile_phases,
+                                 summary_writer=None if profile_dir is None or not profile_phases
+                                 else tf.summary.create_file_writer(str(profile_dir)),
+                                 profile_steps=profile_steps, profile_dir=profile_dir)
+
+        q_values_writer = None
+        if save_q_values_every is not None:
+            if save_model is None:
+                raise ValueError("If you want to save the q values during training you must "
+                                 "specify an output folder.")
+            q_values_writer = QValuesSnapshotWriter(Path(save_model, "q_values"), self.q_values_grid,
+                                                    render=render_q_values)
+            q_values_writer.start()
+
+        self.trained_steps = 0
+        self.scheduler.reset()
+        return profiler, q_values_writer
+
+    def resume_training(self, checkpoint_dir: Path, progress: TrainingProgress) -> (dict, dict):
+        """
+        Load a checkpoint and restore the counters shared by both training loops.
+        :return: The training loop state and arrays of the checkpoint
+        """
+        training_state, training_arrays = self.load_checkpoint(checkpoint_dir)
+        self.trained_steps = training_state["trained_steps"]
+        self.target_update_counter = training_state["target_update_counter"]
+        self.scheduler.environment_steps = training_state["scheduler_environment_steps"]
+        progress.episodes_rewards = training_arrays["episodes_rewards"].tolist()
+        progress.episodes_wins = training_arrays["episodes_wins"].tolist()
+        progress.first_win = any(progress.episodes_wins)
+        return training_state, training_arrays
+
+    def checkpoint_state(self, progress: TrainingProgress) -> (dict, dict):
+        """
+        :return: The training loop state and arrays shared by both training loops, for save_checkpoint
+        """
+        training_state = {"episodes_counter": progress.episodes_counter,
+                          "trained_steps": self.trained_steps,
+                          "target_update_counter": self.target_update_counter,
+                          "scheduler_environment_steps": self.scheduler.environment_steps}
+        training_arrays = {"episodes_rewards": np.array(progress.episodes_rewards),
+                           "episodes_wins": np.array(progress.episodes_wins, dtype=np.bool_)}
+        return training_state, training_arrays
+
+    def learner_steps(self, environment_steps: int, discount: float, beta: float, progress: TrainingProgress,
+                      profiler: PhaseProfiler, q_values_writer: QValuesSnapshotWriter, save_q_values_every: int):
+        """
+        Run the training steps the scheduler gives for new environment steps, saving the
+        Q values snapshots when they are due.
+        :param environment_steps: The number of transitions added to the replay memory
+        """
+        progress.environment_steps += environment_steps
+        for _ in range(self.scheduler.step(environment_steps)):
+            profiler.training_step(self.trained_steps)
+            with profiler.phase("train_step"):
+                training_results = self.training_step(discount, beta)
+            if training_results is None:
+                break
+            progress.last_loss, progress.last_mean_q = training_results
+
+            # Snapshots are written by a background thread
+            if q_values_writer is not None and not self.trained_steps % save_q_values_every:
+                with profiler.phase("summaries"):
+                    q_values_writer.submit(self.trained_steps,
+                                           self.batch_q_values(self.q_values_grid).numpy())
+
+    def update_target_if_due(self):
+        # If counter reaches set value, update target network with weights of main network.
+        # Soft updates are done in every training step instead.
+        if self.target_update == "hard" and self.target_update_counter >= self.update_target_every:
+            self.update_target_model()
+            self.target_update_counter = 0
+
+    def log_block(self, progress: TrainingProgress, profiler: PhaseProfiler, title: str, epsilon: float,
+                  extra_lines: list=()):
+        """
+        Log the statistics of the last show_every episodes and write the phases summaries.
+        :param title: First line of the block
+        :param epsilon: The current exploration rate
+        :param extra_lines: Lines specific to the training loop, logged after the throughput
+        """
+        batch_time = time.time() - progress.start_time
+        show_every = progress.show_every
+        logger.info("====================================================")
+        logger.info(title)
+        logger.info(f"Executed training steps = {self.trained_steps}")
+        logger.info(f"Batch time = {batch_time} sec")
+        logger.info(f"Environment steps per second = {progress.environment_steps / batch_time}")
+        logger.info(f"Gradient steps per second = "
+                    f"{(self.trained_steps - progress.block_start_trained_steps) / batch_time}")
+        for line in extra_lines:
+            logger.info(line)
+        logger.info(f"Epsilon is {epsilon}")
+        if progress.last_loss is not None:
+            logger.info(f"Last training step loss = {float(progress.last_loss)} - "
+                        f"mean Q value = {float(progress.last_mean_q)}")
+        logger.info(f"Last {show_every} episodes reward mean: "
+                    f"{np.mean(progress.episodes_rewards[-show_every:])}")
+        batch_wins = np.sum(progress.episodes_wins[-show_every:])
+        logger.info(f"Wins in last {show_every} episodes = {batch_wins}")
+
+        profiler.write_summaries(self.trained_steps)
+
+    def finish_training(self, progress: TrainingProgress, save_model: Path, profiler: PhaseProfiler,
+                        q_values_writer: QValuesSnapshotWriter) -> np.array:
+        """
+        Save the agent and the training plot, and report the phases profile.
+        :return: The moving average of the episodes rewards
+        """
+        if q_values_writer is not None:
+            q_values_writer.close()
+
+        show_every = progress.show_every
+        moving_avg = np.convolve(progress.episodes_rewards, np.ones((show_every,)) / show_every, mode='valid')
+
+        if save_model is not None:
+            with profiler.phase("saving"):
+                self.save_agent(save_model)
+                self.plot_training_info(moving_avg, save_model)
 
+        profiler.close()
+        profiler.write_summaries(self.trained_steps)
+        profiler.log_report()
         if save_model is not None:
-            self.save_agent(save_model)
-            self.plot_training_info(moving_avg, save_model)
+            profiler.save_report(save_model)
+
+        return moving_avg
 
-    def training_step(self, discount):
+    def training_step(self, discount: float, beta: float=1.):
 
         # Start training only if certain number of samples is already saved
         if len(self.replay_memory) < self.min_replay_memory_size:
             return
 
-        # Get a minibatch of random samples from memory replay table
-        minibatch = random.sample(self.replay_memory, self.batch_size)
+        # Get a minibatch of random samples from memory replay table, with their n-step returns
+        minibatch = self.replay_memory.sample(self.batch_size, beta, discount)
+
+        # Targets, loss and optimizer update are all computed in a single graph call
+        loss, mean_q, td_errors = self.fused_training_step(minibatch.states,
+                                                           minibatch.actions.astype(np.int32),
+                                                           minibatch.rewards,
+                                                           minibatch.new_states,
+                                                           minibatch.dones,
+                                                           minibatch.weights,
+                                                           minibatch.discounts)
+        self.replay_memory.update_priorities(minibatch.indices, td_errors.numpy())
+        self.inference.invalidate()
+        self.trained_steps += 1
 
-        # Get current states from minibatch, then query NN model for Q values
-        current_states = np.array([transition[0] for transition in minibatch])
-        current_qs_list = self.model.predict(current_states)
+        return loss, mean_q
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+                                  tf.TensorSpec(shape=[None], dtype=tf.int32),
+                                  tf.TensorSpec(shape=[None], dtype=tf.float32),
+                                  tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+                                  tf.TensorSpec(shape=[None], dtype=tf.bool),
+                                  tf.TensorSpec(shape=[None], dtype=tf.float32),
+                                  tf.TensorSpec(shape=[None], dtype=tf.float32)])
+    def fused_training_step(self, states: tf.Tensor, actions: tf.Tensor, rewards: tf.Tensor,
+                            new_states: tf.Tensor, dones: tf.Tensor, weights: tf.Tensor,
+                            discounts: tf.Tensor):
+        logger.info("[Retrace] fused_training_step")
+
+        # Max future Q value of each transition, evaluated by the target model
+        target_future_qs = self.target_model(new_states)
+        if self.double_q_learning:
+            # When using double Q learning the NN selects the action and the target model evaluates it
+            max_future_actions = tf.argmax(self.model(new_states), axis=1, output_type=tf.int32)
+            max_future_qs = tf.gather(target_future_qs, max_future_actions, axis=1, batch_dims=1)
+        else:
+            max_future_qs = tf.reduce_max(target_future_qs, axis=1)
 
-        # Get future states from minibatch, then query target model for Q values
-        new_current_states = np.array([transition[3] for transition in minibatch])
-        target_future_qs_list = self.target_model.predict(new_current_states)
+        # If not a terminal state, get new q from future states, otherwise set it to reward.
+        # Each transition has its own discount, n-step returns can be cut short by the episode end
+        not_dones = 1. - tf.cast(dones, tf.float32)
+        new_qs = tf.stop_gradient(rewards + discounts * max_future_qs * not_dones)
 
-        # When using double Q learning we also need to query de NN for Q values
-        future_qs_list = []
-        if self.double_q_learning:
-            future_qs_list = self.model.predict(new_current_states)
-
-        # Fill the NN inputs
-        states_input = []
-        target_q_values = []
-
-        # Now we need to enumerate our batches
-        for index, (current_state, action, reward, new_current_state, done) in enumerate(minibatch):
-
-            # If not a terminal state, get new q from future states, otherwise set it to reward
-            if not done:
-                if self.double_q_learning:
-                    max_future_action = np.argmax(future_qs_list[index])
-                    new_q = reward + discount * target_future_qs_list[index][max_future_action]
-                else:
-                    max_future_q = np.max(target_future_qs_list[index])
-                    new_q = reward + discount * max_future_q
-            else:
-                new_q = reward
-
-            # Get target Q value for given state
-            # We only change the Q value of the taken action
-            current_qs = current_qs_list[index]
-            current_qs[action] = new_q
-
-            # And append to our training data
-            states_input.append(current_state)
-            target_q_values.append(current_qs)
-
-        # Fit on all samples as one batch, log only on terminal state
-        self.model.train_step(np.array(states_input), np.array(target_q_values))
-        self.trained_steps += 1
+        # We only fit the Q value of the taken action.
+        # The weights correct the bias introduced by prioritized replay (all ones otherwise)
+        with tf.GradientTape() as tape:
+            current_qs = self.model(states)
+            actions_qs = tf.gather(current_qs, actions, axis=1, batch_dims=1)
+            td_errors = new_qs - actions_qs
+            loss = tf.reduce_mean(weights * tf.square(td_errors))
+        gradients = tape.gradient(loss, self.model.trainable_variables)
+        self.model.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+
+        if self.target_update == "soft":
+            update_target_variables(self.target_model.variables, self.model.variables, self.tau)
+
+        mean_q = tf.reduce_mean(tf.reduce_max(current_qs, axis=1))
+
+        return loss, mean_q, td_errors
+
+    @tf.function
+    def update_target_model(self):
+        logger.info("[Retrace] update_target_model")
+        update_target_variables(self.target_model.variables, self.model.variables)
+
+    def tf_checkpoint(self) -> tf.train.Checkpoint:
+        """
+        :return: A checkpoint tracking the online and target models and the optimizer slots
+        """
+        return tf.train.Checkpoint(model=self.model, target_model=self.target_model,
+                                   optimizer=self.model.optimizer)
+
+    def save_checkpoint(self, checkpoint_dir: Path, training_state: dict, training_arrays: dict) -> float:
+        """
+        Save everything needed to resume training:
+         - The online and target models weights and the optimizer slots (Tensorflow checkpoint).
+         - The replay memory, as memory-mapped .npy files.
+         - The training loop state: counters and epsilon in a json file, the rewards and
+           wins histories and the environments states in a .npz file.
+        The checkpoint is written to a temporary folder that replaces the previous one when complete.
+        :param checkpoint_dir: Where to save the checkpoint
+        :param training_state: The scalar values of the training loop
+        :param training_arrays: The arrays of the training loop
+        :return: The time it took to write the checkpoint in seconds
+        """
+        start_time = time.time()
+        new_checkpoint_dir = checkpoint_dir.with_name(f"{checkpoint_dir.name}_new")
+        if new_checkpoint_dir.exists():
+            shutil.rmtree(new_checkpoint_dir)
+        new_checkpoint_dir.mkdir(parents=True)
+
+        self.tf_checkpoint().write(str(Path(new_checkpoint_dir, "weights", "weights")))
+        self.replay_memory.save(Path(new_checkpoint_dir, "replay_memory"))
+        np.savez(Path(new_checkpoint_dir, "training_arrays.npz"), **training_arrays)
+        with open(Path(new_checkpoint_dir, "training_state.json"), "w", encoding="utf8") as sfile:
+            json.dump(training_state, sfile, indent=4)
+
+        if checkpoint_dir.exists():
+            shutil.rmtree(checkpoint_dir)
+        new_checkpoint_dir.rename(checkpoint_dir)
+
+        checkpoint_time = time.time() - start_time
+        logger.info(f"Saved checkpoint of episode {training_state['episodes_counter']} "
+                    f"in {checkpoint_time} sec")
+        return checkpoint_time
+
+    def load_checkpoint(self, checkpoint_dir: Path) -> (dict, dict):
+        """
+        Restore a checkpoint saved with `save_checkpoint`. The agent must be created
+        with the same configurations used for the checkpointed training.
+        :param checkpoint_dir: The checkpoint folder
+        :return: The training loop state and arrays
+        """
+        if not checkpoint_dir.exists():
+            raise FileNotFoundError(f"There is no checkpoint in {checkpoint_dir}")
+
+        start_time = time.time()
+        self.tf_checkpoint().read(str(Path(checkpoint_dir, "weights", "weights"))).expect_partial()
+        self.inference.invalidate()
+        self.replay_memory.load(Path(checkpoint_dir, "replay_memory"))
+        with np.load(Path(checkpoint_dir, "training_arrays.npz")) as arrays:
+            training_arrays = dict(arrays)
+        with open(Path(checkpoint_dir, "training_state.json"), "r", encoding="utf8") as sfile:
+            training_state = json.load(sfile)
+
+        logger.info(f"Loaded checkpoint with {len(self.replay_memory)} transitions "
+                    f"in {time.time() - start_time} sec")
+        return training_state, training_arrays
 
     def save_agent(self, output_dir: Path):
         logger.info(f"Saving trained model to {output_dir}")
@@ -305,11 +771,13 @@ class MountainCarAgent(object):
 
     def load_model(self, model_dir: Path):
         self.model = tf.keras.models.load_model(model_dir)
+        self.inference.invalidate()
 
     def play_game(self, plot_game: bool=False):
         self.env.reset()
         starting_state = self.env.state
         done = False
+        episode_length = 0
         while not done:
             if plot_game:
                 self.env.render()
@@ -318,31 +786,21 @@ class MountainCarAgent(object):
             action = self.produce_action(state)
 
             new_state, reward, done, _ = self.env.step(action)
+            episode_length += 1
 
         win = self.env.state[0] >= self.env.goal_position
 
         self.env.reset()
 
-        return starting_state, win
+        return starting_state, win, episode_length
 
     def q_values_plot(self, save_fig: Path=None, show_plot: bool=False):
-        # TODO: Make this more efficient
-        sample_states = [(np.random.uniform(-1.2, 0.6), np.random.uniform(-0.07, 0.07)) for _ in range(1000)]
-        states_predictions = self.model.predict(sample_states)
+        states_predictions = self.batch_q_values(self.q_values_grid).numpy()
+        plot_points = q_values_plot_points(self.q_values_grid, states_predictions)
+
         fig = plt.figure()
-        ax = Axes3D(fig)
-        left_actions = {"xs": [], "ys": [], "zs": []}
-        null_actions = {"xs": [], "ys": [], "zs": []}
-        right_actions = {"xs": [], "ys": [], "zs": []}
-        plot_points = [left_actions, null_actions, right_actions]
-        for i in range(len(sample_states)):
-            action = np.argmax(states_predictions[i])
-            plot_points[action]["xs"].append(sample_states[i][0])
-            plot_points[action]["ys"].append(sample_states[i][1])
-            plot_points[action]["zs"].append(np.max(states_predictions[i][action]))
-
-        for i, (c, m) in enumerate([('r', 'o'), ('b', 'o'), ("g", "o")]):
-            ax.scatter(plot_points[i]["xs"], plot_points[i]["ys"], plot_points[i]["zs"], c=c, marker=m)
+        ax = fig.add_subplot(projection="3d")
+        scatter_q_values(ax, plot_points)
 
         if save_fig is not None:
             fig.savefig(save_fig)
@@ -353,10 +811,51 @@ class MountainCarAgent(object):
 
         return plot_points
 
-    def test_agent(self, episodes: int, plot_games: bool=False):
+    def play_games_batch(self, episodes: int) -> (np.array, np.array, np.array):
+        """
+        Play all the episodes at the same time with the greedy policy. Each timestep
+        uses one model call for the episodes still running, finished ones are dropped.
+        :param episodes: The number of episodes to play
+        :return: Wins, starting states and length of each episode
+        """
+        envs = MountainCarBatch(episodes)
+        starting_states = envs.initial_states(episodes)
+        wins = np.zeros(episodes, dtype=np.bool_)
+        episode_lengths = np.zeros(episodes, dtype=np.int32)
+
+        states = starting_states.copy()
+        running = np.arange(episodes)
+        while len(running):
+            actions = self.produce_actions(states)
+            states, goals = envs.dynamics(states, actions)
+            episode_lengths[running] += 1
+
+            finished = goals | (episode_lengths[running] >= envs.max_episode_steps)
+            wins[running[finished]] = goals[finished]
+            running = running[~finished]
+            states = states[~finished]
+
+        return wins, starting_states, episode_lengths
+
+    def test_agent(self, episodes: int, plot_games: bool=False) -> (list, np.array, np.array):
+        """
+        Play a number of episodes with the greedy policy.
+        :param episodes: The number of episodes to play
+        :param plot_games: Activate to render the games. They are played one at the time.
+        :return: A list with the result of each episode (True for wins),
+                 and the starting states and lengths of the episodes
+        """
+        if not plot_games:
+            wins, starting_states, episode_lengths = self.play_games_batch(episodes)
+            return wins.tolist(), starting_states, episode_lengths
+
         results = []
+        starting_states = []
+        episode_lengths = []
         for i in range(episodes):
-            _, win = self.play_game(plot_game=plot_games)
+            starting_state, win, episode_length = self.play_game(plot_game=plot_games)
             results.append(win)
+            starting_states.append(starting_state)
+            episode_lengths.append(episode_length)
 
-        return results
+        return results, np.array(starting_states), np.array(episode_lengths)
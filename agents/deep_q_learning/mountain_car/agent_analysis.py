@@ -4,54 +4,113 @@ import os
 import json
 from pathlib import Path
 
+import numpy as np
+import matplotlib.pyplot as plt
+
 SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
 sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
 
 from agents.deep_q_learning.mountain_car.agent import MountainCarAgent
-
-
-def moves_analysis(agent: MountainCarAgent):
-    x_moves = []
-    y_moves = []
-    x_min = 10
-    x_max = 0
-    y_min = 10
-    y_max = 0
-
-    wins = []
-    new_state = ()
-    for i in range(100):
-        agent.env.reset()
-        done = False
-        while not done:
-
-            state = agent.env.state
-            action = agent.produce_action(state)
-
-            new_state, reward, done, _ = agent.env.step(action)
-            x_move = abs(new_state[0] - state[0])
-            y_move = abs(new_state[1] - state[1])
-            x_moves.append(x_move)
-            y_moves.append(y_move)
-            x_min = min(x_min, x_move)
-            x_max = max(x_max, x_move)
-            y_min = min(y_min, y_move)
-            y_max = max(y_max, y_move)
-
-        wins.append(bool(new_state[0] >= agent.env.goal_position and new_state[1] >= agent.env.goal_velocity))
-
-    print(f"x_min {x_min}")
-    print(f"x_max {x_max}")
-    print(f"y_min {y_min}")
-    print(f"y_max {y_max}")
-    print(f"Wins = {sum(wins)}")
-    import matplotlib.pyplot as plt
-
-    fig, (ax1, ax2) = plt.subplots(1, 2)
-    ax1.hist(x_moves, 100)
-    ax2.hist(y_moves, 100)
-
-    plt.show()
+from agents.deep_q_learning.mountain_car.batch_env import MountainCarBatch
+
+
+class StreamingHistogram(object):
+    """
+    Histogram with fixed bins that is updated with batches of values, so any
+    number of values can be analysed in constant memory.
+    Values outside the bins range are counted apart, the min and max include them.
+    """
+
+    def __init__(self, low: float, high: float, bins: int=100):
+        """
+        :param low: The lower edge of the first bin
+        :param high: The upper edge of the last bin
+        :param bins: The number of bins
+        """
+        self.edges = np.linspace(low, high, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def total(self) -> int:
+        return int(self.counts.sum()) + self.underflow + self.overflow
+
+    def update(self, values: np.array):
+        if not len(values):
+            return
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.underflow += int(np.count_nonzero(values < self.edges[0]))
+        self.overflow += int(np.count_nonzero(values > self.edges[-1]))
+        self.counts += np.histogram(values, bins=self.edges)[0]
+
+    def to_dict(self, prefix: str) -> dict:
+        """
+        :return: The histogram arrays with their names starting with the prefix, to save them with np.savez
+        """
+        return {f"{prefix}_counts": self.counts, f"{prefix}_edges": self.edges,
+                f"{prefix}_underflow": self.underflow, f"{prefix}_overflow": self.overflow,
+                f"{prefix}_min": self.min, f"{prefix}_max": self.max}
+
+
+def moves_analysis(agent: MountainCarAgent, episodes: int=100, batch_episodes: int=10_000,
+                   bins: int=100) -> (StreamingHistogram, StreamingHistogram, int):
+    """
+    Play episodes with the greedy policy and accumulate the absolute position and velocity
+    changes of every step. The episodes are played in batches stepped together,
+    with one Q values call per step.
+    :param agent: The agent to analyse
+    :param episodes: The number of episodes to play
+    :param batch_episodes: The number of episodes played at the same time, it bounds the memory used
+    :param bins: The number of bins of the histograms
+    :return: The position and velocity moves histograms and the number of wins
+    """
+    envs = MountainCarBatch(min(episodes, batch_episodes))
+
+    # The position changes by the velocity, a velocity change is the push plus the gravity
+    # unless the car hits the left wall, those larger changes are counted as overflow
+    x_moves = StreamingHistogram(0., envs.max_speed, bins)
+    y_moves = StreamingHistogram(0., envs.force + envs.gravity, bins)
+    wins = 0
+
+    for start in range(0, episodes, batch_episodes):
+        count = min(batch_episodes, episodes - start)
+        states = envs.initial_states(count)
+        episode_steps = 0
+
+        # Finished episodes are dropped from the batch
+        while len(states):
+            actions = agent.produce_actions(states)
+            new_states, goals = envs.dynamics(states, actions)
+            episode_steps += 1
+
+            moves = np.abs(new_states - states)
+            x_moves.update(moves[:, 0])
+            y_moves.update(moves[:, 1])
+
+            wins += int(np.count_nonzero(goals))
+            states = new_states[~goals] if episode_steps < envs.max_episode_steps else new_states[:0]
+
+    return x_moves, y_moves, wins
+
+
+def plot_moves(x_moves: StreamingHistogram, y_moves: StreamingHistogram, save_fig: Path=None,
+               show_plot: bool=False):
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(10, 5))
+    for ax, histogram, title in ((ax1, x_moves, "Position moves"), (ax2, y_moves, "Velocity moves")):
+        ax.stairs(histogram.counts, histogram.edges, fill=True)
+        ax.set_title(title)
+        ax.set_xlabel("Absolute change")
+
+    if save_fig is not None:
+        fig.savefig(save_fig)
+
+    if show_plot:
+        plt.show()
+    plt.close(fig)
 
 
 def main():
@@ -60,6 +119,14 @@ def main():
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     required_named = parser.add_argument_group('REQUIRED named arguments')
     required_named.add_argument("--experiment_dir", type=str, required=True)
+    parser.add_argument("--episodes", type=int, default=100,
+                        help="The number of episodes played for the moves analysis.")
+    parser.add_argument("--batch_episodes", type=int, default=10_000,
+                        help="The number of episodes played at the same time.")
+    parser.add_argument("--bins", type=int, default=100,
+                        help="The number of bins of the moves histograms.")
+    parser.add_argument("--show_plot", action="store_true", default=False,
+                        help="Activate to show the plots, they are always saved in the experiment folder.")
     args = parser.parse_args()
 
     experiment_dir = Path(args.experiment_dir)
@@ -79,7 +146,18 @@ def main():
 
     agent.load_model(Path(experiment_dir, "model"))
 
-    agent.q_values_plot(show_plot=True)
+    agent.q_values_plot(save_fig=Path(experiment_dir, "q_values.png"), show_plot=args.show_plot)
+
+    x_moves, y_moves, wins = moves_analysis(agent, args.episodes, args.batch_episodes, args.bins)
+    print(f"x_min {x_moves.min}")
+    print(f"x_max {x_moves.max}")
+    print(f"y_min {y_moves.min}")
+    print(f"y_max {y_moves.max}")
+    print(f"Wins = {wins}/{args.episodes}")
+
+    np.savez(Path(experiment_dir, "moves_analysis.npz"), episodes=args.episodes, wins=wins,
+             **x_moves.to_dict("x_moves"), **y_moves.to_dict("y_moves"))
+    plot_moves(x_moves, y_moves, save_fig=Path(experiment_dir, "moves_analysis.png"), show_plot=args.show_plot)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+"""
+Vectorized version of the Gym MountainCar-v0 environment.
+Steps a batch of independent cars in lockstep with NumPy operations,
+using the physical constants of the Gym implementation.
+"""
+
+import gym
+import numpy as np
+
+
+class MountainCarBatch(object):
+    """
+    N MountainCar-v0 environments stepped in lockstep.
+    Finished environments are reset automatically after each step.
+    """
+
+    def __init__(self, batch_size: int):
+        """
+        Creates a batch of environments. Call reset before stepping them.
+        :param batch_size: The number of environments
+        """
+        env = gym.make("MountainCar-v0")
+        car = env.unwrapped
+
+        self.batch_size = batch_size
+        self.min_position = car.min_position
+        self.max_position = car.max_position
+        self.max_speed = car.max_speed
+        self.goal_position = car.goal_position
+        self.goal_velocity = getattr(car, "goal_velocity", 0)
+        self.force = car.force
+        self.gravity = car.gravity
+        self.max_episode_steps = env.spec.max_episode_steps
+        self.action_space = env.action_space.n
+        self.state_space = env.observation_space.shape[0]
+        env.close()
+
+        self.states = np.zeros((batch_size, self.state_space), dtype=np.float64)
+        self.episode_steps = np.zeros(batch_size, dtype=np.int32)
+
+    def initial_states(self, count: int) -> np.array:
+        """
+        :return: Random starting states (position in [-0.6, -0.4) with no velocity)
+        """
+        states = np.zeros((count, self.state_space), dtype=np.float64)
+        states[:, 0] = np.random.uniform(low=-0.6, high=-0.4, size=count)
+        return states
+
+    def reset(self, mask: np.array=None) -> np.array:
+        """
+        Reset the environments selected by the mask, or all of them.
+        :param mask: Boolean array with the environments to reset
+        :return: A copy of the current states of all environments
+        """
+        if mask is None:
+            mask = np.ones(self.batch_size, dtype=np.bool_)
+        self.states[mask] = self.initial_states(np.count_nonzero(mask))
+        self.episode_steps[mask] = 0
+        return self.states.copy()
+
+    def dynamics(self, states: np.array, actions: np.array) -> (np.array, np.array):
+        """
+        Apply the MountainCar physics to a batch of states.
+        :param states: Array of shape (n, 2) with positions and velocities
+        :param actions: Array of shape (n,) with the actions
+        :return: The new states and a boolean array that is True where the goal was reached
+        """
+        position = states[:, 0]
+        velocity = states[:, 1]
+
+        velocity = velocity + (actions - 1) * self.force + np.cos(3 * position) * (-self.gravity)
+        velocity = np.clip(velocity, -self.max_speed, self.max_speed)
+        position = np.clip(position + velocity, self.min_position, self.max_position)
+        velocity = np.where((position == self.min_position) & (velocity < 0), 0., velocity)
+
+        goals = (position >= self.goal_position) & (velocity >= self.goal_velocity)
+
+        return np.stack([position, velocity], axis=1), goals
+
+    def step(self, actions: np.array) -> (np.array, np.array, np.array, np.array):
+        """
+        Make a move in every environment. Environments that finish are reset, so
+        after this call `states` holds the starting states of their new episodes.
+        :param actions: Array of shape (batch_size,) with the action for each environment
+        :return: new_states (the terminal state for finished environments), rewards, dones and wins
+        """
+        new_states, wins = self.dynamics(self.states, actions)
+        self.episode_steps += 1
+        dones = wins | (self.episode_steps >= self.max_episode_steps)
+        rewards = -np.ones(self.batch_size, dtype=np.float32)
+
+        self.states = new_states.copy()
+        if np.any(dones):
+            self.reset(dones)
+
+        return new_states, rewards, dones, wins
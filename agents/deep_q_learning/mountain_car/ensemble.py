@@ -0,0 +1,376 @@
+"""
+Ensemble of independent MountainCar DQN agents trained together.
+The Q networks of all members are stacked in batched weight tensors, so a single
+forward/backward pass with batched matrix multiplications serves every member.
+Members only share the computation: each one has its own initialization, replay
+memory, exploration rate and target network.
+"""
+
+import time
+import logging
+from pathlib import Path
+
+import numpy as np
+import matplotlib.pyplot as plt
+import tensorflow as tf
+
+from agents.deep_q_learning.replay_memory import ReplayMemory, PrioritizedReplayMemory
+from agents.deep_q_learning.mountain_car.agent import DQNModel, MountainCarAgent
+from agents.deep_q_learning.mountain_car.batch_env import MountainCarBatch
+from agents.deep_q_learning.training_scheduler import TrainingScheduler
+from agents.deep_q_learning.target_network import check_target_update, update_target_variables
+
+
+logger = logging.getLogger()
+
+ACTIVATIONS = {"relu": tf.nn.relu, "tanh": tf.nn.tanh, "sigmoid": tf.nn.sigmoid, "linear": tf.identity}
+
+
+class StackedDQNModel(tf.Module):
+    """
+    K DQNModel networks with the weights of each layer stacked in one (K, inputs, outputs) tensor.
+    Inputs have shape (K, batch, state size) and outputs (K, batch, actions).
+    """
+
+    def __init__(self, seeds: list, state_size: int, layer_size: int, output_size: int,
+                 hidden_layers_count: int, activation: str="relu"):
+        """
+        :param seeds: The seed of each member, used for its weights initialization
+        See DQNModel for the other parameters.
+        """
+        super(StackedDQNModel, self).__init__()
+        self.members = len(seeds)
+        self.activation = activation
+
+        # Same initialization as the Keras Dense layers: glorot uniform kernels and zero biases
+        sizes = [state_size] + [layer_size] * hidden_layers_count + [output_size]
+        generators = [np.random.RandomState(seed) for seed in seeds]
+        self.kernels = []
+        self.biases = []
+        for inputs, outputs in zip(sizes[:-1], sizes[1:]):
+            limit = np.sqrt(6. / (inputs + outputs))
+            kernels = np.stack([generator.uniform(-limit, limit, (inputs, outputs)) for generator in generators])
+            self.kernels.append(tf.Variable(kernels.astype(np.float32)))
+            self.biases.append(tf.Variable(np.zeros((self.members, 1, outputs), dtype=np.float32)))
+
+    def __call__(self, states: tf.Tensor) -> tf.Tensor:
+        x = states
+        for i, (kernel, bias) in enumerate(zip(self.kernels, self.biases)):
+            x = tf.matmul(x, kernel) + bias
+            if i < len(self.kernels) - 1:
+                x = ACTIVATIONS[self.activation](x)
+        return x
+
+    def member_weights(self, member: int) -> list:
+        """
+        :return: The weights of a member in the order of DQNModel.get_weights
+        """
+        weights = []
+        for kernel, bias in zip(self.kernels, self.biases):
+            weights += [kernel[member].numpy(), bias[member, 0].numpy()]
+        return weights
+
+
+class MountainCarEnsemble(object):
+    """
+    Trains one MountainCar DQN agent per seed in lockstep. Every member steps its own
+    environments, and the training steps sample one minibatch from each member's replay memory.
+    """
+
+    def __init__(self, seeds: list, replay_memory_size: int, layer_size: int,
+                 min_replay_memory_size: int, learning_rate: float,
+                 batch_size: int, update_target_every: int,
+                 double_q_learning: bool=False, prioritized_replay: bool=False,
+                 hidden_layers_count: int=3, activation: str="relu", priority_alpha: float=0.6,
+                 environments_count: int=1, train_every: int=1, gradient_steps: int=1,
+                 warmup_steps: int=0, target_update: str="hard", tau: float=0.005, n_steps: int=1):
+        """
+        :param seeds: The seed of each member
+        See MountainCarAgent for the other parameters, they apply to every member.
+        """
+        check_target_update(target_update, tau)
+
+        self.seeds = list(seeds)
+        self.members = len(self.seeds)
+        self.environments_count = environments_count
+        self.envs = MountainCarBatch(self.members * environments_count)
+        self.action_space = self.envs.action_space
+        self.state_space = self.envs.state_space
+        self.layer_size = layer_size
+        self.learning_rate = learning_rate
+        self.hidden_layers_count = hidden_layers_count
+        self.activation = activation
+
+        self.model = StackedDQNModel(self.seeds, self.state_space, layer_size, self.action_space,
+                                     hidden_layers_count, activation)
+        self.target_model = StackedDQNModel(self.seeds, self.state_space, layer_size, self.action_space,
+                                            hidden_layers_count, activation)
+        # Adam works element-wise, one optimizer for the stacked weights trains each member independently
+        self.optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+        logger.info(f"Ensemble of {self.members} members with "
+                    f"{sum(int(np.prod(v.shape)) for v in self.model.trainable_variables) // self.members} "
+                    f"parameters each")
+
+        self.replay_memories = []
+        for _ in self.seeds:
+            if prioritized_replay:
+                memory = PrioritizedReplayMemory(max_size=replay_memory_size, state_shape=(self.state_space,),
+                                                 alpha=priority_alpha, n_steps=n_steps, streams=environments_count)
+            else:
+                memory = ReplayMemory(max_size=replay_memory_size, state_shape=(self.state_space,),
+                                      n_steps=n_steps, streams=environments_count)
+            self.replay_memories.append(memory)
+
+        self.generators = [np.random.RandomState(seed) for seed in self.seeds]
+        self.min_replay_memory_size = min_replay_memory_size
+        self.batch_size = batch_size
+        self.update_target_every = update_target_every
+        self.target_update = target_update
+        self.tau = tau
+        self.double_q_learning = double_q_learning
+        self.target_update_counters = np.zeros(self.members, dtype=np.int64)
+        self.trained_steps = 0
+        self.scheduler = TrainingScheduler(train_every=train_every,
+                                           gradient_steps=gradient_steps,
+                                           warmup_steps=warmup_steps)
+        self.update_target_members(np.ones(self.members, dtype=np.bool_))
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None, None, None], dtype=tf.float32)])
+    def stacked_q_values(self, states: tf.Tensor):
+        logger.info("[Retrace] stacked_q_values")
+        return self.model(states)
+
+    def produce_actions(self, states: np.array) -> np.array:
+        """
+        Greedy actions of every member for its own states, using a single model call.
+        :param states: Array of shape (members, n, state size)
+        :return: Array of shape (members, n)
+        """
+        q_values = self.stacked_q_values(states.astype(np.float32))
+        return np.argmax(q_values, axis=2)
+
+    def train_agent(self, episodes: int=25000, epsilon: float=1, show_every: int=None,
+                    discount: float=0.95, priority_beta: float=0.4) -> list:
+        """
+        Train all members until each one played `episodes` episodes. Members that reach
+        that number keep collecting and training with the others, but their new episodes
+        are not recorded.
+        :return: The rewards of the episodes of each member
+        """
+        members_episodes = np.zeros(self.members, dtype=np.int64)
+        members_epsilons = np.full(self.members, float(epsilon))
+        episodes_rewards = [[] for _ in self.seeds]
+        episodes_wins = [[] for _ in self.seeds]
+        epsilon_min = 0.01
+        epsilon_decay_value = 0.01
+        last_losses, last_mean_qs = None, None
+        self.trained_steps = 0
+        if show_every is None:
+            show_every = episodes
+        next_show = show_every
+
+        logger.info("#### Starting training ####")
+        logger.info(f"Collecting experience from {self.environments_count} environments per member in lockstep")
+        self.scheduler.reset()
+        self.envs.reset()
+        running_rewards = np.zeros((self.members, self.environments_count))
+        start_time = time.time()
+        environment_steps = 0
+        block_start_trained_steps = 0
+        while np.min(members_episodes) < episodes:
+            states = self.envs.states.reshape(self.members, self.environments_count, self.state_space)
+
+            # Select actions for all environments with the exploration rate of each member
+            actions = self.produce_actions(states)
+            exploration = np.maximum(epsilon_min, members_epsilons)
+            for member, generator in enumerate(self.generators):
+                explore = generator.random_sample(self.environments_count) <= exploration[member]
+                actions[member, explore] = generator.randint(0, self.action_space, np.count_nonzero(explore))
+            new_states, rewards, dones, wins = self.envs.step(actions.reshape(-1))
+            environment_steps += self.envs.batch_size
+
+            new_states = new_states.reshape(self.members, self.environments_count, self.state_space)
+            rewards = rewards.reshape(self.members, self.environments_count)
+            dones = dones.reshape(self.members, self.environments_count)
+            wins = wins.reshape(self.members, self.environments_count)
+            for member, memory in enumerate(self.replay_memories):
+                memory.append_batch(states[member], actions[member], rewards[member],
+                                    new_states[member], dones[member])
+
+            beta = priority_beta + (1. - priority_beta) * np.mean(members_episodes) / episodes
+            for _ in range(self.scheduler.step(self.environments_count)):
+                training_results = self.training_step(discount, beta)
+                if training_results is None:
+                    break
+                last_losses, last_mean_qs = training_results
+
+            running_rewards += rewards
+            for member, env_index in zip(*np.nonzero(dones)):
+                if members_episodes[member] < episodes:
+                    episodes_rewards[member].append(running_rewards[member, env_index])
+                    episodes_wins[member].append(bool(wins[member, env_index]))
+                running_rewards[member, env_index] = 0
+                members_episodes[member] += 1
+                members_epsilons[member] -= epsilon_decay_value
+                self.target_update_counters[member] += 1
+
+            if np.min(members_episodes) >= next_show:
+                batch_time = time.time() - start_time
+                recent_rewards = [np.mean(rewards[-show_every:]) for rewards in episodes_rewards]
+                recent_wins = [int(np.sum(wins[-show_every:])) for wins in episodes_wins]
+                logger.info("====================================================")
+                logger.info(f"Showing episode N° {next_show} of all members")
+                logger.info(f"Executed training steps = {self.trained_steps}")
+                logger.info(f"Batch time = {batch_time} sec")
+                logger.info(f"Environment steps per second = {environment_steps / batch_time}")
+                logger.info(f"Gradient steps per second = "
+                            f"{(self.trained_steps - block_start_trained_steps) * self.members / batch_time} "
+                            f"({self.members} members)")
+                logger.info(f"Epsilon is {np.maximum(epsilon_min, members_epsilons).tolist()}")
+                if last_losses is not None:
+                    logger.info(f"Last training step loss = {np.mean(last_losses)} - "
+                                f"mean Q value = {np.mean(last_mean_qs)}")
+                logger.info(f"Last {show_every} episodes reward mean: {np.mean(recent_rewards)} "
+                            f"(members: {np.round(recent_rewards, 2).tolist()})")
+                logger.info(f"Wins in last {show_every} episodes = {recent_wins}")
+
+                next_show += show_every
+                environment_steps = 0
+                block_start_trained_steps = self.trained_steps
+                start_time = time.time()
+
+            # Members whose counter reached the set value copy their weights to their target network
+            if self.target_update == "hard":
+                update_members = self.target_update_counters >= self.update_target_every
+                if np.any(update_members):
+                    self.update_target_members(update_members)
+                    self.target_update_counters[update_members] = 0
+
+        return episodes_rewards
+
+    def training_step(self, discount: float, beta: float=1.):
+
+        # All members have the same number of transitions
+        if len(self.replay_memories[0]) < self.min_replay_memory_size:
+            return
+
+        # Stack a minibatch of each member's memory
+        minibatches = [memory.sample(self.batch_size, beta, discount) for memory in self.replay_memories]
+        losses, mean_qs, td_errors = self.fused_training_step(
+            np.stack([minibatch.states for minibatch in minibatches]),
+            np.stack([minibatch.actions for minibatch in minibatches]).astype(np.int32),
+            np.stack([minibatch.rewards for minibatch in minibatches]),
+            np.stack([minibatch.new_states for minibatch in minibatches]),
+            np.stack([minibatch.dones for minibatch in minibatches]),
+            np.stack([minibatch.weights for minibatch in minibatches]),
+            np.stack([minibatch.discounts for minibatch in minibatches]))
+
+        td_errors = td_errors.numpy()
+        for member, (memory, minibatch) in enumerate(zip(self.replay_memories, minibatches)):
+            memory.update_priorities(minibatch.indices, td_errors[member])
+        self.trained_steps += 1
+
+        return losses.numpy(), mean_qs.numpy()
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None, None, None], dtype=tf.float32),
+                                  tf.TensorSpec(shape=[None, None], dtype=tf.int32),
+                                  tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+                                  tf.TensorSpec(shape=[None, None, None], dtype=tf.float32),
+                                  tf.TensorSpec(shape=[None, None], dtype=tf.bool),
+                                  tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+                                  tf.TensorSpec(shape=[None, None], dtype=tf.float32)])
+    def fused_training_step(self, states: tf.Tensor, actions: tf.Tensor, rewards: tf.Tensor,
+                            new_states: tf.Tensor, dones: tf.Tensor, weights: tf.Tensor,
+                            discounts: tf.Tensor):
+        logger.info("[Retrace] fused_training_step")
+
+        # Same targets as MountainCarAgent.fused_training_step, with a leading members dimension
+        target_future_qs = self.target_model(new_states)
+        if self.double_q_learning:
+            max_future_actions = tf.argmax(self.model(new_states), axis=2, output_type=tf.int32)
+            max_future_qs = tf.gather(target_future_qs, max_future_actions, axis=2, batch_dims=2)
+        else:
+            max_future_qs = tf.reduce_max(target_future_qs, axis=2)
+
+        not_dones = 1. - tf.cast(dones, tf.float32)
+        new_qs = tf.stop_gradient(rewards + discounts * max_future_qs * not_dones)
+
+        # Members don't share weights, so the gradients of the summed losses are the gradients of each member
+        with tf.GradientTape() as tape:
+            current_qs = self.model(states)
+            actions_qs = tf.gather(current_qs, actions, axis=2, batch_dims=2)
+            td_errors = new_qs - actions_qs
+            losses = tf.reduce_mean(weights * tf.square(td_errors), axis=1)
+            loss = tf.reduce_sum(losses)
+        gradients = tape.gradient(loss, self.model.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+
+        if self.target_update == "soft":
+            update_target_variables(self.target_model.variables, self.model.variables, self.tau)
+
+        mean_qs = tf.reduce_mean(tf.reduce_max(current_qs, axis=2), axis=1)
+
+        return losses, mean_qs, td_errors
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None], dtype=tf.bool)])
+    def update_target_members(self, members_mask: tf.Tensor):
+        logger.info("[Retrace] update_target_members")
+        mask = tf.reshape(members_mask, [-1, 1, 1])
+        for target_variable, variable in zip(self.target_model.variables, self.model.variables):
+            target_variable.assign(tf.where(mask, variable, target_variable))
+
+    def member_model(self, member: int) -> DQNModel:
+        """
+        :return: A DQNModel with the weights of a member, to save it or use it with MountainCarAgent
+        """
+        model = DQNModel(layer_size=self.layer_size, output_size=self.action_space,
+                         learning_rate=self.learning_rate, hidden_layers_count=self.hidden_layers_count,
+                         activation=self.activation)
+        # Calling the model defines its input shape, which Keras needs to save it
+        model(np.zeros((1, self.state_space), dtype=np.float32))
+        model.set_weights(self.model.member_weights(member))
+        return model
+
+    def save_members(self, output_dir: Path, episodes_rewards: list, show_every: int) -> list:
+        """
+        Save each member like MountainCarAgent.train_agent does, in a folder named after its seed.
+        :return: The folder and the reward moving average of each member
+        """
+        members_results = []
+        for member, seed in enumerate(self.seeds):
+            member_dir = Path(output_dir, f"seed_{seed}")
+            member_dir.mkdir(exist_ok=True)
+            moving_avg = np.convolve(episodes_rewards[member], np.ones((show_every,)) / show_every, mode='valid')
+
+            logger.info(f"Saving trained model to {member_dir}")
+            self.member_model(member).save(Path(member_dir, "model"))
+            np.save(Path(member_dir, "episodes_rewards.npy"), np.array(episodes_rewards[member]))
+            MountainCarAgent.plot_training_info(moving_avg, member_dir)
+            plt.close()
+            members_results.append((member_dir, moving_avg))
+
+        return members_results
+
+    def test_agent(self, episodes: int) -> (np.array, np.array):
+        """
+        Play a number of episodes with the greedy policy of every member, all at the same time.
+        :param episodes: The number of episodes to play for each member
+        :return: Wins and lengths of the episodes, arrays of shape (members, episodes)
+        """
+        envs = MountainCarBatch(self.members * episodes)
+        states = envs.initial_states(self.members * episodes)
+        wins = np.zeros(self.members * episodes, dtype=np.bool_)
+        episode_lengths = np.zeros(self.members * episodes, dtype=np.int32)
+        running = np.ones(self.members * episodes, dtype=np.bool_)
+
+        # Finished episodes are kept in the batch so the members dimension stays intact
+        while np.any(running):
+            actions = self.produce_actions(states.reshape(self.members, episodes, self.state_space)).reshape(-1)
+            new_states, goals = envs.dynamics(states, actions)
+            states = np.where(running[:, np.newaxis], new_states, states)
+            episode_lengths[running] += 1
+
+            wins |= running & goals
+            running &= ~goals & (episode_lengths < envs.max_episode_steps)
+
+        return wins.reshape(self.members, episodes), episode_lengths.reshape(self.members, episodes)
@@ -0,0 +1,118 @@
+"""
+Snapshots of the Q values predicted by a MountainCar agent during training.
+The Q values are evaluated on a fixed grid of states and handed to a background
+thread that writes them to disk (and optionally renders them), so the training
+loop never waits for file writing or plotting.
+"""
+
+import logging
+import queue
+import threading
+from pathlib import Path
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from mpl_toolkits.mplot3d import Axes3D  # Registers the 3d projection
+
+
+logger = logging.getLogger()
+
+ACTIONS_COLORS = ["r", "b", "g"]  # left, null, right
+
+
+def evaluation_grid(min_position: float, max_position: float, max_speed: float,
+                    points_per_axis: int=50) -> np.array:
+    """
+    Creates a regular grid over the MountainCar state space.
+    :return: Array of shape (points_per_axis ** 2, 2) with positions and velocities (float32)
+    """
+    positions = np.linspace(min_position, max_position, points_per_axis)
+    velocities = np.linspace(-max_speed, max_speed, points_per_axis)
+    grid = np.stack(np.meshgrid(positions, velocities, indexing="ij"), axis=-1).reshape(-1, 2)
+    return grid.astype(np.float32)
+
+
+def q_values_plot_points(states: np.array, q_values: np.array) -> list:
+    """
+    Group the states by their best action.
+    :param states: Array of shape (n, 2) with the evaluated states
+    :param q_values: Array of shape (n, actions) with the Q values of each state
+    :return: A list with a dict for each action, with the position (xs), velocity (ys)
+             and best Q value (zs) of the states where that action is the best one
+    """
+    best_actions = np.argmax(q_values, axis=1)
+    best_qs = np.max(q_values, axis=1)
+    plot_points = []
+    for action in range(q_values.shape[1]):
+        mask = best_actions == action
+        plot_points.append({"xs": states[mask, 0], "ys": states[mask, 1], "zs": best_qs[mask]})
+    return plot_points
+
+
+def scatter_q_values(ax, plot_points: list):
+    """
+    Draw the points returned by q_values_plot_points on a 3D axis.
+    """
+    for i, points in enumerate(plot_points):
+        ax.scatter(points["xs"], points["ys"], points["zs"], c=ACTIONS_COLORS[i % len(ACTIONS_COLORS)], marker="o")
+
+
+class QValuesSnapshotWriter(threading.Thread):
+    """
+    Background thread that saves Q values snapshots.
+    Each snapshot is written as a .npy file with the Q values for every state of the grid,
+    which is saved once in states.npy. PNG rendering is optional.
+    """
+
+    def __init__(self, output_dir: Path, states: np.array, render: bool=False, max_pending: int=16):
+        """
+        Creates the writer and the output folder. Call start() to launch the thread.
+        :param output_dir: Where to save the snapshots
+        :param states: The evaluation grid used for all snapshots
+        :param render: Activate to also save a 3D plot of each snapshot
+        :param max_pending: How many snapshots can wait to be written before submit blocks
+        """
+        threading.Thread.__init__(self, name="QValuesSnapshotWriter", daemon=True)
+        self.output_dir = output_dir
+        self.states = states
+        self.render = render
+        self.pending = queue.Queue(maxsize=max_pending)
+
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+        np.save(Path(self.output_dir, "states.npy"), self.states)
+
+    def submit(self, step: int, q_values: np.array):
+        """
+        Queue a snapshot to be written.
+        :param step: The training step of the snapshot, used in the file names
+        :param q_values: Array of shape (grid size, actions)
+        """
+        self.pending.put((step, q_values))
+
+    def close(self):
+        """Write all pending snapshots and stop the thread."""
+        self.pending.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            snapshot = self.pending.get()
+            if snapshot is None:
+                break
+
+            step, q_values = snapshot
+            try:
+                np.save(Path(self.output_dir, f"q_values_{step}.npy"), q_values.astype(np.float32))
+                if self.render:
+                    self.render_snapshot(Path(self.output_dir, f"q_values_{step}.png"), q_values)
+            except Exception as e:
+                logger.warning(f"Could not write Q values snapshot {step}: {e}")
+
+    def render_snapshot(self, save_fig: Path, q_values: np.array):
+        # Not using pyplot, its global state is not thread safe
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(projection="3d")
+        scatter_q_values(ax, q_values_plot_points(self.states, q_values))
+        fig.savefig(save_fig)
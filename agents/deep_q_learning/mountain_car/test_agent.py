@@ -40,12 +40,11 @@ def main():
 
     agent.load_model(Path(experiment_dir, "model"))
 
-    results = []
-    for i in range(args.episodes):
-        starting_state, win = agent.play_game(plot_game=args.render_games)
-        results.append(win)
+    results, starting_states, episode_lengths = agent.test_agent(episodes=args.episodes,
+                                                                 plot_games=args.render_games)
 
-        print(f"Episode = {i} - Starting State = {starting_state} - Victory = {win}")
+    for i, (starting_state, win, episode_length) in enumerate(zip(starting_states, results, episode_lengths)):
+        print(f"Episode = {i} - Starting State = {starting_state} - Victory = {win} - Length = {episode_length}")
 
     print(f"Agent performance = {sum(results) * 100 / len(results)} % of Wins")
 
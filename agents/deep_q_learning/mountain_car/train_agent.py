@@ -11,7 +11,8 @@ SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
 sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
 
 from code_utils.logger_utils import prepare_stream_logger, prepare_file_logger
-from agents.deep_q_learning.mountain_car.agent import MountainCarAgent, AgentConfig
+from code_utils.results_utils import save_results
+from agents.deep_q_learning.mountain_car.agent import MountainCarAgent, AgentConfig, CHECKPOINT_DIR
 
 
 logger = logging.getLogger()
@@ -38,33 +39,53 @@ def main():
                         help="Activate to run Tensorflow in eager mode.")
     parser.add_argument("--replace", action="store_true", default=False,
                         help="Activate to replace old experiment in the output folder.")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Activate to resume the experiment from its last checkpoint. "
+                             "The configurations saved in the experiment folder are used.")
+    parser.add_argument("--intra_op_threads", type=int, default=None,
+                        help="Threads used by Tensorflow inside an operation. "
+                             "If not set Tensorflow picks the value.")
+    parser.add_argument("--inter_op_threads", type=int, default=None,
+                        help="Threads used by Tensorflow to run independent operations. "
+                             "If not set Tensorflow picks the value.")
     args = parser.parse_args()
 
     # On debug mode all functions are executed normally (eager mode)
     if args.debug:
         tf.config.run_functions_eagerly(True)
 
-    config_file = Path(args.config_file)
-    config = AgentConfig(args.name, config_file)
+    # Limit threads so parallel experiments don't oversubscribe the cores
+    if args.intra_op_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    if args.inter_op_threads is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
 
     # Create experiment folder and handle old results
     output_dir = Path(args.output_dir)
     game_experiments_dir = Path(output_dir, "mountain_car")
     game_experiments_dir.mkdir(exist_ok=True, parents=True)
-    agent_folder = Path(game_experiments_dir, config.name)
-    if agent_folder.exists():
-        if args.replace:
-            shutil.rmtree(agent_folder)
-        else:
-            raise FileExistsError(f"The experiment {agent_folder} already exists."
-                                  f"Change output folder, experiment name or use -replace "
-                                  f"to overwrite.")
-    agent_folder.mkdir()
+    agent_folder = Path(game_experiments_dir, args.name)
+    if args.resume:
+        if not Path(agent_folder, CHECKPOINT_DIR).exists():
+            raise FileNotFoundError(f"The experiment {agent_folder} has no checkpoint to resume from.")
+        config_file = Path(agent_folder, "configurations.json")
+    else:
+        config_file = Path(args.config_file)
+        if agent_folder.exists():
+            if args.replace:
+                shutil.rmtree(agent_folder)
+            else:
+                raise FileExistsError(f"The experiment {agent_folder} already exists."
+                                      f"Change output folder, experiment name or use -replace "
+                                      f"to overwrite.")
+        agent_folder.mkdir()
+    config = AgentConfig(args.name, config_file)
 
     # Save experiments configurations and start experiment log
     prepare_file_logger(logger, logging.INFO, Path(agent_folder, "experiment.log"))
     config.log_configurations(logger)
-    config.copy_config(agent_folder)
+    if not args.resume:
+        config.copy_config(agent_folder)
 
     show_every = int(config.episodes * 0.1) if config.show_every is None else config.show_every
 
@@ -77,19 +98,58 @@ def main():
                              learning_rate=config.learning_rate,
                              double_q_learning=config.double_q_learning,
                              activation=config.activation,
-                             hidden_layers_count=config.hidden_layers_count)
-    agent.train_agent(episodes=config.episodes,
-                      epsilon=config.epsilon,
-                      plot_game=config.plot_game,
-                      show_every=show_every,
-                      save_model=agent_folder,
-                      discount=config.discount,
-                      cycles=config.cycles,
-                      save_q_values_every=config.save_q_values_every)
-
-    results = agent.test_agent(episodes=1000)
-
-    logger.info(f"Agent performance = {sum(results) * 100 / len(results)} % of Wins")
+                             hidden_layers_count=config.hidden_layers_count,
+                             prioritized_replay=config.prioritized_replay,
+                             priority_alpha=config.priority_alpha,
+                             environments_count=config.environments_count,
+                             train_every=config.train_every,
+                             gradient_steps=config.gradient_steps,
+                             warmup_steps=config.warmup_steps,
+                             target_update=config.target_update,
+                             tau=config.tau,
+                             n_steps=config.n_steps)
+    if config.actors_count > 0:
+        # Collection in separate actor processes, this process is the learner
+        moving_avg = agent.train_agent_actors(episodes=config.episodes,
+                                              epsilon=config.epsilon,
+                                              show_every=show_every,
+                                              save_model=agent_folder,
+                                              discount=config.discount,
+                                              priority_beta=config.priority_beta,
+                                              actors_count=config.actors_count,
+                                              actor_chunk_steps=config.actor_chunk_steps,
+                                              broadcast_every=config.broadcast_every,
+                                              save_q_values_every=config.save_q_values_every,
+                                              render_q_values=config.render_q_values,
+                                              checkpoint_every=config.checkpoint_every,
+                                              resume=args.resume,
+                                              profile_phases=config.profile_phases,
+                                              profile_steps=config.profile_steps)
+    else:
+        moving_avg = agent.train_agent(episodes=config.episodes,
+                                       epsilon=config.epsilon,
+                                       plot_game=config.plot_game,
+                                       show_every=show_every,
+                                       save_model=agent_folder,
+                                       discount=config.discount,
+                                       cycles=config.cycles,
+                                       save_q_values_every=config.save_q_values_every,
+                                       priority_beta=config.priority_beta,
+                                       render_q_values=config.render_q_values,
+                                       checkpoint_every=config.checkpoint_every,
+                                       resume=args.resume,
+                                       profile_phases=config.profile_phases,
+                                       profile_steps=config.profile_steps)
+
+    results, _, episode_lengths = agent.test_agent(episodes=1000)
+
+    win_rate = sum(results) * 100 / len(results)
+    logger.info(f"Agent performance = {win_rate} % of Wins")
+    logger.info(f"Mean episode length = {episode_lengths.mean()} steps")
+
+    # The moving average is empty when training was shorter than show_every
+    reward_moving_average = moving_avg[-1] if len(moving_avg) else None
+    save_results(agent_folder, win_rate=win_rate, reward_moving_average=reward_moving_average)
 
 
 if __name__ == '__main__':
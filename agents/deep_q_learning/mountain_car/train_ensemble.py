@@ -0,0 +1,135 @@
+import argparse
+import logging
+import sys
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+
+SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
+sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
+
+from code_utils.logger_utils import prepare_stream_logger, prepare_file_logger
+from code_utils.results_utils import save_results
+from agents.deep_q_learning.mountain_car.agent import AgentConfig
+from agents.deep_q_learning.mountain_car.ensemble import MountainCarEnsemble
+
+
+logger = logging.getLogger()
+prepare_stream_logger(logger, logging.INFO)
+logging.getLogger("tensorflow").setLevel(logging.ERROR)
+
+
+EXPERIMENTS_DIR = Path(Path.home(), "rl_experiments", "deep_q_learning")
+CONFIG_FILE = Path(SCRIPT_DIR.parent, "configurations", "default.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train an ensemble of DQN agents with different seeds "
+                                                 "on the MountainCar environment, as one stacked model.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    required_named = parser.add_argument_group('REQUIRED named arguments')
+    required_named.add_argument("--name", type=str, required=True,
+                                help="The name of this experiment. The experiments files "
+                                     "get saved under this name, each member in a seed_<seed> folder.")
+    parser.add_argument("--config_file", type=str, default=CONFIG_FILE,
+                        help="Configuration file for the experiment, used by all members.")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2, 3],
+                        help="The seed of each member of the ensemble.")
+    parser.add_argument("--output_dir", type=str, default=EXPERIMENTS_DIR,
+                        help="Where to save the experiments files")
+    parser.add_argument("--debug", action="store_true", default=False,
+                        help="Activate to run Tensorflow in eager mode.")
+    parser.add_argument("--replace", action="store_true", default=False,
+                        help="Activate to replace old experiment in the output folder.")
+    parser.add_argument("--intra_op_threads", type=int, default=None,
+                        help="Threads used by Tensorflow inside an operation. "
+                             "If not set Tensorflow picks the value.")
+    parser.add_argument("--inter_op_threads", type=int, default=None,
+                        help="Threads used by Tensorflow to run independent operations. "
+                             "If not set Tensorflow picks the value.")
+    args = parser.parse_args()
+
+    # On debug mode all functions are executed normally (eager mode)
+    if args.debug:
+        tf.config.run_functions_eagerly(True)
+
+    if args.intra_op_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    if args.inter_op_threads is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+
+    if len(set(args.seeds)) != len(args.seeds):
+        raise ValueError(f"The seeds of the members must be different, got {args.seeds}.")
+
+    # Create experiment folder and handle old results
+    output_dir = Path(args.output_dir)
+    game_experiments_dir = Path(output_dir, "mountain_car")
+    game_experiments_dir.mkdir(exist_ok=True, parents=True)
+    agent_folder = Path(game_experiments_dir, args.name)
+    if agent_folder.exists():
+        if args.replace:
+            shutil.rmtree(agent_folder)
+        else:
+            raise FileExistsError(f"The experiment {agent_folder} already exists."
+                                  f"Change output folder, experiment name or use -replace "
+                                  f"to overwrite.")
+    agent_folder.mkdir()
+    config = AgentConfig(args.name, args.config_file)
+
+    # Save experiments configurations and start experiment log
+    prepare_file_logger(logger, logging.INFO, Path(agent_folder, "experiment.log"))
+    config.log_configurations(logger)
+    config.copy_config(agent_folder)
+    logger.info(f"Ensemble seeds: {args.seeds}")
+
+    show_every = int(config.episodes * 0.1) if config.show_every is None else config.show_every
+
+    # Global seed for the environments, each member seeds its own weights and exploration
+    np.random.seed(args.seeds[0])
+
+    # Create and train the ensemble
+    ensemble = MountainCarEnsemble(seeds=args.seeds,
+                                   min_replay_memory_size=config.min_replay_memory_size,
+                                   update_target_every=config.update_target_every,
+                                   replay_memory_size=config.replay_memory_size,
+                                   batch_size=config.batch_size,
+                                   layer_size=config.hidden_layer_size,
+                                   learning_rate=config.learning_rate,
+                                   double_q_learning=config.double_q_learning,
+                                   activation=config.activation,
+                                   hidden_layers_count=config.hidden_layers_count,
+                                   prioritized_replay=config.prioritized_replay,
+                                   priority_alpha=config.priority_alpha,
+                                   environments_count=config.environments_count,
+                                   train_every=config.train_every,
+                                   gradient_steps=config.gradient_steps,
+                                   warmup_steps=config.warmup_steps,
+                                   target_update=config.target_update,
+                                   tau=config.tau,
+                                   n_steps=config.n_steps)
+    episodes_rewards = ensemble.train_agent(episodes=config.episodes,
+                                            epsilon=config.epsilon,
+                                            show_every=show_every,
+                                            discount=config.discount,
+                                            priority_beta=config.priority_beta)
+
+    # Each member folder can be used like a train_agent.py experiment
+    members_results = ensemble.save_members(agent_folder, episodes_rewards, show_every)
+    wins, episode_lengths = ensemble.test_agent(episodes=1000)
+    for member, (member_dir, moving_avg) in enumerate(members_results):
+        config.copy_config(member_dir)
+        win_rate = np.mean(wins[member]) * 100
+        logger.info(f"Member {member_dir.name} performance = {win_rate} % of Wins - "
+                    f"Mean episode length = {episode_lengths[member].mean()} steps")
+        # The moving average is empty when training was shorter than show_every
+        reward_moving_average = moving_avg[-1] if len(moving_avg) else None
+        save_results(member_dir, win_rate=win_rate, reward_moving_average=reward_moving_average)
+
+    logger.info(f"Ensemble performance = {np.mean(wins) * 100} % of Wins")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,22 @@
 import time
 import logging
-import random
 from pathlib import Path
-from collections import deque
 
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import style
-from tensorflow.keras.models import Sequential, load_model
+import tensorflow as tf
+from tensorflow.keras import Model
+from tensorflow.keras.models import load_model
 from tensorflow.keras.layers import Dense
-from tensorflow.keras.optimizers import Adam
 from tqdm import tqdm
 
 from ..move_to_goal import MoveToGoal
+from code_utils.inference_utils import DenseInferenceEngine
+from agents.deep_q_learning.replay_memory import ReplayMemory
+from agents.deep_q_learning.move_to_goal.q_table_cache import QTableCache
+from agents.deep_q_learning.training_scheduler import TrainingScheduler
+from agents.deep_q_learning.target_network import check_target_update, update_target_variables
 
 
 logger = logging.getLogger()
@@ -20,11 +24,50 @@ logger = logging.getLogger()
 style.use("ggplot")
 
 
+def dqn_model_constructor(input_dim: int):
+
+    class MoveToGoalDQNModel(Model):
+        """
+        Feed forward Q network with two hidden layers.
+        The input shape is fixed by the environment state space, so the compiled
+        functions are traced only once.
+        """
+
+        def __init__(self, layer_size: int, output_size: int, learning_rate: float):
+            super(MoveToGoalDQNModel, self).__init__()
+            self.layer_size = layer_size
+            self.output_size = output_size
+            self.learning_rate = learning_rate
+
+            self.input_layer = Dense(layer_size, activation="relu")
+            self.hidden_layer = Dense(layer_size, activation="relu")
+            self.output_layer = Dense(output_size, activation=None)
+            self.optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+
+        def get_config(self):
+            return {"layer_size": self.layer_size,
+                    "output_size": self.output_size,
+                    "learning_rate": self.learning_rate}
+
+        @tf.function(input_signature=[tf.TensorSpec(shape=[None, input_dim], dtype=tf.float32)])
+        def call(self, inputs: tf.Tensor):
+            logger.info("[Retrace] call")
+            x = self.input_layer(inputs)
+            x = self.hidden_layer(x)
+            return self.output_layer(x)
+
+    return MoveToGoalDQNModel
+
+
 class MoveToGoalDQNAgent(object):
 
     def __init__(self, game: MoveToGoal, learning_rate: float=0.001, replay_memory_size: int=50_000,
                  min_replay_memory_size: int=1000, batch_size: int=64, update_target_every: int=5,
-                 hidden_layer_size: int=64):
+                 hidden_layer_size: int=64, train_every: int=1, gradient_steps: int=1,
+                 warmup_steps: int=0, target_update: str="hard", tau: float=0.005, n_steps: int=1,
+                 q_table_cache: bool=False, q_table_refresh_every: int=100):
+
+        check_target_update(target_update, tau)
 
         self.game = game
         self.learning_rate = learning_rate
@@ -33,26 +76,46 @@ class MoveToGoalDQNAgent(object):
         self.batch_size = batch_size
         self.update_target_every = update_target_every
         self.hidden_layer_size = hidden_layer_size
+        self.target_update = target_update
+        self.tau = tau
 
         self.board_size = self.game.get_board_size()
         self.model = self.create_model(hidden_layer_size, summary=True)
 
-        # Target network
-        self.target_model = self.create_model(hidden_layer_size, learning_rate)
+        # Target network, soft updates of it are done by the compiled train step
+        self.target_model = self.create_model(hidden_layer_size)
         self.target_model.set_weights(self.model.get_weights())
 
-        # An array with last n steps for training
-        self.replay_memory = deque(maxlen=self.replay_memory_size)
+        # NumPy copy of the model to act on single states, invalidated when the weights change
+        self.inference = DenseInferenceEngine("relu", weights_source=lambda: self.model.get_weights())
+
+        # Small boards can cache the Q values of all their states. Actions and targets become
+        # table lookups, the online table is evaluated again every q_table_refresh_every training
+        # steps and the target table after each target update (with the online table for soft updates)
+        self.q_table = None
+        self.q_table_refresh_every = q_table_refresh_every
+        if q_table_cache:
+            self.q_table = QTableCache(self.board_size, self.game.get_fixed_positions())
+            self.q_table.refresh_online(self.model)
+            self.q_table.refresh_target(self.target_model)
+
+        # An array with last n steps for training, it also computes the n-step returns
+        self.replay_memory = ReplayMemory(max_size=self.replay_memory_size,
+                                          state_shape=(self.game.state_space,),
+                                          n_steps=n_steps)
         self.target_update_counter = 0
+        self.trained_steps = 0
 
-    def create_model(self, hidden_layer_size: int=64, learning_rate: float=0.001, summary: bool=False):
-        model = Sequential()
-        input_shape = (self.game.state_space,)
-        model.add(Dense(hidden_layer_size, activation="relu", input_shape=input_shape))
-        model.add(Dense(hidden_layer_size, activation="relu"))
+        # Ratio between environment steps and gradient steps
+        self.scheduler = TrainingScheduler(train_every=train_every,
+                                           gradient_steps=gradient_steps,
+                                           warmup_steps=warmup_steps)
 
-        model.add(Dense(self.game.action_space, activation='linear'))
-        model.compile(loss="mse", optimizer=Adam(lr=learning_rate))
+    def create_model(self, hidden_layer_size: int=64, summary: bool=False):
+        model_constructor = dqn_model_constructor(self.game.state_space)
+        model = model_constructor(layer_size=hidden_layer_size, output_size=self.game.action_space,
+                                  learning_rate=self.learning_rate)
+        model.build((None, self.game.state_space))
 
         if summary:
             model.summary(print_fn=lambda x: logger.info(x))
@@ -60,17 +123,17 @@ class MoveToGoalDQNAgent(object):
         return model
 
     def produce_action(self, state: tuple):
-        q_values = self.get_q_values(state)
-        action = np.argmax(q_values)
-        return action
+        if self.q_table is not None:
+            return int(np.argmax(self.q_table.online[self.q_table.encode(state)[0]]))
+        return self.inference.greedy_action(state)
 
     def get_q_values(self, state: tuple):
-        return self.model.predict(np.array([state]))
+        return self.model(np.array([state], dtype=np.float32)).numpy()
 
     # Adds step's data to a memory replay array
     # (observation space, action, reward, new observation space, done)
     def update_replay_memory(self, transition):
-        self.replay_memory.append(transition)
+        self.replay_memory.append(*transition)
 
     def train_agent(self, episodes: int=10_000, epsilon: float=1, plot_game: bool=False,
                     show_every: int=None, discount: float=0.95, cycles: int=4, save_model: Path=None):
@@ -82,7 +145,12 @@ class MoveToGoalDQNAgent(object):
         episode_rewards = []
 
         logger.info("Starting training...")
+        logger.info(f"Gradient steps per environment step = {self.scheduler.update_to_data_ratio} "
+                    f"after {self.scheduler.warmup_steps} warm-up steps")
+        self.scheduler.reset()
         start_time = time.time()
+        environment_steps = 0
+        block_start_trained_steps = self.trained_steps
         start_epsilon = epsilon
         for cycle in range(cycles):
             epsilon = start_epsilon
@@ -97,8 +165,14 @@ class MoveToGoalDQNAgent(object):
                     logger.info(f"Last {show_every} episodes reward mean: {np.mean(episode_rewards[-show_every:])}")
                     batch_wins = np.sum(episodes_wins[-show_every:])
                     logger.info(f"Wins in last {show_every} episodes = {batch_wins}")
-                    logger.info(f"Batch time = {time.time() - start_time} sec")
+                    batch_time = time.time() - start_time
+                    logger.info(f"Batch time = {batch_time} sec")
+                    logger.info(f"Environment steps per second = {environment_steps / batch_time}")
+                    logger.info(f"Gradient steps per second = "
+                                f"{(self.trained_steps - block_start_trained_steps) / batch_time}")
                     show = True
+                    environment_steps = 0
+                    block_start_trained_steps = self.trained_steps
                     start_time = time.time()
                 else:
                     show = False
@@ -121,18 +195,26 @@ class MoveToGoalDQNAgent(object):
 
                     new_state, reward, done = self.game.step(player_action=action)
                     episode_reward += reward
+                    environment_steps += 1
 
                     # Every step we update replay memory and train main network
+                    # as many times as the scheduler says
                     self.update_replay_memory((board_state, action, reward, new_state, done))
-                    self.training_step(discount)
+                    for _ in range(self.scheduler.step()):
+                        # With soft updates the target network changed with the training step
+                        if self.training_step(discount) and self.target_update == "soft" and \
+                                self.q_table is not None and not self.trained_steps % self.q_table_refresh_every:
+                            self.q_table.refresh_target(self.target_model)
 
                     if done:
                         episodes_wins.append(reward == self.game.goal_reward)
                         self.target_update_counter += 1
 
                     # If counter reaches set value, update target network with weights of main network
-                    if self.target_update_counter > self.update_target_every:
-                        self.target_model.set_weights(self.model.get_weights())
+                    if self.target_update == "hard" and self.target_update_counter > self.update_target_every:
+                        self.update_target_model()
+                        if self.q_table is not None:
+                            self.q_table.refresh_target(self.target_model)
                         self.target_update_counter = 0
 
                     episode_reward += reward
@@ -155,45 +237,49 @@ class MoveToGoalDQNAgent(object):
         if len(self.replay_memory) < self.min_replay_memory_size:
             return
 
-        # Get a minibatch of random samples from memory replay table
-        minibatch = random.sample(self.replay_memory, self.batch_size)
+        # Get a minibatch of random samples from memory replay table, with their n-step returns
+        minibatch = self.replay_memory.sample(self.batch_size, discount=discount)
+
+        # Q values of the states to bootstrap from, looked up in the cached table or given by the target network
+        if self.q_table is not None:
+            future_qs = self.q_table.target[self.q_table.encode(minibatch.new_states)]
+        else:
+            future_qs = self.target_model(minibatch.new_states).numpy()
 
-        # Get current states from minibatch, then query NN model for Q values
-        current_states = np.array([transition[0] for transition in minibatch])
-        current_qs_list = self.model.predict(current_states)
+        # If not a terminal state, get new q from future states, otherwise set it to the rewards
+        new_qs = minibatch.rewards + minibatch.discounts * np.max(future_qs, axis=1) * ~minibatch.dones
 
-        # Get future states from minibatch, then query NN model for Q values
-        # When using target network, query it, otherwise main network should be queried
-        new_current_states = np.array([transition[3] for transition in minibatch])
-        future_qs_list = self.target_model.predict(new_current_states)
+        # A single compiled step fits the Q values of the taken actions
+        self.train_step(minibatch.states, minibatch.actions.astype(np.int32), new_qs.astype(np.float32))
+        self.inference.invalidate()
+        self.trained_steps += 1
+        if self.q_table is not None and not self.trained_steps % self.q_table_refresh_every:
+            self.q_table.refresh_online(self.model)
 
-        # Fill the NN inputs
-        states_input = []
-        target_q_values = []
+        return True
 
-        # Now we need to enumerate our batches
-        for index, (current_state, action, reward, new_current_state, done) in enumerate(minibatch):
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+                                  tf.TensorSpec(shape=[None], dtype=tf.int32),
+                                  tf.TensorSpec(shape=[None], dtype=tf.float32)])
+    def train_step(self, states: tf.Tensor, actions: tf.Tensor, targets: tf.Tensor):
+        logger.info("[Retrace] train_step")
 
-            # If not a terminal state, get new q from future states, otherwise set it to 0
-            # almost like with Q Learning, but we use just part of equation here
-            if not done:
-                max_future_q = np.max(future_qs_list[index])
-                new_q = reward + discount * max_future_q
-            else:
-                new_q = reward
+        # Only the Q value of the taken action is fitted
+        with tf.GradientTape() as tape:
+            current_qs = self.model(states)
+            actions_qs = tf.gather(current_qs, actions, axis=1, batch_dims=1)
+            loss = tf.reduce_mean(tf.square(targets - actions_qs))
+        gradients = tape.gradient(loss, self.model.trainable_variables)
+        self.model.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
 
-            # Get target Q value for given state
-            # We only change the Q value of the taken action
-            current_qs = current_qs_list[index]
-            current_qs[action] = new_q
+        if self.target_update == "soft":
+            update_target_variables(self.target_model.variables, self.model.variables, self.tau)
 
-            # And append to our training data
-            states_input.append(current_state)
-            target_q_values.append(current_qs)
+        return loss
 
-        # Fit on all samples as one batch, log only on terminal state
-        self.model.fit(np.array(states_input), np.array(target_q_values),
-                       batch_size=self.batch_size, verbose=0, shuffle=False)
+    @tf.function
+    def update_target_model(self):
+        update_target_variables(self.target_model.variables, self.model.variables)
 
     @staticmethod
     def plot_training_info(moving_avg: np.array, agent_folder: Path=None):
@@ -214,6 +300,9 @@ class MoveToGoalDQNAgent(object):
 
     def load_agent(self, model_dir: Path):
         self.model = load_model(model_dir)
+        self.inference.invalidate()
+        if self.q_table is not None:
+            self.q_table.refresh_online(self.model)
 
     def play_game(self, plot_game: bool=False):
         self.game.prepare_game()
@@ -44,6 +44,14 @@ class AgentConfig(BaseConfig):
         self.batch_size = self.config_dict["batch_size"]
         self.update_target_every = self.config_dict["update_target_every"]
         self.hidden_layer_size = self.config_dict["hidden_layer_size"]
+        self.train_every = self.config_dict["train_every"]
+        self.gradient_steps = self.config_dict["gradient_steps"]
+        self.warmup_steps = self.config_dict["warmup_steps"]
+        self.target_update = self.config_dict["target_update"]
+        self.tau = self.config_dict["tau"]
+        self.n_steps = self.config_dict["n_steps"]
+        self.q_table_cache = self.config_dict["q_table_cache"]
+        self.q_table_refresh_every = self.config_dict["q_table_refresh_every"]
         self.enemy_reward = self.config_dict["enemy_reward"]
         self.enemy_initial_pos = self.config_dict["enemy_initial_pos"]
 
@@ -94,7 +102,15 @@ def main():
                                     min_replay_memory_size=experiment_config.min_replay_memory_size,
                                     batch_size=experiment_config.batch_size,
                                     update_target_every=experiment_config.update_target_every,
-                                    hidden_layer_size=experiment_config.hidden_layer_size)
+                                    hidden_layer_size=experiment_config.hidden_layer_size,
+                                    train_every=experiment_config.train_every,
+                                    gradient_steps=experiment_config.gradient_steps,
+                                    warmup_steps=experiment_config.warmup_steps,
+                                    target_update=experiment_config.target_update,
+                                    tau=experiment_config.tau,
+                                    n_steps=experiment_config.n_steps,
+                                    q_table_cache=experiment_config.q_table_cache,
+                                    q_table_refresh_every=experiment_config.q_table_refresh_every)
     test_agent.train_agent(episodes=experiment_config.episodes,
                            epsilon=experiment_config.epsilon,
                            plot_game=False,
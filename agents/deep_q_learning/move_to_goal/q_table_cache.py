@@ -0,0 +1,81 @@
+"""
+Q values of every state of a MoveToGoal board, stored in dense tables.
+MoveToGoal states are the board positions (x, y) of a few game objects, so the
+whole state space can be enumerated and evaluated by a model in a single batch.
+Once the tables are filled, Q values are array lookups instead of model calls.
+"""
+
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger()
+
+
+class QTableCache(object):
+    """
+    Q tables of the online and target networks, indexed by encoded state.
+    Only the objects that move are enumerated, objects with a fixed position always
+    keep it. The cells of the moving objects (x_i * board_y + y_i) are encoded as a
+    number in base board_x * board_y, and a row index maps each code to its table row.
+    The player, first object of the state, only shares a cell with another object in
+    terminal states, which are never bootstrapped from, so those states have no row
+    of their own and are all mapped to row 0.
+    """
+
+    def __init__(self, board_size: tuple, fixed_positions: tuple):
+        """
+        :param board_size: The board width and height
+        :param fixed_positions: For each object in the state, its fixed position or None if it moves
+        """
+        self.board_x, self.board_y = board_size
+        self.cells = self.board_x * self.board_y
+        self.positions_count = len(fixed_positions)
+        self.moving = [index for index, position in enumerate(fixed_positions) if position is None]
+        codes_count = self.cells ** len(self.moving)
+
+        # Cells of every object for all codes, in order of their encoding
+        codes = np.arange(codes_count)
+        cells = np.zeros((codes_count, self.positions_count), dtype=np.int64)
+        for index, position in enumerate(fixed_positions):
+            if position is not None:
+                cells[:, index] = position[0] * self.board_y + position[1]
+        for digit, index in enumerate(self.moving):
+            cells[:, index] = codes // self.cells ** (len(self.moving) - 1 - digit) % self.cells
+
+        # Only states where the player is on its own cell get a row
+        distinct = np.all(cells[:, 1:] != cells[:, :1], axis=1)
+        self.rows = np.zeros(codes_count, dtype=np.int64)
+        self.rows[distinct] = np.arange(np.count_nonzero(distinct))
+
+        cells = cells[distinct]
+        self.states_count = len(cells)
+        self.states = np.zeros((self.states_count, 2 * self.positions_count), dtype=np.float32)
+        self.states[:, 0::2] = cells // self.board_y
+        self.states[:, 1::2] = cells % self.board_y
+
+        self.online = None
+        self.target = None
+        logger.info(f"Q table cache of {self.states_count} states")
+
+    def encode(self, states: np.array) -> np.array:
+        """
+        :param states: Array of shape (n, state size), or a single state
+        :return: The indices of the states in the tables
+        """
+        positions = np.rint(np.reshape(states, (-1, self.positions_count, 2))).astype(np.int64)
+        cells = positions[:, :, 0] * self.board_y + positions[:, :, 1]
+        codes = np.zeros(len(cells), dtype=np.int64)
+        for index in self.moving:
+            codes = codes * self.cells + cells[:, index]
+        return self.rows[codes]
+
+    def evaluate(self, model) -> np.array:
+        return np.asarray(model(self.states), dtype=np.float32)
+
+    def refresh_online(self, model):
+        self.online = self.evaluate(model)
+
+    def refresh_target(self, model):
+        self.target = self.evaluate(model)
@@ -0,0 +1,425 @@
+"""
+Replay memories used by the Deep Q Learning agents.
+Transitions are stored in preallocated NumPy column arrays so sampling
+a minibatch is a single fancy-indexing operation per column. N-step returns
+are computed on the sampled minibatch with the same vectorized indexing.
+"""
+
+import json
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+
+ReplayBatch = namedtuple("ReplayBatch", ["states", "actions", "rewards", "new_states", "dones",
+                                         "discounts", "indices", "weights"])
+
+COLUMNS = ("states", "actions", "rewards", "new_states", "dones", "cuts")
+MEMORY_STATE_FILE = "memory_state.json"
+
+# Below this many stored transitions per sampled one, minibatches are drawn without
+# replacement. Above it repeated transitions are rare (less than one every 200 samples)
+# and sampling with replacement avoids a permutation of the whole memory.
+WITHOUT_REPLACEMENT_RATIO = 100
+
+
+def save_column(file: Path, array: np.array):
+    """
+    Write an array to a .npy file that can be memory-mapped when loading.
+    The raw data is streamed to the file, nothing is pickled.
+    """
+    np.save(file, array, allow_pickle=False)
+
+
+class ReplayMemory(object):
+    """
+    Fixed size ring buffer of (state, action, reward, new_state, done) transitions.
+    Once full, the oldest transitions are overwritten.
+    Transitions from `streams` environments stepped in lockstep are stored interleaved,
+    so the next transition of the same episode is always `streams` positions ahead,
+    unless the transition is marked as a cut (the stream continues elsewhere).
+    """
+
+    def __init__(self, max_size: int, state_shape: tuple, state_dtype=np.float32,
+                 action_dtype=np.int8, n_steps: int=1, streams: int=1):
+        """
+        Creates an empty replay memory with all its columns allocated.
+        :param max_size: The max number of stored transitions
+        :param state_shape: The shape of a single environment state
+        :param state_dtype: The data type used to store states and new states
+        :param action_dtype: The data type used to store actions
+        :param n_steps: The number of rewards accumulated in the sampled returns (1 is one-step Q learning)
+        :param streams: The number of environments whose transitions are appended together each step
+        """
+        if n_steps < 1 or streams < 1:
+            raise ValueError(f"Invalid replay memory configuration: n_steps={n_steps}, streams={streams}")
+
+        self.max_size = max_size
+        self.state_shape = tuple(state_shape)
+        self.n_steps = n_steps
+        self.streams = streams
+
+        self.states = np.zeros((max_size,) + self.state_shape, dtype=state_dtype)
+        self.actions = np.zeros(max_size, dtype=action_dtype)
+        self.rewards = np.zeros(max_size, dtype=np.float32)
+        self.new_states = np.zeros((max_size,) + self.state_shape, dtype=state_dtype)
+        self.dones = np.zeros(max_size, dtype=np.bool_)
+        self.cuts = np.zeros(max_size, dtype=np.bool_)
+
+        self.cursor = 0
+        self.size = 0
+
+    def __len__(self) -> int:
+        """
+        :return: The number of stored transitions
+        """
+        return self.size
+
+    @property
+    def nbytes(self) -> int:
+        """
+        :return: The memory used by the stored columns in bytes
+        """
+        return sum(column.nbytes for column in self.columns())
+
+    def columns(self) -> tuple:
+        """
+        :return: All the storage arrays of the memory
+        """
+        return self.states, self.actions, self.rewards, self.new_states, self.dones, self.cuts
+
+    def append(self, state, action: int, reward: float, new_state, done: bool) -> int:
+        """
+        Stores a single transition in the position of the write cursor.
+        :return: The index where the transition was stored
+        """
+        i = self.cursor
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.new_states[i] = new_state
+        self.dones[i] = done
+        self.cuts[i] = False
+
+        self.cursor = (i + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+
+        return i
+
+    def append_batch(self, states: np.array, actions: np.array, rewards: np.array,
+                     new_states: np.array, dones: np.array, cuts: np.array=None) -> np.array:
+        """
+        Stores a batch of transitions, wrapping around the end of the buffer if needed.
+        All arguments must have the same length in their first dimension.
+        :param cuts: Marks the transitions whose episode doesn't continue `streams` positions
+                     ahead, so n-step returns stop there without ending the episode.
+                     None if all episodes continue in the next appended transitions.
+        :return: The indices where the transitions were stored
+        """
+        count = len(actions)
+        if cuts is None:
+            cuts = np.zeros(count, dtype=np.bool_)
+        if count > self.max_size:
+            # Only the newest transitions would survive
+            states, actions, rewards = states[-self.max_size:], actions[-self.max_size:], rewards[-self.max_size:]
+            new_states, dones, cuts = new_states[-self.max_size:], dones[-self.max_size:], cuts[-self.max_size:]
+            count = self.max_size
+
+        indices = (self.cursor + np.arange(count)) % self.max_size
+        self.states[indices] = states
+        self.actions[indices] = actions
+        self.rewards[indices] = rewards
+        self.new_states[indices] = new_states
+        self.dones[indices] = dones
+        self.cuts[indices] = cuts
+
+        self.cursor = (self.cursor + count) % self.max_size
+        self.size = min(self.size + count, self.max_size)
+
+        return indices
+
+    def sample_indices(self, batch_size: int) -> np.array:
+        """
+        :param batch_size: The number of indices to sample
+        :return: Uniformly sampled indices of stored transitions. They are distinct while the
+                 memory holds less than WITHOUT_REPLACEMENT_RATIO times batch_size transitions
+        """
+        if batch_size <= self.size < WITHOUT_REPLACEMENT_RATIO * batch_size:
+            return np.random.choice(self.size, size=batch_size, replace=False)
+        return np.random.randint(0, self.size, size=batch_size)
+
+    def sample(self, batch_size: int, beta: float=None, discount: float=1.) -> ReplayBatch:
+        """
+        Sample a minibatch of stored transitions.
+        :param batch_size: The number of transitions to sample
+        :param beta: Not used, uniform sampling needs no importance sampling correction
+        :param discount: The discount factor of the returns
+        :return: A ReplayBatch with one array per column, the sampled indices and unit weights
+        """
+        indices = self.sample_indices(batch_size)
+        return self.gather(indices, np.ones(batch_size, dtype=np.float32), discount)
+
+    def gather(self, indices: np.array, weights: np.array, discount: float=1.) -> ReplayBatch:
+        """
+        :param indices: The transitions to gather
+        :param weights: The importance sampling weights of the transitions
+        :param discount: The discount factor of the returns
+        :return: A ReplayBatch with the transitions stored in the given indices. With n-step returns,
+                 rewards hold the discounted sum of the rewards, new_states the state to bootstrap from
+                 and discounts the factor of its Q value (discount ** steps actually accumulated)
+        """
+        if self.n_steps == 1:
+            return ReplayBatch(states=self.states[indices],
+                               actions=self.actions[indices],
+                               rewards=self.rewards[indices],
+                               new_states=self.new_states[indices],
+                               dones=self.dones[indices],
+                               discounts=np.full(len(indices), discount, dtype=np.float32),
+                               indices=indices,
+                               weights=weights)
+
+        rewards, bootstrap_indices, dones, discounts = self.n_step_returns(indices, discount)
+        return ReplayBatch(states=self.states[indices],
+                           actions=self.actions[indices],
+                           rewards=rewards,
+                           new_states=self.new_states[bootstrap_indices],
+                           dones=dones,
+                           discounts=discounts,
+                           indices=indices,
+                           weights=weights)
+
+    def n_step_returns(self, indices: np.array, discount: float) -> (np.array, np.array, np.array, np.array):
+        """
+        Compute the n-step returns of a batch of transitions with a (batch, n_steps) index matrix.
+        The accumulation stops at the end of the episode, at cuts and at the newest stored
+        transition of each stream, so the returns are never mixed between episodes.
+        :param indices: The transitions indices
+        :param discount: The discount factor of the returns
+        :return: The discounted sums of rewards, the indices of the transitions whose new state
+                 is used to bootstrap, if the episode ended within the steps, and the bootstrap discounts
+        """
+        offsets = np.arange(self.n_steps) * self.streams
+        steps_indices = (indices[:, np.newaxis] + offsets) % self.max_size
+
+        # Steps are available if they were already stored after the sampled transition
+        stored_after = (self.cursor - 1 - indices) % self.max_size
+        available = offsets <= stored_after[:, np.newaxis]
+        dones = self.dones[steps_indices] & available
+        # Steps after the end of the episode belong to the next one, after a cut to other streams
+        stops = dones | self.cuts[steps_indices]
+        stopped_before = (np.cumsum(stops, axis=1) - stops) > 0
+        used = available & ~stopped_before
+
+        steps = np.count_nonzero(used, axis=1)
+        discount_powers = discount ** np.arange(self.n_steps)
+        rewards = np.sum(self.rewards[steps_indices] * used * discount_powers, axis=1)
+        bootstrap_indices = steps_indices[np.arange(len(indices)), steps - 1]
+
+        return (rewards.astype(np.float32), bootstrap_indices, np.any(dones & used, axis=1),
+                (discount ** steps).astype(np.float32))
+
+    def update_priorities(self, indices: np.array, td_errors: np.array):
+        """Uniform replay memories have no priorities, nothing to update."""
+        pass
+
+    def memory_state(self) -> dict:
+        """
+        :return: The scalar state of the memory, saved with the columns
+        """
+        return {"max_size": self.max_size, "cursor": self.cursor, "size": self.size}
+
+    def save(self, directory: Path):
+        """
+        Save the stored transitions as one .npy file per column (memory-mapped on load),
+        plus a json file with the write cursor.
+        :param directory: Where to save the files, created if it doesn't exist
+        """
+        directory.mkdir(exist_ok=True, parents=True)
+        for name in COLUMNS:
+            save_column(Path(directory, f"{name}.npy"), getattr(self, name)[:self.size])
+        with open(Path(directory, MEMORY_STATE_FILE), "w", encoding="utf8") as sfile:
+            json.dump(self.memory_state(), sfile, indent=4)
+
+    def load(self, directory: Path) -> dict:
+        """
+        Restore the transitions saved with `save`. The files are memory-mapped and
+        copied into the preallocated columns.
+        :param directory: The folder passed to `save`
+        :return: The saved memory state
+        :raises ValueError if the memory was saved with a different max size
+        """
+        with open(Path(directory, MEMORY_STATE_FILE), "r", encoding="utf8") as sfile:
+            memory_state = json.load(sfile)
+        if memory_state["max_size"] != self.max_size:
+            raise ValueError(f"The saved replay memory has max size {memory_state['max_size']}, "
+                             f"this one has {self.max_size}")
+
+        for name in COLUMNS:
+            stored = np.load(Path(directory, f"{name}.npy"), mmap_mode="r")
+            getattr(self, name)[:len(stored)] = stored
+            del stored
+        self.cursor = memory_state["cursor"]
+        self.size = memory_state["size"]
+
+        return memory_state
+
+
+class SumTree(object):
+    """
+    Binary tree where each parent holds the sum of its children, stored in a flat array.
+    The root is at index 1 and the leaves start at index `capacity`, so the children
+    of node i are 2i and 2i + 1. Used for O(log n) proportional sampling.
+    """
+
+    def __init__(self, size: int):
+        """
+        Creates a tree with all its leaves set to zero.
+        :param size: The number of leaves that can be used
+        """
+        self.size = size
+        self.capacity = 1
+        while self.capacity < size:
+            self.capacity *= 2
+        self.depth = int(np.log2(self.capacity))
+        self.nodes = np.zeros(2 * self.capacity, dtype=np.float64)
+
+    @property
+    def total(self) -> float:
+        """
+        :return: The sum of all the leaves
+        """
+        return self.nodes[1]
+
+    def rebuild(self):
+        """Recompute all the parent nodes from the leaves, one level at a time."""
+        level_start = self.capacity // 2
+        while level_start >= 1:
+            children = self.nodes[2 * level_start:4 * level_start]
+            self.nodes[level_start:2 * level_start] = children[0::2] + children[1::2]
+            level_start //= 2
+
+    def get(self, indices: np.array) -> np.array:
+        """
+        :return: The values of the given leaves
+        """
+        return self.nodes[indices + self.capacity]
+
+    def update(self, indices: np.array, values: np.array):
+        """
+        Set the value of a batch of leaves and recompute their ancestors level by level.
+        :param indices: The leaves indices
+        :param values: The new leaves values
+        """
+        nodes = np.asarray(indices) + self.capacity
+        self.nodes[nodes] = values
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+
+    def find(self, values: np.array) -> np.array:
+        """
+        Descend the tree for a batch of values in [0, total).
+        :return: For each value, the index of the leaf where the cumulative sum of the leaves reaches it
+        """
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_values = self.nodes[left]
+            go_right = values > left_values
+            values = np.where(go_right, values - left_values, values)
+            nodes = np.where(go_right, left + 1, left)
+        return np.minimum(nodes - self.capacity, self.size - 1)
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """
+    Replay memory that samples transitions proportionally to their priority
+    (Schaul et al. 2015, https://arxiv.org/abs/1511.05952).
+    Priorities are kept in a SumTree. New transitions get the max priority seen so far.
+    """
+
+    def __init__(self, max_size: int, state_shape: tuple, alpha: float=0.6,
+                 priority_epsilon: float=1e-6, state_dtype=np.float32, action_dtype=np.int8,
+                 n_steps: int=1, streams: int=1):
+        """
+        Creates an empty prioritized replay memory.
+        :param alpha: How much prioritization is used (0 is uniform sampling)
+        :param priority_epsilon: Added to the TD errors so no transition has zero priority
+        See base class for the other parameters.
+        """
+        ReplayMemory.__init__(self, max_size, state_shape, state_dtype, action_dtype, n_steps, streams)
+        self.alpha = alpha
+        self.priority_epsilon = priority_epsilon
+        self.tree = SumTree(max_size)
+        self.max_priority = 1.
+
+    def append(self, state, action: int, reward: float, new_state, done: bool) -> int:
+        """See base class."""
+        i = ReplayMemory.append(self, state, action, reward, new_state, done)
+        self.tree.update(np.array([i]), np.array([self.max_priority]))
+        return i
+
+    def append_batch(self, states: np.array, actions: np.array, rewards: np.array,
+                     new_states: np.array, dones: np.array, cuts: np.array=None) -> np.array:
+        """See base class."""
+        indices = ReplayMemory.append_batch(self, states, actions, rewards, new_states, dones, cuts)
+        self.tree.update(indices, np.full(len(indices), self.max_priority))
+        return indices
+
+    def sample_indices(self, batch_size: int) -> np.array:
+        """
+        Stratified proportional sampling: the total priority is split in batch_size
+        segments and one value is drawn uniformly from each of them.
+        :return: The sampled transitions indices
+        """
+        segment = self.tree.total / batch_size
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * segment
+        return self.tree.find(values)
+
+    def sample(self, batch_size: int, beta: float=0.4, discount: float=1.) -> ReplayBatch:
+        """
+        Sample a minibatch of stored transitions proportionally to their priorities.
+        :param batch_size: The number of transitions to sample
+        :param beta: Importance sampling correction exponent (1 is full correction)
+        :param discount: The discount factor of the returns
+        :return: A ReplayBatch with one array per column, the sampled indices and
+                 the importance sampling weights (normalized by their max)
+        """
+        indices = self.sample_indices(batch_size)
+        probabilities = self.tree.get(indices) / self.tree.total
+        weights = (self.size * probabilities) ** -beta
+        weights = (weights / np.max(weights)).astype(np.float32)
+        return self.gather(indices, weights, discount)
+
+    def update_priorities(self, indices: np.array, td_errors: np.array):
+        """
+        Set the priorities of sampled transitions from their new TD errors.
+        :param indices: The transitions indices
+        :param td_errors: The TD error of each transition
+        """
+        priorities = (np.abs(td_errors) + self.priority_epsilon) ** self.alpha
+        self.tree.update(indices, priorities)
+        self.max_priority = max(self.max_priority, np.max(priorities))
+
+    def memory_state(self) -> dict:
+        """See base class."""
+        memory_state = ReplayMemory.memory_state(self)
+        memory_state["max_priority"] = float(self.max_priority)
+        return memory_state
+
+    def save(self, directory: Path):
+        """See base class. The priorities of the stored transitions are saved too."""
+        ReplayMemory.save(self, directory)
+        save_column(Path(directory, "priorities.npy"), self.tree.get(np.arange(self.size)))
+
+    def load(self, directory: Path) -> dict:
+        """See base class. The sum tree is rebuilt from the saved priorities."""
+        memory_state = ReplayMemory.load(self, directory)
+        priorities = np.load(Path(directory, "priorities.npy"), mmap_mode="r")
+        self.tree.nodes[:] = 0.
+        self.tree.nodes[self.tree.capacity:self.tree.capacity + len(priorities)] = priorities
+        self.tree.rebuild()
+        self.max_priority = memory_state["max_priority"]
+        return memory_state
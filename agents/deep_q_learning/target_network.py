@@ -0,0 +1,37 @@
+"""
+Target network updates for the Deep Q Learning agents.
+The updates are variable assignments meant to run inside a tf.function,
+so the weights never leave the TensorFlow runtime.
+"""
+
+TARGET_UPDATES = ["hard", "soft"]
+
+
+def check_target_update(target_update: str, tau: float):
+    """
+    Validate the target network update configuration.
+    :param target_update: "hard" copies the weights every `update_target_every` episodes,
+                          "soft" does Polyak averaging after every training step
+    :param tau: The weight of the online network in the soft update
+    :raises ValueError if the configuration is not valid
+    """
+    if target_update not in TARGET_UPDATES:
+        raise ValueError(f"Unknown target network update '{target_update}', use one of {TARGET_UPDATES}")
+    if target_update == "soft" and not 0. < tau <= 1.:
+        raise ValueError(f"The soft update tau must be in (0, 1], got {tau}")
+
+
+def update_target_variables(target_variables: list, variables: list, tau: float=None):
+    """
+    Update the target network variables with the online network ones.
+    Must be called inside a tf.function to be compiled.
+    :param target_variables: The target network variables
+    :param variables: The online network variables, in the same order
+    :param tau: If None the variables are copied, otherwise
+                target = tau * online + (1 - tau) * target
+    """
+    for target_variable, variable in zip(target_variables, variables):
+        if tau is None:
+            target_variable.assign(variable)
+        else:
+            target_variable.assign(tau * variable + (1. - tau) * target_variable)
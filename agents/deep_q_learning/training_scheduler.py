@@ -0,0 +1,54 @@
+"""
+Scheduling of gradient steps during Deep Q Learning training.
+Controls the ratio between collected environment steps and training steps.
+"""
+
+
+class TrainingScheduler(object):
+    """
+    Decides how many gradient steps to run after each batch of environment steps.
+     - A warm-up phase of pure collection is run first.
+     - After that, every `train_every` environment steps `gradient_steps` training steps are run.
+    """
+
+    def __init__(self, train_every: int=1, gradient_steps: int=1, warmup_steps: int=0):
+        """
+        Creates a new scheduler.
+        :param train_every: How many environment steps between training triggers
+        :param gradient_steps: How many gradient steps are run on each trigger
+        :param warmup_steps: Environment steps of pure collection before training starts
+        """
+        if train_every < 1 or gradient_steps < 0 or warmup_steps < 0:
+            raise ValueError(f"Invalid training schedule: train_every={train_every}, "
+                             f"gradient_steps={gradient_steps}, warmup_steps={warmup_steps}")
+
+        self.train_every = train_every
+        self.gradient_steps = gradient_steps
+        self.warmup_steps = warmup_steps
+        self.environment_steps = 0
+
+    @property
+    def update_to_data_ratio(self) -> float:
+        """
+        :return: The number of gradient steps per environment step after the warm-up
+        """
+        return self.gradient_steps / self.train_every
+
+    def reset(self):
+        self.environment_steps = 0
+
+    def step(self, environment_steps: int=1) -> int:
+        """
+        Register new environment steps.
+        :param environment_steps: The number of environment steps just executed
+        :return: The number of gradient steps to run now
+        """
+        previous_steps = self.environment_steps
+        self.environment_steps += environment_steps
+
+        # Only the steps after the warm-up phase count for the triggers
+        previous_steps = max(previous_steps - self.warmup_steps, 0)
+        current_steps = max(self.environment_steps - self.warmup_steps, 0)
+        triggers = current_steps // self.train_every - previous_steps // self.train_every
+
+        return triggers * self.gradient_steps
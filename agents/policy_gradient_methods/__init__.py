@@ -1,8 +1,6 @@
-from .models import feed_forward_model_constructor
+import importlib
+
 from agents.policy_gradient_methods.envs import *
-from .base_pg import BasePolicyGradientAgent, TrainingExperience
-from .pg_methods import NaivePolicyGradientAgent, RewardToGoPolicyGradientAgent, \
-    BaseAgentConfig, REINFORCEPolicyGradientAgent, REINFORCEAgentConfig
 
 
 ENVIRONMENTS = {"CartPole-v0": CartPoleEnvironment,
@@ -10,10 +8,44 @@ ENVIRONMENTS = {"CartPole-v0": CartPoleEnvironment,
                 "HeuristicMountainCar-v0": HeuristicMountainCarEnvironment,
                 "MoveToGoalSimpleSmall": MoveToGoalSimpleSmallEnvironment}
 
-PG_METHODS = {"naive": {"agent": NaivePolicyGradientAgent,
-                        "config": BaseAgentConfig},
-              "reward_to_go": {"agent": RewardToGoPolicyGradientAgent,
-                               "config": BaseAgentConfig},
-              "REINFORCE": {"agent": REINFORCEPolicyGradientAgent,
-                            "config": REINFORCEAgentConfig}
-              }
+# The agents and their models import Tensorflow, they are imported on first use so the
+# rollout worker processes, which only need the environments, start without it.
+AGENTS_MODULES = {"feed_forward_model_constructor": "models",
+                  "BasePolicyGradientAgent": "base_pg",
+                  "TrainingExperience": "base_pg",
+                  "NaivePolicyGradientAgent": "pg_methods",
+                  "RewardToGoPolicyGradientAgent": "pg_methods",
+                  "REINFORCEPolicyGradientAgent": "pg_methods",
+                  "BaseAgentConfig": "pg_methods",
+                  "REINFORCEAgentConfig": "pg_methods"}
+
+
+__all__ = ["Environment", "Episode", "EpisodesBatch", "CartPoleEnvironment", "AcrobotEnvironment",
+           "HeuristicMountainCarEnvironment", "MoveToGoalSimpleSmallEnvironment", "play_episodes",
+           "ENVIRONMENTS", "PG_METHODS"] + list(AGENTS_MODULES)
+
+
+def __getattr__(name: str):
+    if name == "PG_METHODS":
+        from .pg_methods import NaivePolicyGradientAgent, RewardToGoPolicyGradientAgent, \
+            BaseAgentConfig, REINFORCEPolicyGradientAgent, REINFORCEAgentConfig
+        value = {"naive": {"agent": NaivePolicyGradientAgent,
+                           "config": BaseAgentConfig},
+                 "reward_to_go": {"agent": RewardToGoPolicyGradientAgent,
+                                  "config": BaseAgentConfig},
+                 "REINFORCE": {"agent": REINFORCEPolicyGradientAgent,
+                               "config": REINFORCEAgentConfig}
+                 }
+    elif name in AGENTS_MODULES:
+        module = importlib.import_module(f".{AGENTS_MODULES[name]}", __name__)
+        value = getattr(module, name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    # Stored as a module global, so it is built once and the next accesses get the same object
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -12,7 +12,12 @@ import matplotlib.pyplot as plt
 SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
 sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
 
-from agents.policy_gradient_methods import *
+from agents.policy_gradient_methods.envs import Environment, Episode, EpisodesBatch, play_episodes
+from agents.policy_gradient_methods.models import feed_forward_model_constructor
+from agents.policy_gradient_methods.collector import ExperienceCollector
+from agents.policy_gradient_methods.rollout_workers import RolloutWorkerPool
+from code_utils.inference_utils import DenseInferenceEngine
+from code_utils.profiler_utils import PhaseProfiler
 
 
 logger = logging.getLogger()
@@ -36,11 +41,12 @@ class TrainingExperience(object):
         assert len(states) == len(weights) == len(actions)
         assert len(total_rewards) == len(episode_lengths)
 
-        self.states = np.array(states, dtype=np.float32)
-        self.weights = np.array(weights, dtype=np.float32)
-        self.actions = np.array(actions, dtype=np.int32)
-        self.total_rewards = np.array(total_rewards, dtype=np.float32)
-        self.episode_lengths = np.array(episode_lengths, dtype=np.int32)
+        # Arrays of the right type are kept as they are, so they can be views of an EpisodesBatch
+        self.states = np.asarray(states, dtype=np.float32)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.actions = np.asarray(actions, dtype=np.int32)
+        self.total_rewards = np.asarray(total_rewards, dtype=np.float32)
+        self.episode_lengths = np.asarray(episode_lengths, dtype=np.int32)
 
     def __len__(self):
         """
@@ -58,7 +64,8 @@ class BasePolicyGradientAgent(object):
     """
 
     def __init__(self, env: Environment, agent_path: Path, layer_size: int,
-                 learning_rate: float, hidden_layers_count: int, activation: str):
+                 learning_rate: float, hidden_layers_count: int, activation: str,
+                 environments_count: int=1, rollout_workers: int=0):
         """Create an agent that uses a FFNN model to represent its policy.
 
         Args:
@@ -67,8 +74,16 @@ class BasePolicyGradientAgent(object):
             learning_rate: The training step size
             hidden_layers_count: The number of FF layers before the output layer
             activation: Activation function for hidden layer neurons
+            environments_count: The number of environment copies stepped together
+                                when collecting experience
+            rollout_workers: The number of RolloutWorkerPool processes that collect the
+                             experience in train_policy, each of them with environments_count
+                             copies. If 0 the experience is collected by this process.
         """
         self.env = env
+        self.activation = activation
+        self.environments_count = environments_count
+        self.rollout_workers = rollout_workers
         self.agent_path = agent_path
         model_path = Path(agent_path, "model")
         policy_constructor = feed_forward_model_constructor(env.state_space_n, env.action_space_n)
@@ -78,6 +93,16 @@ class BasePolicyGradientAgent(object):
                                          hidden_layers_count=hidden_layers_count,
                                          activation=activation)
 
+        # NumPy copy of the policy to play games, invalidated when the weights change
+        self.inference = DenseInferenceEngine(activation, weights_source=lambda: self.policy.get_weights())
+
+        # Reused by every collect_experience call, created for the first experience size
+        self.episodes_batch = None
+        self.rollout_pool = None
+
+        # Replaced in train_policy when the phases are profiled
+        self.profiler = PhaseProfiler(enabled=False)
+
     def get_training_experience(self, episodes: EpisodesBatch) -> TrainingExperience:
         """
         Transforms an EpisodesBatch into a TrainingExperience.
@@ -87,44 +112,79 @@ class BasePolicyGradientAgent(object):
         """
         raise NotImplementedError
 
+    def start_rollout_workers(self, experience_size: int):
+        """
+        Start a RolloutWorkerPool of rollout_workers processes, used to collect the
+        experience until stop_rollout_workers is called.
+        :param experience_size: The number of environment steps of each batch
+        """
+        # Build the policy so the weights have their shapes
+        self.policy(np.zeros((1, self.env.state_space_n), dtype=np.float32))
+        logger.info(f"Starting {self.rollout_workers} rollout workers")
+        self.rollout_pool = RolloutWorkerPool(self.rollout_workers, type(self.env), self.environments_count,
+                                              experience_size, [weights.shape for weights in self.policy.get_weights()],
+                                              self.activation)
+        self.episodes_batch = None
+
+    def stop_rollout_workers(self):
+        self.rollout_pool.close()
+        self.rollout_pool = None
+        self.episodes_batch = None
+
+    def create_episodes_batch(self, size: int) -> EpisodesBatch:
+        """
+        Create an EpisodesBatch for collect_episodes. Every running copy can finish
+        an episode after the batch is full, so the buffers have room for it.
+        :param size: Batch size
+        :return: An empty EpisodesBatch
+        """
+        if self.rollout_pool is not None:
+            return EpisodesBatch(max_size=size, state_space_n=self.env.state_space_n,
+                                 overflow_size=self.rollout_pool.capacity - size)
+
+        max_episode_length = self.env.max_episode_length
+        if max_episode_length is None:
+            raise ValueError(f"{type(self.env).__name__} has no max_episode_length, "
+                             f"it is needed to preallocate the experience buffers.")
+        return EpisodesBatch(max_size=size, state_space_n=self.env.state_space_n,
+                             overflow_size=self.environments_count * max_episode_length)
+
+    def collect_episodes(self, episodes_batch: EpisodesBatch, produce_actions):
+        """
+        Fill an EpisodesBatch with episodes played by the environment copies, see play_episodes.
+        :param episodes_batch: The batch to fill, it is cleared first
+        :param produce_actions: Function that returns the action of each state of an array of states
+        """
+        play_episodes(self.env, self.environments_count, episodes_batch, produce_actions, self.profiler)
+
     def collect_experience(self, size: int) -> TrainingExperience:
         """
         Collects a batch of steps in the environment using the current policy
-        to be feed to the neural network.
+        to be feed to the neural network, see collect_episodes.
+        The episodes are stored in the agent EpisodesBatch, so the returned experience
+        holds views of its buffers that are overwritten by the next call.
 
         :param size: Batch size
         :return: An ExperienceBatch object with the collected steps information.
         """
-
-        episodes_batch = EpisodesBatch(max_size=size)
-
-        while not episodes_batch.is_full():
-            self.env.reset_environment()
-            done = False
-            states = []
-            rewards = []
-            actions = []
-
-            while not done:
-                current_state = self.env.get_environment_state()
-                tf_current_state = tf.constant(np.array([current_state]), dtype=tf.float32)
-                action = self.policy.produce_actions(tf_current_state)[0][0]
-                next_state, reward, done = self.env.environment_step(action)
-
-                states.append(current_state)
-                actions.append(action)
-                rewards.append(reward)
-
-            episode = Episode(states, actions, rewards)
-            episodes_batch.add_episode(episode=episode)
-
-        training_experience = self.get_training_experience(episodes=episodes_batch)
+        if self.episodes_batch is None or self.episodes_batch.max_size != size:
+            self.episodes_batch = self.create_episodes_batch(size)
+
+        if self.rollout_pool is not None:
+            with self.profiler.phase("rollout_workers"):
+                self.rollout_pool.collect(self.episodes_batch, self.policy.get_weights())
+        else:
+            self.collect_episodes(self.episodes_batch,
+                                  lambda states: self.policy.produce_actions(tf.constant(states)).numpy()[:, 0])
+        with self.profiler.phase("returns"):
+            training_experience = self.get_training_experience(episodes=self.episodes_batch)
 
         return training_experience
 
     def train_policy(self, train_steps: int, experience_size: int,
                      save_policy_every: int=None, show_every: int=None,
-                     minibatch_size: int=None):
+                     minibatch_size: int=None, max_policy_lag: int=0, profile_phases: bool=False,
+                     profile_steps: list=None):
         """Train the agent to solve the current environment.
 
         Args:
@@ -136,7 +196,48 @@ class BasePolicyGradientAgent(object):
             minibatch_size: How many environment steps are pass to the NN at once.
                             If None, the total number of steps collected for each
                             training step is used (experience_size)
+            max_policy_lag: If 0 each batch is collected and then trained on. Otherwise the
+                            next batches are collected by a background ExperienceCollector
+                            while training, with weights at most max_policy_lag training
+                            steps older than the weights they train.
+            profile_phases: Measure the time of each phase of the training loop with a
+                            PhaseProfiler. The statistics are written to the policy summaries
+                            and to a JSON report in the agent path.
+            profile_steps: The first and the last (excluded) training steps captured with
+                           the Tensorflow profiler, in the policy train log. None to not capture.
+
+        Returns:
+            The moving average of the mean reward of each training step
         """
+        self.profiler = PhaseProfiler(enabled=profile_phases, summary_writer=self.policy.summary_writer,
+                                      profile_steps=profile_steps, profile_dir=self.policy.train_log_dir)
+
+        logger.info(f"Collecting experience from {self.environments_count} environments in lockstep")
+        if self.rollout_workers > 0:
+            self.start_rollout_workers(experience_size)
+
+        collector = None
+        if max_policy_lag > 0:
+            logger.info(f"Collecting in the background with a max policy lag of {max_policy_lag}")
+            # Build the policy so it has weights to publish
+            self.policy(np.zeros((1, self.env.state_space_n), dtype=np.float32))
+            collector = ExperienceCollector(self, train_steps, experience_size, max_policy_lag)
+            collector.publish_weights(0, self.policy.get_weights())
+            collector.start()
+
+        try:
+            return self.training_loop(train_steps, experience_size, save_policy_every, show_every,
+                                      minibatch_size, collector)
+        finally:
+            self.profiler.close()
+            if collector is not None:
+                collector.stop()
+            if self.rollout_pool is not None:
+                self.stop_rollout_workers()
+
+    def training_loop(self, train_steps: int, experience_size: int, save_policy_every: int,
+                      show_every: int, minibatch_size: int, collector: ExperienceCollector=None):
+        """The loop of train_policy, with the experience of the collector if there is one."""
 
         policy_values_dir = None
         if save_policy_every is not None:
@@ -145,9 +246,25 @@ class BasePolicyGradientAgent(object):
 
         train_steps_avg_rewards = []
         start_time = time.time()
+        collection_time = 0
+        collected_steps = 0
+        waiting_time = 0
+        policy_lags = []
         training_steps = 0
         for i in range(train_steps):
-            training_experience = self.collect_experience(experience_size)
+            self.profiler.training_step(i)
+            if collector is None:
+                collection_start = time.time()
+                training_experience = self.collect_experience(experience_size)
+                collection_time += time.time() - collection_start
+            else:
+                waiting_start = time.time()
+                with self.profiler.phase("collection_wait"):
+                    weights_version, training_experience, batch_collection_time = collector.get_experience()
+                waiting_time += time.time() - waiting_start
+                collection_time += batch_collection_time
+                policy_lags.append(training_steps - weights_version)
+            collected_steps += len(training_experience)
             mean_reward = np.mean(training_experience.total_rewards)
 
             if show_every is not None:
@@ -155,57 +272,76 @@ class BasePolicyGradientAgent(object):
                     logger.info("====================================================")
                     logger.info(f"Training step N° {i}")
                     logger.info(f"Batch time = {time.time() - start_time} sec")
+                    logger.info(f"Collection steps per second = {collected_steps / collection_time}")
+                    if collector is not None:
+                        logger.info(f"Policy lag mean = {np.mean(policy_lags)} - max = {np.max(policy_lags)}")
+                        logger.info(f"Learner waiting for experience = {waiting_time} sec")
+                        waiting_time = 0
+                        policy_lags = []
                     logger.info(f"Last {len(training_experience.total_rewards)} episodes reward mean: {mean_reward}")
+                    self.profiler.write_summaries(training_steps)
                     start_time = time.time()
+                    collection_time = 0
+                    collected_steps = 0
 
-            states_batch = tf.constant(training_experience.states, dtype=np.float32)
-            actions_batch = tf.constant(training_experience.actions, dtype=np.int32)
-            weights_batch = tf.constant(training_experience.weights, dtype=np.float32)
+            with self.profiler.phase("experience_conversion"):
+                states_batch = tf.constant(training_experience.states, dtype=np.float32)
+                actions_batch = tf.constant(training_experience.actions, dtype=np.int32)
+                weights_batch = tf.constant(training_experience.weights, dtype=np.float32)
 
             batch_size = minibatch_size if minibatch_size is not None else len(states_batch)
-            data = tf.data.Dataset.from_tensor_slices((states_batch, actions_batch, weights_batch))
-            # TODO: Check if randomizing has some effect
-            data = data.shuffle(buffer_size=len(states_batch)).batch(batch_size)
-
-            for minibatch_step, data_batch in enumerate(data):
-
-                if i == 0 and minibatch_step == 0:
-                    tf.summary.trace_on(graph=True, profiler=True)
-                    # Call only one tf.function when tracing.
-                    self.policy(data_batch[0])
-                    with self.policy.summary_writer.as_default():
-                        tf.summary.trace_export(name="policy_call", step=0,
-                                                profiler_outdir=str(self.policy.train_log_dir))
-                    self.policy.summary_writer.flush()
-
-                logits, loss, log_probabilities = self.policy.train_step(
-                    data_batch[0], data_batch[1], data_batch[2])
-
-                if minibatch_step == len(data) - 1:
-                    with self.policy.summary_writer.as_default():
-                        # TODO: Add summaries for state values and action probabilities
-                        tf.summary.scalar("mean_reward", data=mean_reward, step=training_steps)
-                        tf.summary.histogram("logits", data=logits, step=training_steps)
-                        tf.summary.scalar("loss", data=loss, step=training_steps)
-                        tf.summary.histogram("log_probabilities", data=log_probabilities, step=training_steps)
-                        tf.summary.histogram("weights", data=data_batch[2], step=training_steps)
-                    self.policy.summary_writer.flush()
 
+            if i == 0:
+                # The graph only, the Tensorflow profiler runs for the profile_steps window
+                tf.summary.trace_on(graph=True)
+                # Call only one tf.function when tracing.
+                self.policy(states_batch[:batch_size])
+                with self.policy.summary_writer.as_default():
+                    tf.summary.trace_export(name="policy_call", step=0)
+                self.policy.summary_writer.flush()
+
+            with self.profiler.phase("train_step"):
+                # TODO: Compare the shuffled minibatches of train_epoch with unshuffled ones
+                losses, logits, log_probabilities, last_weights = self.policy.train_epoch(
+                    states_batch, actions_batch, weights_batch, tf.constant(batch_size, dtype=tf.int32))
+
+            with self.profiler.phase("summaries"):
+                with self.policy.summary_writer.as_default():
+                    # TODO: Add summaries for state values and action probabilities
+                    tf.summary.scalar("mean_reward", data=mean_reward, step=training_steps)
+                    tf.summary.histogram("logits", data=logits, step=training_steps)
+                    tf.summary.scalar("loss", data=losses[-1], step=training_steps)
+                    tf.summary.histogram("log_probabilities", data=log_probabilities, step=training_steps)
+                    tf.summary.histogram("weights", data=last_weights, step=training_steps)
+                self.policy.summary_writer.flush()
+
+            self.inference.invalidate()
             training_steps += 1
+            if collector is not None:
+                collector.publish_weights(training_steps, self.policy.get_weights())
+                collector.batch_trained()
             train_steps_avg_rewards.append(mean_reward)
 
             if save_policy_every is not None:
                 if not i % save_policy_every:
-                    # TODO: Make this better changing policy_values_plot to something more generic
-                    possible_states, states_predictions = self.env.policy_values_plot(
-                        Path(policy_values_dir, f"policy_values_{i}.png"))
-                    with open(Path(policy_values_dir, f"policy_values_{i}.pickle"), "wb") as pfile:
-                        pickle.dump(states_predictions, pfile, protocol=pickle.HIGHEST_PROTOCOL)
+                    with self.profiler.phase("saving"):
+                        # TODO: Make this better changing policy_values_plot to something more generic
+                        possible_states, states_predictions = self.env.policy_values_plot(
+                            Path(policy_values_dir, f"policy_values_{i}.png"))
+                        with open(Path(policy_values_dir, f"policy_values_{i}.pickle"), "wb") as pfile:
+                            pickle.dump(states_predictions, pfile, protocol=pickle.HIGHEST_PROTOCOL)
 
         moving_avg = np.convolve(train_steps_avg_rewards, np.ones((show_every,)) / show_every, mode='valid')
 
-        self.save_agent()
-        self.plot_training_info(moving_avg, self.agent_path)
+        with self.profiler.phase("saving"):
+            self.save_agent()
+            self.plot_training_info(moving_avg, self.agent_path)
+
+        self.profiler.write_summaries(training_steps)
+        self.profiler.log_report()
+        self.profiler.save_report(self.agent_path)
+
+        return moving_avg
 
     def save_agent(self):
         """Save the policy neural network to files in the model path."""
@@ -221,6 +357,7 @@ class BasePolicyGradientAgent(object):
         :param model_dir: Where the trained model is stored.
         """
         self.policy = tf.keras.models.load_model(model_dir)
+        self.inference.invalidate()
 
     @staticmethod
     def plot_training_info(moving_avg: np.array, agent_folder: Path=None):
@@ -253,8 +390,7 @@ class BasePolicyGradientAgent(object):
                     time.sleep(delay)
 
             state = self.env.get_environment_state()
-            tf_current_state = tf.constant(np.array([state]), dtype=tf.float32)
-            action = self.policy.produce_actions(tf_current_state)[0][0]
+            action = self.inference.sample_action(state)
 
             new_state, reward, done = self.env.environment_step(action)
 
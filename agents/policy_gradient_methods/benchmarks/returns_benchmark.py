@@ -0,0 +1,102 @@
+"""
+Compares the per episode weights computations used originally by the policy gradient
+agents with the batch wide kernels of returns.py, for batches of episodes of a fixed length:
+ - naive: total reward of the episode
+ - reward_to_go: sum of the rewards from each step
+ - REINFORCE: discounted sum of the rewards from each step
+The kernel outputs are checked against the original computations.
+"""
+
+import argparse
+import sys
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
+sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
+
+from agents.policy_gradient_methods.returns import episode_offsets, total_reward_weights, rewards_to_go, \
+    discounted_rewards_to_go
+
+
+def naive_loop(episodes: list, discount_factor: float) -> np.array:
+    weights = []
+    for rewards in episodes:
+        weights += [np.sum(rewards)] * len(rewards)
+    return np.array(weights, dtype=np.float32)
+
+
+def reward_to_go_loop(episodes: list, discount_factor: float) -> np.array:
+    weights = []
+    for rewards in episodes:
+        for i in range(len(rewards)):
+            weights.append(sum(rewards[i:]))
+    return np.array(weights, dtype=np.float32)
+
+
+def reinforce_loop(episodes: list, discount_factor: float) -> np.array:
+    weights = []
+    for rewards in episodes:
+        for i in range(len(rewards)):
+            rewards_from_step = rewards[i:]
+            discounts = (np.ones(len(rewards_from_step)) * discount_factor) ** np.arange(len(rewards_from_step))
+            weights.append(sum(discounts * rewards_from_step))
+    return np.array(weights, dtype=np.float32)
+
+
+METHODS = {"naive": (naive_loop, lambda rewards, offsets, discount_factor: total_reward_weights(rewards, offsets)),
+           "reward_to_go": (reward_to_go_loop, lambda rewards, offsets, discount_factor: rewards_to_go(rewards, offsets)),
+           "REINFORCE": (reinforce_loop, discounted_rewards_to_go)}
+
+
+def time_function(function, repeats: int, *args):
+    """
+    :return: The mean time per call in milliseconds and the output of the last call
+    """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        output = function(*args)
+    return (time.perf_counter() - start) / repeats * 1e3, output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the policy gradient weights computations.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--episode_lengths", type=int, nargs="+", default=[20, 200, 500, 10000],
+                        help="The episode lengths to benchmark.")
+    parser.add_argument("--batch_steps", type=int, default=10000,
+                        help="The number of steps of each batch, split in episodes of the benchmarked length.")
+    parser.add_argument("--discount_factor", type=float, default=0.99,
+                        help="The discount factor of REINFORCE.")
+    parser.add_argument("--max_loop_time", type=float, default=60.,
+                        help="The per episode loops of batches expected to take longer (in seconds) are skipped.")
+    args = parser.parse_args()
+
+    print(f"{'method':>14} {'episode length':>15} {'loop (ms)':>11} {'kernel (ms)':>12} "
+          f"{'speedup':>9} {'max abs error':>14}")
+    for episode_length in args.episode_lengths:
+        episodes_count = max(1, args.batch_steps // episode_length)
+        rewards = np.random.uniform(-1, 1, episodes_count * episode_length).astype(np.float32)
+        episodes = np.split(rewards, episodes_count)
+        offsets = episode_offsets([episode_length] * episodes_count)
+
+        for method, (loop, kernel) in METHODS.items():
+            kernel_time, weights = time_function(kernel, 20, rewards, offsets, args.discount_factor)
+
+            # The loops are quadratic in the episode length, estimate their time with one episode first
+            one_episode_time, _ = time_function(loop, 1, episodes[:1], args.discount_factor)
+            if one_episode_time * episodes_count / 1e3 > args.max_loop_time:
+                print(f"{method:>14} {episode_length:>15} {'skipped':>11} {kernel_time:>12.3f} {'':>9} {'':>14}")
+                continue
+
+            loop_time, loop_weights = time_function(loop, 1, episodes, args.discount_factor)
+            error = np.max(np.abs(loop_weights - weights))
+            print(f"{method:>14} {episode_length:>15} {loop_time:>11.2f} {kernel_time:>12.3f} "
+                  f"{loop_time / kernel_time:>8.0f}x {error:>14.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Measures the experience collection throughput of the policy gradient agents against
+the number of RolloutWorkerPool processes. With 0 workers the batch is collected in
+the learner process with play_episodes, like collect_experience does without a pool.
+The policy is a NumPy copy of a feed forward policy with random weights, so only the
+collection is timed and Tensorflow is not needed.
+"""
+
+import argparse
+import sys
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
+sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
+
+from agents.policy_gradient_methods.envs import AcrobotEnvironment, EpisodesBatch, play_episodes
+from agents.policy_gradient_methods.rollout_workers import RolloutWorkerPool
+from code_utils.inference_utils import DenseInferenceEngine
+
+
+def random_policy_weights(state_space_n: int, action_space_n: int, layer_size: int,
+                          hidden_layers_count: int) -> list:
+    """
+    :return: The kernel and bias of each layer, as returned by get_weights
+    """
+    sizes = [state_space_n] + [layer_size] * hidden_layers_count + [action_space_n]
+    weights = []
+    for inputs, outputs in zip(sizes[:-1], sizes[1:]):
+        weights.append(np.random.normal(0., 1. / np.sqrt(inputs), (inputs, outputs)).astype(np.float32))
+        weights.append(np.zeros(outputs, dtype=np.float32))
+    return weights
+
+
+def measure_in_process(environments_count: int, experience_size: int, batches: int, weights: list,
+                       activation: str) -> float:
+    """
+    :return: Environment steps per second
+    """
+    environment = AcrobotEnvironment()
+    policy = DenseInferenceEngine(activation)
+    policy.set_weights(weights)
+    episodes_batch = EpisodesBatch(max_size=experience_size, state_space_n=environment.state_space_n,
+                                   overflow_size=environments_count * environment.max_episode_length)
+
+    play_episodes(environment, environments_count, episodes_batch, policy.sample_actions)  # Warm up
+    steps = 0
+    start = time.perf_counter()
+    for _ in range(batches):
+        play_episodes(environment, environments_count, episodes_batch, policy.sample_actions)
+        steps += len(episodes_batch)
+    return steps / (time.perf_counter() - start)
+
+
+def measure_workers(workers_count: int, environments_count: int, experience_size: int, batches: int,
+                    weights: list, activation: str) -> float:
+    """
+    :return: Environment steps per second
+    """
+    pool = RolloutWorkerPool(workers_count, AcrobotEnvironment, environments_count, experience_size,
+                             [array.shape for array in weights], activation)
+    try:
+        episodes_batch = EpisodesBatch(max_size=experience_size, state_space_n=AcrobotEnvironment().state_space_n,
+                                       overflow_size=pool.capacity - experience_size)
+
+        pool.collect(episodes_batch, weights)  # Warm up, the workers create their environments
+        steps = 0
+        start = time.perf_counter()
+        for _ in range(batches):
+            pool.collect(episodes_batch, weights)
+            steps += len(episodes_batch)
+        return steps / (time.perf_counter() - start)
+    finally:
+        pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rollout workers collection throughput on Acrobot.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4],
+                        help="The rollout_workers values to benchmark, 0 collects in process.")
+    parser.add_argument("--environments_count", type=int, default=8,
+                        help="The number of environment copies stepped in lockstep by each process.")
+    parser.add_argument("--experience_size", type=int, default=5000,
+                        help="The number of environment steps of each batch.")
+    parser.add_argument("--batches", type=int, default=10,
+                        help="How many batches are timed for each workers count.")
+    parser.add_argument("--hidden_layer_size", type=int, default=40,
+                        help="The number of neurons on each hidden layer of the policy.")
+    parser.add_argument("--hidden_layers_count", type=int, default=4,
+                        help="The number of hidden layers of the policy.")
+    parser.add_argument("--activation", type=str, default="relu",
+                        help="Activation function of the policy hidden layers.")
+    args = parser.parse_args()
+
+    environment = AcrobotEnvironment()
+    weights = random_policy_weights(environment.state_space_n, environment.action_space_n,
+                                    args.hidden_layer_size, args.hidden_layers_count)
+
+    print(f"{'workers':>8} {'steps/s':>10} {'speedup':>9}")
+    baseline = None
+    for workers_count in args.workers:
+        if workers_count == 0:
+            steps_per_second = measure_in_process(args.environments_count, args.experience_size, args.batches,
+                                                  weights, args.activation)
+        else:
+            steps_per_second = measure_workers(workers_count, args.environments_count, args.experience_size,
+                                               args.batches, weights, args.activation)
+        baseline = steps_per_second if baseline is None else baseline
+        print(f"{workers_count:>8} {steps_per_second:>10.0f} {steps_per_second / baseline:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Background collection of experience for the policy gradient agents, so the
+environments are stepped while the learner trains on the previous batch.
+The collector acts with a NumPy snapshot of the policy weights published by the
+learner, and it is never more than a given number of training steps behind it.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from code_utils.inference_utils import DenseInferenceEngine
+
+
+logger = logging.getLogger()
+
+
+class ExperienceCollector(threading.Thread):
+    """Thread that collects the experience batches of a training run ahead of the learner.
+
+    The policy lag of a batch is the number of training steps done by the learner
+    between the weights that collected the batch and the training step that uses it.
+    A batch is only started when its lag can't exceed max_policy_lag: max_policy_lag + 1
+    batches can be collected or queued and not trained yet, and each of them has its
+    own EpisodesBatch buffers.
+    """
+
+    def __init__(self, agent, batches_count: int, experience_size: int, max_policy_lag: int):
+        """Create a collector, call start to begin collecting.
+
+        Args:
+            agent: The BasePolicyGradientAgent that trains on the batches, its environment
+                copies are only stepped by the collector until it finishes
+            batches_count: The number of batches to collect
+            experience_size: The number of environment steps of each batch
+            max_policy_lag: The max policy lag of a batch, at least 1
+        """
+        if max_policy_lag < 1:
+            raise ValueError(f"The max policy lag must be at least 1, got {max_policy_lag}")
+        threading.Thread.__init__(self, name="experience_collector", daemon=True)
+        self.agent = agent
+        self.batches_count = batches_count
+        self.max_policy_lag = max_policy_lag
+        self.engine = DenseInferenceEngine(agent.activation)
+        self.episodes_batches = [agent.create_episodes_batch(experience_size) for _ in range(max_policy_lag + 1)]
+
+        self.free_batches = threading.Semaphore(max_policy_lag + 1)
+        self.experiences = queue.Queue()
+        self.weights_lock = threading.Lock()
+        self.weights = None
+        self.weights_version = 0
+        self.stop_event = threading.Event()
+
+    def publish_weights(self, version: int, weights: list):
+        """Make new policy weights available for the next batches.
+
+        Args:
+            version: The number of training steps done by the learner with these weights
+            weights: The policy weights as returned by get_weights
+        """
+        with self.weights_lock:
+            self.weights = weights
+            self.weights_version = version
+
+    def run(self):
+        try:
+            for batch in range(self.batches_count):
+                while not self.free_batches.acquire(timeout=0.1):
+                    if self.stop_event.is_set():
+                        return
+
+                with self.weights_lock:
+                    weights, version = self.weights, self.weights_version
+                self.engine.set_weights(weights)
+
+                start = time.time()
+                episodes_batch = self.episodes_batches[batch % len(self.episodes_batches)]
+                if self.agent.rollout_pool is not None:
+                    with self.agent.profiler.phase("rollout_workers"):
+                        self.agent.rollout_pool.collect(episodes_batch, weights)
+                else:
+                    self.agent.collect_episodes(episodes_batch, self.engine.sample_actions)
+                with self.agent.profiler.phase("returns"):
+                    training_experience = self.agent.get_training_experience(episodes=episodes_batch)
+                self.experiences.put((version, training_experience, time.time() - start))
+        except Exception as error:
+            logger.exception("Experience collection failed")
+            self.experiences.put(error)
+
+    def get_experience(self):
+        """Wait for the next batch.
+
+        Returns:
+            The version of the weights that collected the batch, the TrainingExperience
+            and the collection time in seconds
+        """
+        item = self.experiences.get()
+        if isinstance(item, Exception):
+            raise RuntimeError("The experience collector failed") from item
+        return item
+
+    def batch_trained(self):
+        """Release the buffers of the oldest batch given by get_experience, it must not be used after this."""
+        self.free_batches.release()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
@@ -1,3 +1,3 @@
 from .environments import Environment, Episode, EpisodesBatch, CartPoleEnvironment, \
-    AcrobotEnvironment, HeuristicMountainCarEnvironment
+    AcrobotEnvironment, HeuristicMountainCarEnvironment, play_episodes
 from .mtg_simple import MoveToGoalSimpleSmallEnvironment
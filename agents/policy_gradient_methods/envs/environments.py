@@ -4,6 +4,8 @@ from typing import List
 import gym
 import numpy as np
 
+from code_utils.profiler_utils import PhaseProfiler
+
 
 class Episode(object):
     """A single episode of an environment.
@@ -23,9 +25,9 @@ class Episode(object):
             actions: A list with all the actions taken in the episode
         """
         assert len(states) == len(rewards) == len(actions)
-        self.states = np.array(states, dtype=np.float32)
-        self.rewards = np.array(rewards, dtype=np.float32)
-        self.actions = np.array(actions, dtype=np.int32)
+        self.states = np.asarray(states, dtype=np.float32)
+        self.rewards = np.asarray(rewards, dtype=np.float32)
+        self.actions = np.asarray(actions, dtype=np.int32)
         self.total_reward = np.sum(self.rewards)
 
     def __len__(self) -> int:
@@ -38,16 +40,36 @@ class Episode(object):
 
 class EpisodesBatch(object):
     """
-    A collection of episodes.
+    A collection of episodes, stored in columns.
+    The states, actions and rewards of all the episodes are written one after the other
+    in flat buffers preallocated for max_size steps plus an overflow, and each episode is
+    only kept as its offset in the buffers. The buffers are reused after clear, so the
+    arrays returned by columns are overwritten by the episodes added after it.
     """
-    def __init__(self, max_size: int):
+    def __init__(self, max_size: int, state_space_n: int, overflow_size: int=0, buffers: tuple=None):
         """
         Creates an empty episodes batch.
         :param max_size: The max number of stored steps.
+        :param state_space_n: The length of the state vector representation
+        :param overflow_size: Steps stored after the batch is full, so episodes that were
+                              running when the batch got full can still be added.
+        :param buffers: The states, actions and rewards buffers to use (e.g. in shared memory),
+                        with room for max_size + overflow_size steps. If None they are allocated.
         """
-        self.episodes = []
         self.max_size = max_size
-        self.current_size = 0
+        self.capacity = max_size + overflow_size
+        if buffers is None:
+            buffers = (np.zeros((self.capacity, state_space_n), dtype=np.float32),
+                       np.zeros(self.capacity, dtype=np.int32),
+                       np.zeros(self.capacity, dtype=np.float32))
+        self.states, self.actions, self.rewards = buffers
+        assert len(self.states) >= self.capacity and len(self.actions) >= self.capacity \
+            and len(self.rewards) >= self.capacity
+        self.offsets = [0]
+
+    @property
+    def current_size(self) -> int:
+        return self.offsets[-1]
 
     def __len__(self) -> int:
         """
@@ -58,23 +80,55 @@ class EpisodesBatch(object):
     def __iter__(self):
         """
         Iterate over the stored episodes and yield one at the time
-        :return: An Episode object
+        :return: An Episode object, with views of the batch buffers
         """
-        for episode in self.episodes:
-            yield episode
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            yield Episode(self.states[start:end], self.actions[start:end], self.rewards[start:end])
 
     def add_episode(self, episode: Episode):
         """
         Add and episode to the batch. Update number of stored steps.
         :param episode: An Episode object
-        :raises ValueError if the episodes batch is full (max number of steps stored)
+        :raises ValueError if the episode does not fit in the batch buffers
+        """
+        self.add_steps(episode.states, episode.actions, episode.rewards)
+
+    def add_steps(self, states: np.array, actions: np.array, rewards: np.array):
+        """
+        Copy the steps of one episode to the end of the batch buffers.
+        :param states: Array of shape (episode length, state_space_n)
+        :param actions: The action of each step
+        :param rewards: The reward of each step
+        :raises ValueError if the episode does not fit in the batch buffers
+        """
+        start = self.current_size
+        end = start + len(states)
+        if end > self.capacity:
+            raise ValueError(f"The batch is full! max_size: {self.max_size} - capacity: {self.capacity}"
+                             f" - current_size: {self.current_size} - episode length: {len(states)}")
+        self.states[start:end] = states
+        self.actions[start:end] = actions
+        self.rewards[start:end] = rewards
+        self.offsets.append(end)
+
+    def add_episodes(self, states: np.array, actions: np.array, rewards: np.array, episode_lengths: np.array):
+        """
+        Copy the steps of consecutive episodes to the end of the batch buffers.
+        :param states: Array of shape (total length, state_space_n)
+        :param actions: The action of each step
+        :param rewards: The reward of each step
+        :param episode_lengths: The length of each episode
+        :raises ValueError if the episodes do not fit in the batch buffers
         """
-        if not self.is_full():
-            self.episodes.append(episode)
-            self.current_size += len(episode)
-        else:
-            raise ValueError(f"The batch is full! max_size: {self.max_size} -"
-                             f" current_size: {self.current_size}")
+        start = self.current_size
+        end = start + len(states)
+        if end > self.capacity:
+            raise ValueError(f"The batch is full! max_size: {self.max_size} - capacity: {self.capacity}"
+                             f" - current_size: {self.current_size} - episodes length: {len(states)}")
+        self.states[start:end] = states
+        self.actions[start:end] = actions
+        self.rewards[start:end] = rewards
+        self.offsets.extend((start + np.cumsum(episode_lengths)).tolist())
 
     def is_full(self) -> bool:
         """
@@ -82,13 +136,92 @@ class EpisodesBatch(object):
         """
         return self.current_size >= self.max_size
 
+    def clear(self):
+        """Remove all the episodes, the buffers are kept to store the next ones."""
+        self.offsets = [0]
+
+    def columns(self) -> (np.array, np.array, np.array, np.array):
+        """
+        :return: Views of the states, actions and rewards of all the stored steps
+                 and the offsets of the episodes (the start of each episode followed by the number of steps)
+        """
+        size = self.current_size
+        return self.states[:size], self.actions[:size], self.rewards[:size], np.array(self.offsets, dtype=np.int64)
+
+
+def play_episodes(env, environments_count: int, episodes_batch: EpisodesBatch, produce_actions,
+                  profiler: PhaseProfiler=None):
+    """
+    Fill an EpisodesBatch with episodes played by copies of an environment.
+    The copies are stepped in lockstep, with a single policy call per timestep for
+    all of them. Once the finished and running episodes have enough steps no new
+    episodes are started, and the running ones are played until they finish.
+    Only the running copies are given to the policy and stepped, and only the copies
+    that start a new episode have their state read again.
+    The steps of each copy are written to its row of the environment trajectory
+    buffers and the finished episodes are copied to the batch.
+
+    :param env: The Environment whose batch of copies is stepped
+    :param environments_count: The number of copies
+    :param episodes_batch: The batch to fill, it is cleared first. It needs room for
+                           a max length episode of every copy after it is full.
+    :param produce_actions: Function that returns the action of each state of an array of states
+    :param profiler: Measures the policy_inference, environment_step and environment_states phases
+    """
+    if profiler is None:
+        profiler = PhaseProfiler(enabled=False)
+    size = episodes_batch.max_size
+    episodes_batch.clear()
+
+    copies = np.arange(environments_count)
+    trajectory_states, trajectory_actions, trajectory_rewards = env.get_trajectory_buffers(environments_count)
+    trajectory_lengths = np.zeros(environments_count, dtype=np.int64)
+
+    states = env.reset_batch(environments_count)
+    running = np.ones(environments_count, dtype=np.bool_)
+
+    while np.any(running):
+        steps = copies[running]
+        with profiler.phase("policy_inference"):
+            actions = produce_actions(states[steps])
+        with profiler.phase("environment_step"):
+            next_states, rewards, dones = env.step_batch(actions, steps)
+
+        positions = trajectory_lengths[steps]
+        trajectory_states[steps, positions] = states[steps]
+        trajectory_actions[steps, positions] = actions
+        trajectory_rewards[steps, positions] = rewards
+        trajectory_lengths[steps] += 1
+        states[steps] = next_states
+
+        finished = steps[dones]
+        for i in finished:
+            length = trajectory_lengths[i]
+            episodes_batch.add_steps(trajectory_states[i, :length], trajectory_actions[i, :length],
+                                     trajectory_rewards[i, :length])
+            trajectory_lengths[i] = 0
+
+        # Copies that finished stop once the steps of all episodes reach the batch size
+        if len(episodes_batch) + trajectory_lengths.sum() >= size:
+            running[finished] = False
+
+        # The copies that keep running were reset, their next state is the first of a new episode
+        restarted = finished[running[finished]]
+        if len(restarted):
+            with profiler.phase("environment_states"):
+                states[restarted] = env.get_states_batch(restarted)
+
 
 class Environment(object):
     """Base class to create environments that can be used to train a
     policy gradient algorithm. All methods need to be implemented.
+
+    The batch methods (reset_batch, get_states_batch and step_batch) step N copies
+    of the environment together, so a policy can choose the actions of all the
+    copies with a single call. They are built on the single environment methods.
     """
     def __init__(self, env, action_space_n: int, state_space_n: int,
-                 actions: List[str], state_names: List[str]=None):
+                 actions: List[str], state_names: List[str]=None, max_episode_length: int=None):
         """Create a new Environment object.
 
         Args:
@@ -97,12 +230,16 @@ class Environment(object):
             state_space_n: The length of the state vector representation
             actions: A list with the actions names
             state_names: A list with the state attributes names
+            max_episode_length: The max number of steps of an episode, None if unknown
         """
         self.env = env
         self.action_space_n = action_space_n
         self.state_space_n = state_space_n
         self.actions = actions
         self.state_names = state_names
+        self.max_episode_length = max_episode_length
+        self.batch_environments = []
+        self.trajectory_buffers = None
 
     def reset_environment(self):
         """Reset the environment to start a new episode."""
@@ -128,6 +265,83 @@ class Environment(object):
         """
         raise NotImplementedError
 
+    def create_copy(self):
+        """Create a new independent instance of this environment, used by the batch methods.
+
+        Returns:
+            An Environment of the same type
+        """
+        return type(self)()
+
+    def reset_batch(self, batch_size: int) -> np.array:
+        """Reset a batch of copies of the environment to start new episodes.
+        The copies are created on the first call, or when the batch size changes.
+
+        Args:
+            batch_size: The number of copies
+
+        Returns:
+            The states of all copies, array of shape (batch_size, state_space_n)
+        """
+        if len(self.batch_environments) != batch_size:
+            self.batch_environments = [self.create_copy() for _ in range(batch_size)]
+        for environment in self.batch_environments:
+            environment.reset_environment()
+        return self.get_states_batch()
+
+    def get_trajectory_buffers(self, batch_size: int) -> (np.array, np.array, np.array):
+        """Get the buffers where the running episode of each copy is written by play_episodes.
+        They are allocated on the first call, or when the batch size changes, and reused after.
+
+        Args:
+            batch_size: The number of copies
+
+        Returns:
+            The states, actions and rewards buffers, with a row of max_episode_length steps per copy
+        """
+        if self.trajectory_buffers is None or len(self.trajectory_buffers[0]) != batch_size:
+            self.trajectory_buffers = (
+                np.zeros((batch_size, self.max_episode_length, self.state_space_n), dtype=np.float32),
+                np.zeros((batch_size, self.max_episode_length), dtype=np.int32),
+                np.zeros((batch_size, self.max_episode_length), dtype=np.float32))
+        return self.trajectory_buffers
+
+    def get_states_batch(self, copies: np.array=None) -> np.array:
+        """Get the current states of the batch of copies, ready to feed to the neural network.
+
+        Args:
+            copies: The indices of the copies to read, all of them if None
+
+        Returns:
+            Array of shape (number of copies, state_space_n)
+        """
+        environments = self.batch_environments if copies is None else [self.batch_environments[i] for i in copies]
+        return np.array([environment.get_environment_state() for environment in environments], dtype=np.float32)
+
+    def step_batch(self, actions: np.array, copies: np.array=None) -> (np.array, np.array, np.array):
+        """Make a move in copies of the environment. Copies that finish are reset,
+        so after this call get_states_batch returns the first states of their new episodes.
+
+        Args:
+            actions: The action index for each stepped copy
+            copies: The indices of the copies to step, in the order of the actions. All of them if None
+
+        Returns:
+            next_states (np.array of shape (number of copies, state_space_n), the terminal state for
+            finished copies), rewards (np.array of float32) and dones (np.array of bool)
+        """
+        environments = self.batch_environments if copies is None else [self.batch_environments[i] for i in copies]
+        batch_size = len(environments)
+        next_states = np.zeros((batch_size, self.state_space_n), dtype=np.float32)
+        rewards = np.zeros(batch_size, dtype=np.float32)
+        dones = np.zeros(batch_size, dtype=np.bool_)
+        for i, (environment, action) in enumerate(zip(environments, actions)):
+            _, rewards[i], dones[i] = environment.environment_step(action)
+            next_states[i] = environment.get_environment_state()
+            if dones[i]:
+                environment.reset_environment()
+        return next_states, rewards, dones
+
     def get_possible_states(self) -> np.array:
         """Returns a list of every possible environment state, or a sample of them.
 
@@ -160,7 +374,8 @@ class CartPoleEnvironment(Environment):
         actions = ["left", "right"]
         state_names = ["Cart Position", "Cart Velocity", "Pole Angle", "Pole Angular Velocity"]
 
-        Environment.__init__(self, env, action_space, state_space, actions, state_names)
+        Environment.__init__(self, env, action_space, state_space, actions, state_names,
+                             max_episode_length=env.spec.max_episode_steps)
 
     def reset_environment(self):
         self.env.reset()
@@ -196,7 +411,8 @@ class AcrobotEnvironment(Environment):
         state_names = ["cos(theta1)", "sin(theta1)", "cos(theta2)",
                        "sin(theta2)", "thetaDot1", "thetaDot2"]
 
-        Environment.__init__(self, env, action_space, state_space, actions, state_names)
+        Environment.__init__(self, env, action_space, state_space, actions, state_names,
+                             max_episode_length=env.spec.max_episode_steps)
 
     def reset_environment(self):
         self.env.reset()
@@ -232,7 +448,8 @@ class HeuristicMountainCarEnvironment(Environment):
         actions = ["left", "null", "right"]
         state_names = ["position", "velocity"]
 
-        Environment.__init__(self, env, action_space, state_space, actions, state_names)
+        Environment.__init__(self, env, action_space, state_space, actions, state_names,
+                             max_episode_length=env.spec.max_episode_steps)
 
     def reset_environment(self):
         self.env.reset()
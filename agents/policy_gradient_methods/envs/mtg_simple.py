@@ -21,7 +21,8 @@ class MoveToGoalSimpleSmallEnvironment(Environment):
         actions = env.actions
         state_names = [f"x{i}" for i in range(env.board_x)] + [f"x{j}" for j in range(env.board_y)]
 
-        Environment.__init__(self, env, action_space, state_space, actions, state_names)
+        Environment.__init__(self, env, action_space, state_space, actions, state_names,
+                             max_episode_length=env.game_end)
 
     def reset_environment(self):
         self.env.prepare_game()
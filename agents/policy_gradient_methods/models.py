@@ -89,6 +89,40 @@ def feed_forward_model_constructor(input_dim, output_dim):
 
             return logits, loss, log_probabilities
 
+        @tf.function(input_signature=[tf.TensorSpec(shape=[None, input_dim], dtype=tf.float32),
+                                      tf.TensorSpec(shape=[None], dtype=tf.int32),
+                                      tf.TensorSpec(shape=[None], dtype=tf.float32),
+                                      tf.TensorSpec(shape=[], dtype=tf.int32)])
+        def train_epoch(self, states: tf.Tensor, actions: tf.Tensor, weights: tf.Tensor, minibatch_size: tf.Tensor):
+            """
+            One pass over the experience in shuffled minibatches, with a train_step for each of them.
+            The permutation, the minibatch slicing and the optimizer steps run in a graph loop.
+            Returns:
+                The loss of each minibatch and the logits, log probabilities and weights of the last one.
+            """
+            logger.info("[Retrace] train_epoch")
+            steps_count = tf.shape(states)[0]
+            minibatches_count = (steps_count + minibatch_size - 1) // minibatch_size
+            permutation = tf.random.shuffle(tf.range(steps_count))
+
+            losses = tf.TensorArray(tf.float32, size=minibatches_count)
+            logits = tf.zeros([0, self.output_size])
+            log_probabilities = tf.zeros([0])
+            minibatch_weights = tf.zeros([0])
+            for i in tf.range(minibatches_count):
+                tf.autograph.experimental.set_loop_options(
+                    shape_invariants=[(logits, tf.TensorShape([None, self.output_size])),
+                                      (log_probabilities, tf.TensorShape([None])),
+                                      (minibatch_weights, tf.TensorShape([None]))])
+                indices = permutation[i * minibatch_size:(i + 1) * minibatch_size]
+                minibatch_weights = tf.gather(weights, indices)
+                logits, loss, log_probabilities = self.train_step(tf.gather(states, indices),
+                                                                  tf.gather(actions, indices),
+                                                                  minibatch_weights)
+                losses = losses.write(i, loss)
+
+            return losses.stack(), logits, log_probabilities, minibatch_weights
+
         @tf.function(input_signature=[tf.TensorSpec(shape=[None, output_dim], dtype=tf.float32)])
         def get_probabilities(self, logits: tf.Tensor):
             logger.info("[Retrace] get_probabilities")
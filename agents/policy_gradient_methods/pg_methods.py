@@ -7,7 +7,10 @@ import numpy as np
 SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
 sys.path.append(str(SCRIPT_DIR.parent.parent.parent.parent))
 
-from agents.policy_gradient_methods import *
+from agents.policy_gradient_methods.base_pg import BasePolicyGradientAgent, TrainingExperience
+from agents.policy_gradient_methods.envs import Environment, EpisodesBatch
+from agents.policy_gradient_methods.returns import episode_returns, total_reward_weights, \
+    rewards_to_go, discounted_rewards_to_go
 from code_utils.config_utils import BaseConfig
 
 
@@ -31,6 +34,11 @@ class BaseAgentConfig(BaseConfig):
         self.hidden_layers_count = self.config_dict["hidden_layers_count"]
         self.activation = self.config_dict["activation"]
         self.save_policy_every = self.config_dict["save_policy_every"]
+        self.environments_count = self.config_dict["environments_count"]
+        self.max_policy_lag = self.config_dict["max_policy_lag"]
+        self.rollout_workers = self.config_dict["rollout_workers"]
+        self.profile_phases = self.config_dict["profile_phases"]
+        self.profile_steps = self.config_dict["profile_steps"]
 
 
 class REINFORCEAgentConfig(BaseAgentConfig):
@@ -64,29 +72,17 @@ class NaivePolicyGradientAgent(BasePolicyGradientAgent):
                                          layer_size=agent_config.hidden_layer_size,
                                          learning_rate=agent_config.learning_rate,
                                          hidden_layers_count=agent_config.hidden_layers_count,
-                                         activation=agent_config.activation)
+                                         activation=agent_config.activation,
+                                         environments_count=agent_config.environments_count,
+                                         rollout_workers=agent_config.rollout_workers)
 
     def get_training_experience(self, episodes: EpisodesBatch) -> TrainingExperience:
         """See base class."""
-
-        states_batch = []
-        weights_batch = []
-        actions_batch = []
-        total_rewards = []
-        episode_lengths = []
-
-        for episode in episodes:
-            states_batch.append(episode.states)
-            actions_batch.append(episode.actions)
-            weights_batch += [episode.total_reward] * len(episode)
-            total_rewards.append(episode.total_reward)
-            episode_lengths.append(len(episode))
-
-        states_batch = np.concatenate(states_batch, axis=0)
-        actions_batch = np.concatenate(actions_batch, axis=0)
+        states_batch, actions_batch, rewards, offsets = episodes.columns()
+        weights_batch = total_reward_weights(rewards, offsets)
 
         return TrainingExperience(states_batch, weights_batch, actions_batch,
-                                  total_rewards, episode_lengths)
+                                  episode_returns(rewards, offsets), np.diff(offsets))
 
 
 class RewardToGoPolicyGradientAgent(BasePolicyGradientAgent):
@@ -99,35 +95,17 @@ class RewardToGoPolicyGradientAgent(BasePolicyGradientAgent):
                                          layer_size=agent_config.hidden_layer_size,
                                          learning_rate=agent_config.learning_rate,
                                          hidden_layers_count=agent_config.hidden_layers_count,
-                                         activation=agent_config.activation)
+                                         activation=agent_config.activation,
+                                         environments_count=agent_config.environments_count,
+                                         rollout_workers=agent_config.rollout_workers)
 
     def get_training_experience(self, episodes: EpisodesBatch) -> TrainingExperience:
         """See base class."""
-
-        states_batch = []
-        weights_batch = []
-        actions_batch = []
-        total_rewards = []
-        episode_lengths = []
-
-        for episode in episodes:
-            states_batch.append(episode.states)
-            actions_batch.append(episode.actions)
-
-            episode_rewards_to_go = []
-            for i in range(len(episode.rewards)):
-                episode_rewards_to_go.append(sum(episode.rewards[i:]))
-
-            weights_batch.append(episode_rewards_to_go)
-            total_rewards.append(episode.total_reward)
-            episode_lengths.append(len(episode))
-
-        states_batch = np.concatenate(states_batch, axis=0)
-        actions_batch = np.concatenate(actions_batch, axis=0)
-        weights_batch = np.concatenate(weights_batch, axis=0)
+        states_batch, actions_batch, rewards, offsets = episodes.columns()
+        weights_batch = rewards_to_go(rewards, offsets)
 
         return TrainingExperience(states_batch, weights_batch, actions_batch,
-                                  total_rewards, episode_lengths)
+                                  episode_returns(rewards, offsets), np.diff(offsets))
 
 
 class REINFORCEPolicyGradientAgent(BasePolicyGradientAgent):
@@ -141,35 +119,14 @@ class REINFORCEPolicyGradientAgent(BasePolicyGradientAgent):
                                          layer_size=agent_config.hidden_layer_size,
                                          learning_rate=agent_config.learning_rate,
                                          hidden_layers_count=agent_config.hidden_layers_count,
-                                         activation=agent_config.activation)
+                                         activation=agent_config.activation,
+                                         environments_count=agent_config.environments_count,
+                                         rollout_workers=agent_config.rollout_workers)
 
     def get_training_experience(self, episodes: EpisodesBatch) -> TrainingExperience:
         """See base class."""
-
-        states_batch = []
-        weights_batch = []
-        actions_batch = []
-        total_rewards = []
-        episode_lengths = []
-
-        for episode in episodes:
-            states_batch.append(episode.states)
-            actions_batch.append(episode.actions)
-
-            episode_discounted_rewards_to_go = []
-            for i in range(len(episode.rewards)):
-                rewards_to_go = episode.rewards[i:]
-                discounts = (np.ones(len(rewards_to_go)) * self.discount_factor) ** np.arange(len(rewards_to_go))
-                discounted_rewards_to_go = discounts * rewards_to_go
-                episode_discounted_rewards_to_go.append(sum(discounted_rewards_to_go))
-
-            weights_batch.append(episode_discounted_rewards_to_go)
-            total_rewards.append(episode.total_reward)
-            episode_lengths.append(len(episode))
-
-        states_batch = np.concatenate(states_batch, axis=0)
-        actions_batch = np.concatenate(actions_batch, axis=0)
-        weights_batch = np.concatenate(weights_batch, axis=0)
+        states_batch, actions_batch, rewards, offsets = episodes.columns()
+        weights_batch = discounted_rewards_to_go(rewards, offsets, self.discount_factor)
 
         return TrainingExperience(states_batch, weights_batch, actions_batch,
-                                  total_rewards, episode_lengths)
+                                  episode_returns(rewards, offsets), np.diff(offsets))
@@ -0,0 +1,113 @@
+"""
+Weights of the policy gradient algorithms computed from the rewards of a whole batch.
+The rewards of all episodes are stored one after the other in a flat array, and the
+episodes are delimited by their offsets: episode i is rewards[offsets[i]:offsets[i + 1]].
+Every function makes a constant number of passes over the array, so the cost is linear
+in the total number of steps regardless of the episode lengths.
+"""
+
+import numpy as np
+
+
+# Smallest discount power used to scale the rewards of a segment in discounted_rewards_to_go
+MIN_DISCOUNT_SCALE = 1e-100
+
+
+def episode_offsets(episode_lengths) -> np.array:
+    """
+    Args:
+        episode_lengths: The length of each episode of the batch
+
+    Returns:
+        Array with the start of each episode in the flat arrays followed by the total number of steps
+    """
+    offsets = np.zeros(len(episode_lengths) + 1, dtype=np.int64)
+    np.cumsum(episode_lengths, out=offsets[1:])
+    return offsets
+
+
+def episode_returns(rewards: np.array, offsets: np.array) -> np.array:
+    """
+    Returns:
+        The total reward of each episode
+    """
+    cumulative = np.zeros(len(rewards) + 1, dtype=np.float64)
+    np.cumsum(rewards, out=cumulative[1:])
+    return (cumulative[offsets[1:]] - cumulative[offsets[:-1]]).astype(np.float32)
+
+
+def total_reward_weights(rewards: np.array, offsets: np.array) -> np.array:
+    """Naive policy gradient weights, every step is weighted by the total reward of its episode.
+
+    Returns:
+        Array with the weight of each step
+    """
+    return np.repeat(episode_returns(rewards, offsets), np.diff(offsets))
+
+
+def rewards_to_go(rewards: np.array, offsets: np.array) -> np.array:
+    """Reward to go weights, every step is weighted by the sum of the rewards from that step
+    to the end of its episode.
+
+    A reverse cumulative sum over the whole batch gives the rewards to the end of the batch,
+    the rewards after the end of each episode are then subtracted.
+
+    Returns:
+        Array with the weight of each step
+    """
+    suffix = np.zeros(len(rewards) + 1, dtype=np.float64)
+    np.cumsum(rewards[::-1], out=suffix[-2::-1])
+    episode_ends = np.repeat(offsets[1:], np.diff(offsets))
+    return (suffix[:-1] - suffix[episode_ends]).astype(np.float32)
+
+
+def discounted_rewards_to_go(rewards: np.array, offsets: np.array, discount_factor: float) -> np.array:
+    """Discounted reward to go weights, the weight of step t of an episode of length T is
+    sum(discount_factor ** (k - t) * rewards[k] for k in range(t, T)).
+
+    The steps are laid out in rows (segments) of at most the mean episode length, one
+    reverse cumulative sum along the rows scans all the segments at once, and the sum
+    of each segment is then carried to the previous segment of its episode.
+
+    Returns:
+        Array with the weight of each step
+    """
+    if not 0. <= discount_factor <= 1.:
+        raise ValueError(f"The discount factor must be in [0, 1], got {discount_factor}")
+
+    lengths = np.diff(offsets)
+    if len(rewards) == 0:
+        return np.zeros(0, dtype=np.float32)
+    if discount_factor == 0.:
+        return np.array(rewards, dtype=np.float32)
+
+    # Rows of the mean episode length keep the padding below one step per step of the batch,
+    # and they are shortened if needed for the discount powers to stay above MIN_DISCOUNT_SCALE
+    segment_size = -(-len(rewards) // len(lengths))
+    if discount_factor < 1.:
+        segment_size = min(segment_size, max(1, int(np.log(MIN_DISCOUNT_SCALE) / np.log(discount_factor))))
+
+    # Position of each step in its episode, segment and the position in the segment
+    positions = np.arange(len(rewards)) - np.repeat(offsets[:-1], lengths)
+    episode_segments = -(-lengths // segment_size)
+    segment_offsets = episode_offsets(episode_segments)
+    segments = np.repeat(segment_offsets[:-1], lengths) + positions // segment_size
+    columns = positions % segment_size
+
+    # Rewards of each segment in a row, padded with zeros and scaled by the discount powers
+    # of their column. The scaled sums are scaled back to the discounted sums from each column
+    powers = np.power(np.float64(discount_factor), np.arange(segment_size + 1))
+    scaled = np.zeros((segment_offsets[-1], segment_size), dtype=np.float64)
+    scaled[segments, columns] = rewards * powers[columns]
+    discounted = np.cumsum(scaled[:, ::-1], axis=1)[:, ::-1]
+    discounted /= powers[:-1]
+
+    # Only the last segment of an episode can be shorter, so the sum of the next segment
+    # is discounted by the distance from each column to the end of a full segment
+    tail_powers = powers[:0:-1]
+    for k in range(episode_segments.max() - 1, 0, -1):
+        # Episodes with more than k segments carry from segment k to segment k - 1
+        carrying = segment_offsets[:-1][episode_segments > k]
+        discounted[carrying + k - 1] += tail_powers * discounted[carrying + k, :1]
+
+    return discounted[segments, columns].astype(np.float32)
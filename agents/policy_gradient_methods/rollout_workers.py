@@ -0,0 +1,182 @@
+"""
+Rollout worker processes for the policy gradient agents.
+Each worker owns its own copies of the environment and a NumPy copy of the policy,
+and plays its share of an experience batch writing the steps straight into shared
+memory, where the learner reads them as arrays. The learner publishes its policy
+weights in shared memory before each batch.
+"""
+
+import multiprocessing
+import queue
+import traceback
+
+import numpy as np
+
+from agents.policy_gradient_methods.envs import EpisodesBatch, play_episodes
+from code_utils.inference_utils import DenseInferenceEngine
+from code_utils.shared_memory_utils import SharedArrays, WeightsBroadcast
+
+
+# Seconds between the checks that the workers are alive while waiting for their results
+RESULTS_POLL_INTERVAL = 1.
+
+
+class RolloutWorkerPool(object):
+    """Pool of processes that collect experience batches together.
+
+    Every worker has a region of the shared memory buffers for its steps, with room for
+    its share of the batch and a max length episode of each of its environment copies.
+    Only the tasks and the number of collected episodes go through queues.
+    """
+
+    def __init__(self, workers_count: int, environment_class, environments_count: int,
+                 experience_size: int, weights_shapes: list, activation: str):
+        """Start the worker processes.
+
+        Args:
+            workers_count: The number of worker processes
+            environment_class: The Environment type, each worker creates its own instance
+            environments_count: The number of environment copies stepped in lockstep by each worker
+            experience_size: The number of environment steps of each batch
+            weights_shapes: The shape of each policy weights array
+            activation: Activation function of the policy hidden layers
+        """
+        environment = environment_class()
+        if environment.max_episode_length is None:
+            raise ValueError(f"{environment_class.__name__} has no max_episode_length, "
+                             f"it is needed to preallocate the experience buffers.")
+
+        self.workers_count = workers_count
+        self.experience_size = experience_size
+        self.worker_size = -(-experience_size // workers_count)
+        self.worker_capacity = self.worker_size + environments_count * environment.max_episode_length
+        self.buffers = SharedArrays({
+            "states": ((workers_count, self.worker_capacity, environment.state_space_n), np.float32),
+            "actions": ((workers_count, self.worker_capacity), np.int32),
+            "rewards": ((workers_count, self.worker_capacity), np.float32),
+            "episode_lengths": ((workers_count, self.worker_capacity), np.int64)})
+
+        context = multiprocessing.get_context("spawn")
+        self.broadcast = WeightsBroadcast(weights_shapes, context)
+        self.version = 0
+        self.tasks = [context.Queue() for _ in range(workers_count)]
+        self.results = context.Queue()
+        self.workers = [context.Process(target=run_rollout_worker, name=f"rollout_worker_{worker_id}",
+                                        args=(worker_id, environment_class, environments_count, self.worker_size,
+                                              self.worker_capacity, self.buffers, self.broadcast,
+                                              self.tasks[worker_id], self.results, activation,
+                                              np.random.randint(2 ** 31)),
+                                        daemon=True)
+                        for worker_id in range(workers_count)]
+        for worker in self.workers:
+            worker.start()
+
+    @property
+    def capacity(self) -> int:
+        """The number of steps of all the workers regions, that a batch given to collect must hold."""
+        return self.workers_count * self.worker_capacity
+
+    def collect(self, episodes_batch: EpisodesBatch, weights: list):
+        """Collect a batch with the given policy weights.
+
+        Args:
+            episodes_batch: The batch to fill with the episodes of all the workers, it is cleared first
+            weights: The policy weights as returned by get_weights
+        """
+        self.version += 1
+        self.broadcast.publish(weights, self.version)
+        for tasks in self.tasks:
+            tasks.put(self.version)
+
+        episodes_counts = [0] * self.workers_count
+        for _ in range(self.workers_count):
+            result = self.wait_result()
+            if isinstance(result, str):
+                raise RuntimeError(f"Rollout worker failed:\n{result}")
+            worker_id, episodes_count = result
+            episodes_counts[worker_id] = episodes_count
+
+        episodes_batch.clear()
+        for worker_id, episodes_count in enumerate(episodes_counts):
+            episode_lengths = self.buffers["episode_lengths"][worker_id, :episodes_count]
+            steps = int(episode_lengths.sum())
+            episodes_batch.add_episodes(self.buffers["states"][worker_id, :steps],
+                                        self.buffers["actions"][worker_id, :steps],
+                                        self.buffers["rewards"][worker_id, :steps],
+                                        episode_lengths)
+
+    def wait_result(self):
+        """Wait for the result of a worker, checking that the workers are still running.
+
+        Returns:
+            The worker id and its number of collected episodes, or the traceback of a failed task
+        """
+        while True:
+            try:
+                return self.results.get(timeout=RESULTS_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+            # Workers only exit when closed, one killed by a signal or out of memory sends no result
+            for worker in self.workers:
+                if worker.exitcode is not None:
+                    raise RuntimeError(f"{worker.name} exited with code {worker.exitcode}")
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.buffers.close()
+        self.broadcast.close()
+
+
+def run_rollout_worker(worker_id: int, environment_class, environments_count: int, worker_size: int,
+                       worker_capacity: int, buffers: SharedArrays, broadcast: WeightsBroadcast,
+                       tasks, results, activation: str, seed: int):
+    """Worker process loop.
+
+    For each task play worker_size steps (finishing the running episodes) with the
+    latest published weights, until the task is None.
+
+    Args:
+        worker_id: Identifies the worker region of the buffers
+        environment_class: The Environment type
+        environments_count: The number of environment copies stepped in lockstep
+        worker_size: The number of steps collected for each task
+        worker_capacity: The number of steps of the worker region of the buffers
+        buffers: Where the steps and the episodes lengths are written
+        broadcast: Where the learner publishes the weights
+        tasks: Queue with the tasks of this worker
+        results: Queue where the number of collected episodes (or an error) is sent
+        activation: The activation of the policy hidden layers
+        seed: Random seed of this worker
+    """
+    np.random.seed(seed)
+    try:
+        environment = environment_class()
+        policy = DenseInferenceEngine(activation)
+        version = -1
+        episodes_batch = EpisodesBatch(max_size=worker_size, state_space_n=environment.state_space_n,
+                                       overflow_size=worker_capacity - worker_size,
+                                       buffers=(buffers["states"][worker_id], buffers["actions"][worker_id],
+                                                buffers["rewards"][worker_id]))
+    except Exception:
+        results.put(traceback.format_exc())
+        return
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        try:
+            new_weights, version = broadcast.latest(version)
+            if new_weights is not None:
+                policy.set_weights(new_weights)
+
+            play_episodes(environment, environments_count, episodes_batch, policy.sample_actions)
+
+            episode_lengths = np.diff(episodes_batch.offsets)
+            buffers["episode_lengths"][worker_id, :len(episode_lengths)] = episode_lengths
+            results.put((worker_id, len(episode_lengths)))
+        except Exception:
+            results.put(traceback.format_exc())
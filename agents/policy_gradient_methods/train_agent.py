@@ -11,7 +11,7 @@ SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
 sys.path.append(str(SCRIPT_DIR.parent.parent.parent))
 
 from agents.policy_gradient_methods import ENVIRONMENTS, PG_METHODS
-from code_utils import prepare_file_logger, prepare_stream_logger
+from code_utils import prepare_file_logger, prepare_stream_logger, save_results
 
 logger = logging.getLogger()
 prepare_stream_logger(logger, logging.INFO)
@@ -45,12 +45,26 @@ def main():
                         help="Activate to run Tensorflow in eager mode.")
     parser.add_argument("--replace", action="store_true", default=False,
                         help="Activate to replace old experiment in the output folder.")
+    parser.add_argument("--test_episodes", type=int, default=100,
+                        help="The number of episodes played after training to measure the win rate.")
+    parser.add_argument("--intra_op_threads", type=int, default=None,
+                        help="Threads used by Tensorflow inside an operation. "
+                             "If not set Tensorflow picks the value.")
+    parser.add_argument("--inter_op_threads", type=int, default=None,
+                        help="Threads used by Tensorflow to run independent operations. "
+                             "If not set Tensorflow picks the value.")
     args = parser.parse_args()
 
     # On debug mode all functions are executed normally (eager mode)
     if args.debug:
         tf.config.run_functions_eagerly(True)
 
+    # Limit threads so parallel experiments don't oversubscribe the cores
+    if args.intra_op_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    if args.inter_op_threads is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+
     # Use provided configurations file or the default for the selected environment and agent
     if args.config_file is None:
         config_file = Path(CONFIGS_DIR, f"{args.env}_{args.agent}_default.json")
@@ -68,7 +82,7 @@ def main():
             raise FileExistsError(f"The experiment {agent_folder} already exists."
                                   f"Change output folder, experiment name or use -replace "
                                   f"to overwrite.")
-    agent_folder.mkdir()
+    agent_folder.mkdir(parents=True)
 
     # Save experiments configurations and start experiment log
     prepare_file_logger(logger, logging.INFO, Path(agent_folder, "experiment.log"))
@@ -82,9 +96,19 @@ def main():
 
     # Create and train the agent
     agent = PG_METHODS[args.agent]["agent"](env=ENVIRONMENTS[args.env](), agent_path=agent_folder, agent_config=config)
-    agent.train_policy(train_steps=config.training_steps, experience_size=config.experience_size,
-                       show_every=show_every, save_policy_every=config.save_policy_every,
-                       minibatch_size=config.minibatch_size)
+    moving_avg = agent.train_policy(train_steps=config.training_steps, experience_size=config.experience_size,
+                                    show_every=show_every, save_policy_every=config.save_policy_every,
+                                    minibatch_size=config.minibatch_size, max_policy_lag=config.max_policy_lag,
+                                    profile_phases=config.profile_phases, profile_steps=config.profile_steps)
+
+    # Environments without a win condition return None
+    wins = [agent.play_game()[1] for _ in range(args.test_episodes)]
+    win_rate = None if args.test_episodes == 0 or wins[0] is None else sum(wins) * 100 / len(wins)
+    logger.info(f"Agent performance = {win_rate} % of Wins")
+
+    # The moving average is empty when training was shorter than show_every
+    reward_moving_average = moving_avg[-1] if len(moving_avg) else None
+    save_results(agent_folder, win_rate=win_rate, reward_moving_average=reward_moving_average)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,296 @@
+"""
+Runs one experiment per configuration file in a folder, in parallel processes.
+ - The number of parallel processes is sized to the machine, and Tensorflow threads
+   are limited in each of them so they don't oversubscribe the cores.
+ - Configurations that already have results in the output folder are skipped,
+   so an interrupted sweep can be resumed running the same command.
+ - Optionally, successive halving stops configurations that are clearly losing.
+ - The results of all runs are consolidated in a table (sweep_results.csv).
+Works with the Deep Q Learning Mountain Car and the policy gradient train_agent.py scripts.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SCRIPT_DIR = Path(os.path.abspath(sys.argv[0]))
+sys.path.append(str(SCRIPT_DIR.parent.parent))
+
+from code_utils import prepare_stream_logger, load_results
+
+
+logger = logging.getLogger()
+prepare_stream_logger(logger, logging.INFO)
+
+
+AGENTS_DIR = SCRIPT_DIR.parent
+ENTRY_POINTS = {"dqn": Path(AGENTS_DIR, "deep_q_learning", "mountain_car", "train_agent.py"),
+                "policy_gradient": Path(AGENTS_DIR, "policy_gradient_methods", "train_agent.py")}
+SWEEP_STATE_FILE = "sweep_state.json"
+SWEEP_RESULTS_FILE = "sweep_results.csv"
+
+# Both training loops log this line on every show block
+REWARD_MEAN_PATTERN = re.compile(r"episodes reward mean: ([-+\w.]+)")
+
+
+class Experiment(object):
+    """A single training run of the sweep."""
+
+    def __init__(self, config_file: Path, agent_folder: Path, command: list):
+        """
+        :param config_file: The experiment configurations file
+        :param agent_folder: Where the train_agent.py script saves the experiment
+        :param command: The command that runs the experiment
+        """
+        self.name = config_file.stem
+        self.config_file = config_file
+        self.agent_folder = agent_folder
+        self.command = command
+        self.status = "pending"
+        self.process = None
+        self.output_file = None
+        self.log_position = 0
+        self.reward_means = []
+        self.rung = 0
+        self.win_rate = None
+        self.reward_moving_average = None
+
+    def start(self, env: dict, output_file: Path):
+        self.output_file = open(output_file, "w", encoding="utf8")
+        self.process = subprocess.Popen(self.command, env=env, stdout=self.output_file,
+                                        stderr=subprocess.STDOUT)
+        self.status = "running"
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.finish("stopped")
+
+    def finish(self, status: str):
+        self.status = status
+        self.output_file.close()
+        self.process = None
+        results = load_results(self.agent_folder)
+        if results is not None:
+            self.win_rate = results["win_rate"]
+            self.reward_moving_average = results["reward_moving_average"]
+
+    def read_progress(self):
+        """Parse the reward means logged since the last call."""
+        log_file = Path(self.agent_folder, "experiment.log")
+        if not log_file.exists():
+            return
+        with open(log_file, "r", encoding="utf8") as lfile:
+            lfile.seek(self.log_position)
+            lines = lfile.readlines()
+            self.log_position = lfile.tell()
+        for line in lines:
+            match = REWARD_MEAN_PATTERN.search(line)
+            if match is not None:
+                self.reward_means.append(float(match.group(1)))
+
+    def to_dict(self) -> dict:
+        return {"name": self.name,
+                "status": self.status,
+                "win_rate": self.win_rate,
+                "reward_moving_average": self.reward_moving_average,
+                "last_reward_mean": self.reward_means[-1] if self.reward_means else None,
+                "reward_reports": len(self.reward_means),
+                "rung": self.rung}
+
+
+class SuccessiveHalving(object):
+    """
+    Asynchronous successive halving. Rung k is reached after `min_reports * eta ** k`
+    reward reports. An experiment reaching a rung continues only if it is in the top
+    1 / eta of all the experiments that reached that rung so far (at least eta of them).
+    """
+
+    def __init__(self, eta: int, min_reports: int):
+        self.eta = eta
+        self.min_reports = min_reports
+        self.rungs = {}
+
+    def rung_reports(self, rung: int) -> int:
+        return self.min_reports * self.eta ** rung
+
+    def should_stop(self, experiment: Experiment) -> bool:
+        """
+        Move the experiment through the rungs it reached.
+        :return: True if the experiment is losing in one of them
+        """
+        while len(experiment.reward_means) >= self.rung_reports(experiment.rung):
+            value = experiment.reward_means[self.rung_reports(experiment.rung) - 1]
+            rung_values = self.rungs.setdefault(experiment.rung, [])
+            rung_values.append(value)
+
+            if len(rung_values) >= self.eta:
+                keep = max(1, len(rung_values) // self.eta)
+                cutoff = sorted(rung_values, reverse=True)[keep - 1]
+                if value < cutoff:
+                    return True
+
+            experiment.rung += 1
+
+        return False
+
+
+def agent_folder_for(args, config_file: Path) -> Path:
+    if args.agent_type == "dqn":
+        return Path(args.output_dir, "mountain_car", config_file.stem)
+    return Path(args.output_dir, args.env, args.agent, config_file.stem)
+
+
+def experiment_command(args, config_file: Path) -> list:
+    command = [sys.executable, str(ENTRY_POINTS[args.agent_type]),
+               "--name", config_file.stem,
+               "--config_file", str(config_file),
+               "--output_dir", str(args.output_dir),
+               "--replace",
+               "--intra_op_threads", str(args.threads_per_worker),
+               "--inter_op_threads", "1"]
+    if args.agent_type == "policy_gradient":
+        command += ["--env", args.env, "--agent", args.agent]
+    return command
+
+
+def save_sweep(output_dir: Path, experiments: list):
+    """Write the sweep state (used to resume) and the consolidated results table."""
+    rows = [experiment.to_dict() for experiment in experiments]
+    with open(Path(output_dir, SWEEP_STATE_FILE), "w", encoding="utf8") as sfile:
+        json.dump({row["name"]: row for row in rows}, sfile, indent=4)
+
+    def sort_key(row):
+        return (row["win_rate"] if row["win_rate"] is not None else -1,
+                row["reward_moving_average"] if row["reward_moving_average"] is not None else -float("inf"))
+
+    with open(Path(output_dir, SWEEP_RESULTS_FILE), "w", encoding="utf8", newline="") as rfile:
+        writer = csv.DictWriter(rfile, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(sorted(rows, key=sort_key, reverse=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a sweep of experiments in parallel processes.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    required_named = parser.add_argument_group('REQUIRED named arguments')
+    required_named.add_argument("--configs_dir", type=str, required=True,
+                                help="Folder with one .json configuration file per experiment.")
+    required_named.add_argument("--output_dir", type=str, required=True,
+                                help="Where to save the experiments files and the sweep results.")
+    required_named.add_argument("--agent_type", type=str, choices=ENTRY_POINTS.keys(), required=True,
+                                help="Which train_agent.py script runs the experiments.")
+    parser.add_argument("--env", type=str, default=None,
+                        help="The environment to solve (policy_gradient only).")
+    parser.add_argument("--agent", type=str, default=None,
+                        help="The policy gradient method to use (policy_gradient only).")
+    parser.add_argument("--threads_per_worker", type=int, default=1,
+                        help="Tensorflow intra op threads for each experiment.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Parallel experiments. Defaults to the CPU count divided by threads_per_worker.")
+    parser.add_argument("--halving_eta", type=int, default=None,
+                        help="Activate successive halving, keeping the top 1/eta experiments at each rung.")
+    parser.add_argument("--halving_min_reports", type=int, default=5,
+                        help="Reward reports (show blocks) before the first successive halving rung.")
+    parser.add_argument("--poll_every", type=float, default=5.,
+                        help="Seconds between checks of the running experiments.")
+    args = parser.parse_args()
+
+    if args.agent_type == "policy_gradient" and (args.env is None or args.agent is None):
+        raise ValueError("Policy gradient sweeps need the --env and --agent arguments.")
+
+    args.output_dir = Path(args.output_dir)
+    args.output_dir.mkdir(exist_ok=True, parents=True)
+    sweep_logs_dir = Path(args.output_dir, "sweep_logs")
+    sweep_logs_dir.mkdir(exist_ok=True)
+
+    workers = args.workers
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // args.threads_per_worker)
+
+    # Also limit the threads of libraries used outside Tensorflow
+    env = dict(os.environ)
+    env["OMP_NUM_THREADS"] = str(args.threads_per_worker)
+    env["MKL_NUM_THREADS"] = str(args.threads_per_worker)
+
+    previous_state = {}
+    state_file = Path(args.output_dir, SWEEP_STATE_FILE)
+    if state_file.exists():
+        with open(state_file, "r", encoding="utf8") as sfile:
+            previous_state = json.load(sfile)
+
+    experiments = []
+    pending = []
+    for config_file in sorted(Path(args.configs_dir).glob("*.json")):
+        experiment = Experiment(config_file, agent_folder_for(args, config_file),
+                                experiment_command(args, config_file))
+        experiments.append(experiment)
+
+        # Resume: skip experiments that finished or were stopped on a previous run
+        previous = previous_state.get(experiment.name, {})
+        results = load_results(experiment.agent_folder)
+        if results is not None or previous.get("status") == "stopped":
+            experiment.status = "done" if results is not None else "stopped"
+            experiment.win_rate = previous.get("win_rate") if results is None else results["win_rate"]
+            experiment.reward_moving_average = previous.get("reward_moving_average") if results is None \
+                else results["reward_moving_average"]
+            logger.info(f"Skipping {experiment.name}, it has results from a previous run")
+        else:
+            pending.append(experiment)
+
+    if not experiments:
+        raise ValueError(f"No configuration files found in {args.configs_dir}")
+
+    logger.info(f"Running {len(pending)} experiments with {workers} workers and "
+                f"{args.threads_per_worker} Tensorflow threads per worker")
+
+    halving = None
+    if args.halving_eta is not None:
+        halving = SuccessiveHalving(eta=args.halving_eta, min_reports=args.halving_min_reports)
+
+    start_time = time.time()
+    running = []
+    while pending or running:
+        while pending and len(running) < workers:
+            experiment = pending.pop(0)
+            experiment.start(env, Path(sweep_logs_dir, f"{experiment.name}.txt"))
+            running.append(experiment)
+            logger.info(f"Started {experiment.name}")
+
+        time.sleep(args.poll_every)
+
+        for experiment in list(running):
+            experiment.read_progress()
+            return_code = experiment.process.poll()
+
+            if return_code is not None:
+                experiment.read_progress()
+                experiment.finish("done" if return_code == 0 else "failed")
+                running.remove(experiment)
+                logger.info(f"Finished {experiment.name} ({experiment.status}) - "
+                            f"win rate {experiment.win_rate} - "
+                            f"reward moving average {experiment.reward_moving_average}")
+            elif halving is not None and halving.should_stop(experiment):
+                experiment.stop()
+                running.remove(experiment)
+                logger.info(f"Stopped {experiment.name} at rung {experiment.rung} - "
+                            f"reward mean {experiment.reward_means[-1]}")
+
+        save_sweep(args.output_dir, experiments)
+
+    save_sweep(args.output_dir, experiments)
+    logger.info(f"Sweep finished in {time.time() - start_time} sec")
+    with open(Path(args.output_dir, SWEEP_RESULTS_FILE), "r", encoding="utf8") as rfile:
+        for line in rfile:
+            logger.info(line.rstrip())
+
+
+if __name__ == '__main__':
+    main()
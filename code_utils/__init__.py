@@ -1,2 +1,5 @@
 from .config_utils import BaseConfig
 from .logger_utils import prepare_file_logger, prepare_stream_logger
+from .results_utils import save_results, load_results
+from .shared_memory_utils import SharedArrays, WeightsBroadcast
+from .inference_utils import DenseInferenceEngine
@@ -0,0 +1,134 @@
+import numpy as np
+
+
+def relu(x: np.array):
+    np.maximum(x, 0., out=x)
+
+
+def tanh(x: np.array):
+    np.tanh(x, out=x)
+
+
+def sigmoid(x: np.array):
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1.
+    np.reciprocal(x, out=x)
+
+
+def linear(x: np.array):
+    pass
+
+
+# In place activations of the hidden layers
+ACTIVATIONS = {"relu": relu, "tanh": tanh, "sigmoid": sigmoid, "linear": linear}
+
+
+class DenseInferenceEngine(object):
+    """
+    Forward pass of a stack of Dense layers with NumPy, for acting without the
+    Tensorflow dispatch cost of calling the model on one or a few states.
+    It runs on a read-only float32 snapshot of the weights and writes the layers
+    outputs to buffers preallocated for each batch size.
+    The snapshot is taken again on the next call after invalidate, so owners must
+    invalidate the engine every time the model weights change.
+    """
+
+    def __init__(self, activation: str="relu", weights_source=None):
+        """
+        :param activation: The activation of the hidden layers, the output layer is linear
+        :param weights_source: Function that returns the model weights as returned by
+                               get_weights (kernel and bias of each layer). If None the
+                               weights must be given with set_weights.
+        """
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"Activation {activation} is not supported, use one of {list(ACTIVATIONS)}.")
+        self.activation = ACTIVATIONS[activation]
+        self.weights_source = weights_source
+        self.kernels = None
+        self.biases = None
+        self.buffers = {}
+
+    def set_weights(self, weights: list):
+        """
+        Take a snapshot of the weights.
+        :param weights: The kernel and bias of each layer, in order
+        """
+        snapshot = []
+        for array in weights:
+            array = np.array(array, dtype=np.float32, order="C")
+            array.flags.writeable = False
+            snapshot.append(array)
+        self.kernels = snapshot[0::2]
+        self.biases = snapshot[1::2]
+
+        # The layer sizes may have changed
+        self.buffers = {}
+
+    def invalidate(self):
+        """Drop the snapshot, the weights source is read again on the next call."""
+        self.kernels = None
+        self.biases = None
+
+    def layers_buffers(self, batch_size: int) -> list:
+        if batch_size not in self.buffers:
+            self.buffers[batch_size] = [np.empty((batch_size, self.kernels[0].shape[0]), dtype=np.float32)] + \
+                                       [np.empty((batch_size, kernel.shape[1]), dtype=np.float32)
+                                        for kernel in self.kernels]
+        return self.buffers[batch_size]
+
+    def forward(self, states: np.array) -> np.array:
+        """
+        :param states: Array of shape (n, inputs)
+        :return: The outputs of the last layer, array of shape (n, outputs).
+                 It is a buffer of the engine, overwritten by the next call with the same batch size.
+        """
+        if self.kernels is None:
+            if self.weights_source is None:
+                raise ValueError("The engine has no weights, set them with set_weights.")
+            self.set_weights(self.weights_source())
+
+        buffers = self.layers_buffers(len(states))
+        x = buffers[0]
+        x[...] = states
+        last_layer = len(self.kernels) - 1
+        for i, (kernel, bias, out) in enumerate(zip(self.kernels, self.biases, buffers[1:])):
+            np.matmul(x, kernel, out=out)
+            out += bias
+            if i < last_layer:
+                self.activation(out)
+            x = out
+        return x
+
+    def greedy_actions(self, states: np.array) -> np.array:
+        """
+        :return: The action with the highest output for each state
+        """
+        return np.argmax(self.forward(states), axis=1)
+
+    def greedy_action(self, state) -> int:
+        """
+        :return: The action with the highest output for one state
+        """
+        return int(np.argmax(self.forward(np.reshape(state, (1, -1)))[0]))
+
+    def sample_actions(self, states: np.array) -> np.array:
+        """
+        Sample an action from the softmax of the outputs (the policy logits) for each state.
+        """
+        logits = self.forward(states)
+        probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+        cumulative = np.cumsum(probabilities, axis=1)
+        thresholds = np.random.random(len(states)) * cumulative[:, -1]
+        actions = np.sum(cumulative <= thresholds[:, None], axis=1)
+        return np.minimum(actions, cumulative.shape[1] - 1)
+
+    def sample_action(self, state) -> int:
+        """
+        Sample an action from the softmax of the outputs (the policy logits) for one state.
+        """
+        logits = self.forward(np.reshape(state, (1, -1)))[0]
+        probabilities = np.exp(logits - logits.max())
+        cumulative = np.cumsum(probabilities)
+        action = np.searchsorted(cumulative, np.random.random() * cumulative[-1], side="right")
+        return int(min(action, len(cumulative) - 1))
@@ -0,0 +1,226 @@
+import json
+import logging
+import math
+import threading
+import time
+from pathlib import Path
+
+
+logger = logging.getLogger()
+
+
+REPORT_FILE = "profile_report.json"
+
+# Durations histogram: log spaced bins from 100 ns to 1000 s
+MIN_LOG_SECONDS = -7
+MAX_LOG_SECONDS = 3
+BINS_PER_DECADE = 20
+BINS_COUNT = (MAX_LOG_SECONDS - MIN_LOG_SECONDS) * BINS_PER_DECADE
+
+PERCENTILES = (50, 90, 99)
+
+
+class PhaseTimes(object):
+    """
+    Running statistics of the durations of one phase. The percentiles come from a
+    histogram with log spaced bins, so the memory doesn't grow with the number of
+    measures and they are accurate to about 12% of the duration.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.bins = [0] * BINS_COUNT
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if seconds > 0:
+            index = int((math.log10(seconds) - MIN_LOG_SECONDS) * BINS_PER_DECADE)
+            self.bins[min(max(index, 0), BINS_COUNT - 1)] += 1
+        else:
+            self.bins[0] += 1
+
+    def percentile(self, percentile: float) -> float:
+        """
+        :param percentile: Between 0 and 100
+        :return: The upper edge of the bin of the percentile, in seconds
+        """
+        if self.count == 0:
+            return 0.
+        rank = percentile / 100 * self.count
+        cumulative = 0
+        for index, count in enumerate(self.bins):
+            cumulative += count
+            if cumulative >= rank and count > 0:
+                return min(10 ** (MIN_LOG_SECONDS + (index + 1) / BINS_PER_DECADE), self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        statistics = {"count": self.count,
+                      "total_seconds": self.total,
+                      "mean_seconds": self.total / self.count if self.count else 0.,
+                      "max_seconds": self.max}
+        for percentile in PERCENTILES:
+            statistics[f"p{percentile}_seconds"] = self.percentile(percentile)
+        return statistics
+
+
+class Phase(object):
+    """Context manager that adds the time spent in its block to a phase of a PhaseProfiler."""
+
+    def __init__(self, profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullPhase(object):
+    """Context manager of a disabled PhaseProfiler, it does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_PHASE = NullPhase()
+
+
+class PhaseProfiler(object):
+    """
+    Measures the time spent in each phase of a training loop (environment steps, policy
+    inference, training steps, etc.) by wrapping them in `with profiler.phase(name):` blocks.
+    The totals and percentiles of each phase are written as Tensorboard summaries and to a
+    JSON report. A window of training steps can also be captured with the Tensorflow profiler.
+    Phases can be measured from several threads. A disabled profiler only costs a method call per phase.
+    Tensorflow is only imported when the summaries or the Tensorflow profiler are used, so the
+    NumPy only processes (rollout workers, actors) that time their phases don't load it.
+    """
+
+    def __init__(self, enabled: bool=True, summary_writer=None, profile_steps: tuple=None,
+                 profile_dir: Path=None):
+        """
+        :param enabled: If False nothing is measured
+        :param summary_writer: Tensorflow summary writer for the phases statistics, None to not write them
+        :param profile_steps: The first and the last (excluded) training steps captured with the
+                              Tensorflow profiler, None to not use it
+        :param profile_dir: Where the Tensorflow profiler writes the captured steps
+        """
+        if profile_steps is not None and profile_dir is None:
+            raise ValueError("The Tensorflow profiler needs a profile_dir.")
+        self.enabled = enabled
+        self.summary_writer = summary_writer
+        self.profile_steps = None if profile_steps is None else tuple(profile_steps)
+        self.profile_dir = profile_dir
+        self.profiling = False
+        self.phases = {}
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+
+    def phase(self, name: str):
+        """
+        :param name: The phase measured by the returned context manager
+        """
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self, name)
+
+    def add(self, name: str, seconds: float):
+        """
+        Add a measure of a phase timed by the caller.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            if name not in self.phases:
+                self.phases[name] = PhaseTimes()
+            self.phases[name].add(seconds)
+
+    def training_step(self, step: int):
+        """
+        Start or stop the Tensorflow profiler if the training step starts or ends its window.
+        Call it at the start of every training step.
+        :param step: The training step about to start
+        """
+        if self.profile_steps is None:
+            return
+        first_step, last_step = self.profile_steps
+        if step == first_step and not self.profiling:
+            import tensorflow as tf
+            logger.info(f"Starting the Tensorflow profiler at training step {step}")
+            tf.profiler.experimental.start(str(self.profile_dir))
+            self.profiling = True
+        elif step == last_step and self.profiling:
+            self.stop_profiler()
+
+    def stop_profiler(self):
+        if self.profiling:
+            import tensorflow as tf
+            tf.profiler.experimental.stop()
+            self.profiling = False
+            logger.info(f"Tensorflow profile saved to {self.profile_dir}")
+
+    def report(self) -> dict:
+        """
+        :return: The statistics of each phase and its share of the time since the profiler was created
+        """
+        elapsed = time.perf_counter() - self.start_time
+        with self.lock:
+            phases = {name: times.to_dict() for name, times in self.phases.items()}
+        for statistics in phases.values():
+            statistics["share"] = statistics["total_seconds"] / elapsed if elapsed > 0 else 0.
+        return {"elapsed_seconds": elapsed, "phases": phases}
+
+    def write_summaries(self, step: int):
+        """
+        Write the statistics of each phase to the summary writer.
+        :param step: The step of the summaries
+        """
+        if not self.enabled or self.summary_writer is None:
+            return
+        import tensorflow as tf
+        report = self.report()
+        with self.summary_writer.as_default():
+            for name, statistics in report["phases"].items():
+                tf.summary.scalar(f"phases/{name}/total_seconds", data=statistics["total_seconds"], step=step)
+                tf.summary.scalar(f"phases/{name}/share", data=statistics["share"], step=step)
+                for percentile in PERCENTILES:
+                    tf.summary.scalar(f"phases/{name}/p{percentile}_ms",
+                                      data=statistics[f"p{percentile}_seconds"] * 1e3, step=step)
+        self.summary_writer.flush()
+
+    def log_report(self):
+        if not self.enabled:
+            return
+        for name, statistics in sorted(self.report()["phases"].items(),
+                                       key=lambda item: -item[1]["total_seconds"]):
+            logger.info(f"Phase {name}: {statistics['total_seconds']:.2f} sec ({100 * statistics['share']:.1f}%) - "
+                        f"{statistics['count']} times - p50 {statistics['p50_seconds'] * 1e3:.3f} ms - "
+                        f"p99 {statistics['p99_seconds'] * 1e3:.3f} ms")
+
+    def save_report(self, output_dir: Path):
+        """
+        Save the report as a JSON file in a folder.
+        :param output_dir: Where to save the report
+        """
+        if not self.enabled:
+            return
+        with open(Path(output_dir, REPORT_FILE), "w", encoding="utf8") as rfile:
+            json.dump(self.report(), rfile, indent=4)
+
+    def close(self):
+        """Stop the Tensorflow profiler if its window didn't end."""
+        self.stop_profiler()
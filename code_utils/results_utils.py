@@ -0,0 +1,31 @@
+import json
+from pathlib import Path
+
+
+RESULTS_FILE = "results.json"
+
+
+def save_results(agent_folder: Path, win_rate: float=None, reward_moving_average: float=None):
+    """
+    Save the final results of an experiment to a json file in its folder.
+    The file is written last, so its presence means the experiment finished.
+    :param agent_folder: The experiment folder
+    :param win_rate: Percentage of won test episodes (None if the environment has no win condition)
+    :param reward_moving_average: Last value of the training reward moving average
+    """
+    results = {"win_rate": None if win_rate is None else float(win_rate),
+               "reward_moving_average": None if reward_moving_average is None else float(reward_moving_average)}
+    with open(Path(agent_folder, RESULTS_FILE), "w", encoding="utf8") as rfile:
+        json.dump(results, rfile, indent=4)
+
+
+def load_results(agent_folder: Path) -> dict:
+    """
+    :param agent_folder: The experiment folder
+    :return: The saved results, or None if the experiment has no results
+    """
+    results_file = Path(agent_folder, RESULTS_FILE)
+    if not results_file.exists():
+        return None
+    with open(results_file, "r", encoding="utf8") as rfile:
+        return json.load(rfile)
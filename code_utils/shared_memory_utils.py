@@ -0,0 +1,94 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# Arrays start at cache line boundaries
+ALIGNMENT = 64
+
+
+class SharedArrays(object):
+    """
+    A group of NumPy arrays stored in a single shared memory block, used to exchange
+    data between processes without pickling it.
+    The process that creates the block owns it and unlinks it on close. When pickled
+    (e.g. as an argument of a new multiprocessing process) the copy attaches to the same block.
+    """
+
+    def __init__(self, specs: dict, name: str=None):
+        """
+        Create a new shared memory block or attach to an existing one.
+        :param specs: The shape and data type of each array, as {array_name: (shape, dtype)}
+        :param name: The name of the block to attach to. If None a new block is created.
+        """
+        self.specs = specs
+        self.owner = name is None
+
+        offsets = {}
+        size = 0
+        for key, (shape, dtype) in specs.items():
+            size = -(-size // ALIGNMENT) * ALIGNMENT
+            offsets[key] = size
+            size += int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        # Processes started by multiprocessing share the resource tracker of the owner,
+        # which unlinks the block if the owner dies without closing it
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=max(size, 1))
+
+        self.arrays = {key: np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offsets[key])
+                       for key, (shape, dtype) in specs.items()}
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def __getitem__(self, key: str) -> np.array:
+        return self.arrays[key]
+
+    def __reduce__(self):
+        return SharedArrays, (self.specs, self.name)
+
+    def close(self):
+        """Release the block in this process. The owner also destroys it."""
+        # The arrays must not reference the buffer when it's closed
+        self.arrays = {}
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class WeightsBroadcast(object):
+    """
+    The latest weights of a model, published by a learner in shared memory for its worker processes.
+    Each publication has a version (e.g. the learner training steps), so workers only copy new weights.
+    """
+
+    def __init__(self, shapes: list, context):
+        """
+        :param shapes: The shape of each weights array
+        :param context: The multiprocessing context used to create the workers
+        """
+        self.arrays = SharedArrays({f"weights_{i}": (shape, np.float32) for i, shape in enumerate(shapes)})
+        self.count = len(shapes)
+        self.version = context.Value("q", -1, lock=False)
+        self.lock = context.Lock()
+
+    def publish(self, weights: list, version: int):
+        with self.lock:
+            for i, array in enumerate(weights):
+                self.arrays[f"weights_{i}"][...] = array
+            self.version.value = version
+
+    def latest(self, current_version: int) -> (list, int):
+        """
+        :param current_version: The version of the weights held by the caller
+        :return: A copy of the weights and their version, or None if the caller has the latest version
+        """
+        if self.version.value == current_version:
+            return None, current_version
+        with self.lock:
+            weights = [self.arrays[f"weights_{i}"].copy() for i in range(self.count)]
+            return weights, self.version.value
+
+    def close(self):
+        self.arrays.close()
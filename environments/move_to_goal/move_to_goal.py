@@ -142,6 +142,9 @@ class MoveToGoal(object):
     def get_state(self):
         raise NotImplementedError()
 
+    def get_fixed_positions(self):
+        raise NotImplementedError()
+
     def step(self, **kwargs):
         raise NotImplementedError()
 
@@ -88,6 +88,13 @@ class MoveToGoalEnemy(MoveToGoal):
     def get_state(self) -> tuple:
         return self.player.position + self.goal.position + self.enemy.position
 
+    def get_fixed_positions(self) -> tuple:
+        """
+        :return: The position of each object in the state that never changes, None for the others
+        """
+        enemy_position = self.enemy_initial_pos if self.enemy_movement != "random" else None
+        return None, self.goal_initial_pos, enemy_position
+
     def step(self, player_action: int) -> (tuple, float, bool):
 
         self.execute_object_action(self.player, player_action)
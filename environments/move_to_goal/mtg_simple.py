@@ -83,6 +83,12 @@ class MoveToGoalSimple(MoveToGoal):
     def get_state(self) -> tuple:
         return self.player.position
 
+    def get_fixed_positions(self) -> tuple:
+        """
+        :return: The position of each object in the state that never changes, None for the others
+        """
+        return None,
+
     def step(self, player_action: int) -> (tuple, float, bool):
 
         self.execute_object_action(self.player, player_action)